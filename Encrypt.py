@@ -19,28 +19,371 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 #
 # origin from https://goo.gl/8PToR6
+import functools
 import hashlib
+import hmac
+import io
+import json
+import lzma
+import mmap
 import os
+import stat
 import struct
 import tempfile
+import threading
+import zlib
 from base64 import b64decode, b64encode
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from configparser import ConfigParser
-from typing import Optional, Tuple
+from itertools import chain, islice
+from typing import (Any, BinaryIO, ByteString, Callable, Dict, Iterable, Iterator, List, Mapping, NamedTuple,
+					Optional, Sequence, Tuple, TypeVar, Union)
 
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+_T = TypeVar('_T')
+_R = TypeVar('_R')
+
+# Segmented (VERSION 2) file layout:
+#   header:  <Q version> <7s nonce prefix> <I segment size>
+#   body:    one or more segments, each `ciphertext || 16 byte tag'
+# Every segment is sealed on its own with nonce = prefix || counter (>I) || last flag (B)
+# and the header prepended to the associated data, so segments cannot be
+# reordered, truncated at a segment boundary or moved between files.
+_SEGMENTED_HEADER = struct.Struct('<Q7sI')
+# VERSION 3 appends the id of the key ring entry (_NO_KEY_ID if none) and a flags byte
+# holding the id of the compression codec applied before encryption (0 for none)
+_KEYED_HEADER = struct.Struct('<Q7sIIB3x')
+_SEGMENTED_HEADERS = {2: _SEGMENTED_HEADER, 3: _KEYED_HEADER}
+_NO_KEY_ID = 0xFFFFFFFF
+_TAG_SIZE = 16
+_MAX_SEGMENTS = 1 << 32
+
+
+class _Codec(NamedTuple):
+	name: str
+	# Objects with compress(data)/flush() and decompress(data)[/flush()], as zlib.compressobj
+	compressobj: Callable[[], Any]
+	decompressobj: Callable[[], Any]
+
+
+_CODECS: Dict[int, _Codec] = {
+	1: _Codec('zlib', zlib.compressobj, zlib.decompressobj),
+	2: _Codec('lzma', lzma.LZMACompressor, lzma.LZMADecompressor),
+}
+if zstandard is not None:
+	_CODECS[3] = _Codec('zstd', lambda: zstandard.ZstdCompressor().compressobj(),
+						lambda: zstandard.ZstdDecompressor().decompressobj())
+# Input whose first block does not shrink below this ratio is stored uncompressed
+_COMPRESS_SAMPLE_SIZE = 64 * 1024
+_COMPRESS_RATIO = 0.9
+_COMPRESS_CHUNK_SIZE = 256 * 1024
+
+
+def register_compression(codec_id: int, name: str, compressobj: Callable[[], Any], decompressobj: Callable[[], Any]) -> None:
+	'''
+		Register a streaming codec under `name', `codec_id' (1-255) is stored in the file header
+	'''
+	if not 0 < codec_id < 256:
+		raise ValueError(f'Codec id should between 1 and 255, but {codec_id} found.')
+	_CODECS[codec_id] = _Codec(name, compressobj, decompressobj)
+
+
+def _codec_id(name: str) -> int:
+	for codec_id, codec in _CODECS.items():
+		if codec.name == name:
+			return codec_id
+	raise ValueError(f'Unknown compression `{name}\', available: {[codec.name for codec in _CODECS.values()]}')
+
+
+def _compressible(sample: bytes) -> bool:
+	return len(sample) > 0 and len(zlib.compress(sample, 1)) < len(sample) * _COMPRESS_RATIO
+
+
+class _PrefixedReader:
+	def __init__(self, prefix: bytes, fin: BinaryIO):
+		self._prefix: bytes = prefix
+		self._fin: BinaryIO = fin
+
+	def read(self, size: int) -> bytes:
+		if not self._prefix:
+			return self._fin.read(size)
+		data, self._prefix = self._prefix[:size], self._prefix[size:]
+		return data
+
+
+class _ChunkReader:
+	def __init__(self, chunks: Iterator[bytes]):
+		self._chunks: Iterator[bytes] = chunks
+		self._buffer = bytearray()
+
+	def read(self, size: int) -> bytes:
+		while len(self._buffer) < size:
+			chunk = next(self._chunks, None)
+			if chunk is None:
+				break
+			self._buffer += chunk
+		data = bytes(self._buffer[:size])
+		del self._buffer[:size]
+		return data
+
+
+class _CompressingReader:
+	def __init__(self, fin: Any, compressor: Any):
+		self._fin = fin
+		self._compressor = compressor
+		self._buffer = bytearray()
+		self._eof: bool = False
+
+	def read(self, size: int) -> bytes:
+		while len(self._buffer) < size and not self._eof:
+			chunk = self._fin.read(_COMPRESS_CHUNK_SIZE)
+			if chunk:
+				self._buffer += self._compressor.compress(chunk)
+			else:
+				self._buffer += self._compressor.flush()
+				self._eof = True
+		data = bytes(self._buffer[:size])
+		del self._buffer[:size]
+		return data
+
+
+class _DecompressingWriter:
+	def __init__(self, fout: BinaryIO, decompressor: Any):
+		self._fout: BinaryIO = fout
+		self._decompressor = decompressor
+
+	def write(self, data: bytes) -> None:
+		self._fout.write(self._decompressor.decompress(data))
+
+	def close(self) -> None:
+		flush = getattr(self._decompressor, 'flush', None)
+		if flush is not None:
+			self._fout.write(flush())
+
+
+class _SegmentedHeader(NamedTuple):
+	raw: bytes
+	version: int
+	nonce_prefix: bytes
+	segment_size: int
+	key_id: Optional[int] = None
+	flags: int = 0
+
+	@classmethod
+	def unpack(cls, raw: bytes) -> '_SegmentedHeader':
+		'''
+			`raw' should be a complete header, whose version is a key of _SEGMENTED_HEADERS
+		'''
+		header = cls(raw, *_SEGMENTED_HEADERS[struct.unpack_from('<Q', raw)[0]].unpack(raw))
+		return header._replace(key_id=None) if header.key_id == _NO_KEY_ID else header
+
+
+_config_cache: Dict[str, Tuple[int, ConfigParser]] = {}
+_config_lock = threading.Lock()
+
+
+def _load_config(config_file: str) -> Optional[ConfigParser]:
+	# Parsed profiles are reused until the file is modified
+	try:
+		mtime = os.stat(config_file).st_mtime_ns
+	except OSError:
+		return None
+	with _config_lock:
+		cached = _config_cache.get(config_file)
+		if cached is None or cached[0] != mtime:
+			config = ConfigParser()
+			if len(config.read(config_file)) == 0:
+				return None
+			cached = _config_cache[config_file] = (mtime, config)
+	return cached[1]
+
+
+@functools.lru_cache(maxsize=64)
+def _derive_key(hash_func: Callable, passphrase: str) -> bytes:
+	return hash_func(passphrase.encode()).digest()
+
+
+def _segment_nonce(nonce_prefix: bytes, index: int, last: bool) -> bytes:
+	if index >= _MAX_SEGMENTS:
+		raise OverflowError('Segment counter exhausted, use a larger segment size')
+	return nonce_prefix + struct.pack('>IB', index, last)
+
+
+def _encrypt_segment(key: bytes, nonce: bytes, data: bytes, associated_data: bytes) -> bytes:
+	return AESGCM(key).encrypt(nonce, data, associated_data)
+
+
+def _decrypt_segment(key: bytes, nonce: bytes, data: bytes, associated_data: bytes) -> bytes:
+	return AESGCM(key).decrypt(nonce, data, associated_data)
+
+
+def _read_full(fin: BinaryIO, size: int) -> bytes:
+	# Pipes and sockets may return short reads before EOF
+	chunk = fin.read(size)
+	if len(chunk) in (0, size):
+		return chunk
+	parts = [chunk]
+	remain = size - len(chunk)
+	while remain:
+		chunk = fin.read(remain)
+		if not chunk:
+			break
+		parts.append(chunk)
+		remain -= len(chunk)
+	return b''.join(parts)
+
+
+def _iter_chunks(fin: BinaryIO, size: int) -> Iterator[Tuple[int, bytes, bool]]:
+	'''
+		yield (index, chunk, is_last), reading one chunk ahead to find the last one.
+		Always yield at least one (maybe empty) chunk.
+	'''
+	index = 0
+	chunk = _read_full(fin, size)
+	while True:
+		following = _read_full(fin, size) if len(chunk) == size else b''
+		yield index, chunk, not following
+		if not following:
+			return
+		chunk = following
+		index += 1
+
+
+# Output buffers handed to a single vectored write
+_IOV_BATCH = 8
+
+
+def _auto_chunk_size(size: int) -> int:
+	# Next power of two of the input size, between 64 KiB and 256 KiB: large enough to
+	# amortize the per-call overhead, small enough to keep a whole batch in cache.
+	return min(1 << 18, max(1 << 16, 1 << (max(size, 1) - 1).bit_length()))
+
+
+def _writev_all(fout: BinaryIO, views: List[memoryview]) -> None:
+	if not hasattr(os, 'writev'):
+		for view in views:
+			fout.write(view)
+		return
+	fd = fout.fileno()
+	while views:
+		written = os.writev(fd, views)
+		while views and written >= len(views[0]):
+			written -= len(views.pop(0))
+		if written:
+			views[0] = views[0][written:]
+
+
+def _update_file(context, fin: BinaryIO, fout: BinaryIO, chunk_size: Optional[int] = None) -> None:
+	'''
+		Feed the rest of `fin' through an encryptor/decryptor context into `fout' (an unbuffered file).
+		The input is memory-mapped when it is a regular file, output goes through `update_into'
+		into reused buffers which are written `_IOV_BATCH' at a time with vectored writes.
+	'''
+	try:
+		status = os.fstat(fin.fileno())
+		size = status.st_size - fin.tell() if stat.S_ISREG(status.st_mode) else 0
+	except (OSError, io.UnsupportedOperation):
+		size = 0
+	if chunk_size is None:
+		chunk_size = _auto_chunk_size(size)
+	# update_into requires room for one extra block minus one byte
+	buffers = [bytearray(chunk_size + 15) for _ in range(_IOV_BATCH)]
+	outputs = [memoryview(buffer) for buffer in buffers]
+	pending: List[memoryview] = []
+
+	def feed(data: memoryview) -> None:
+		slot = len(pending)
+		pending.append(outputs[slot][:context.update_into(data, buffers[slot])])
+		if len(pending) == _IOV_BATCH:
+			_writev_all(fout, pending)
+			pending.clear()
+
+	if size > 0:
+		offset = fin.tell()
+		with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mapping, memoryview(mapping) as view:
+			for position in range(offset, offset + size, chunk_size):
+				feed(view[position:position + chunk_size])
+	else:
+		# Pipes and other special files cannot be mapped
+		source = bytearray(chunk_size)
+		with memoryview(source) as view:
+			while length := fin.readinto(source):
+				feed(view[:length])
+	_writev_all(fout, pending)
+
+
+def _ordered_map(executor: Executor, fn: Callable[..., bytes], jobs: Iterable[tuple], window: int) -> Iterator[bytes]:
+	# Keep at most `window' jobs in flight and yield results in submission order
+	pending = deque()
+	try:
+		for job in jobs:
+			if len(pending) >= window:
+				yield pending.popleft().result()
+			pending.append(executor.submit(fn, *job))
+		while pending:
+			yield pending.popleft().result()
+	finally:
+		for future in pending:
+			future.cancel()
+
+
+def _run_segments(fn: Callable[..., bytes], jobs: Iterable[tuple], executor: Optional[Executor]) -> Iterator[bytes]:
+	workers = os.cpu_count() or 1
+	if executor is not None:
+		yield from _ordered_map(executor, fn, jobs, workers * 2)
+		return
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		yield from _ordered_map(pool, fn, jobs, workers * 2)
 
 
 class AESGCMEncryptClassic:
+	# Envelope layout: <B version> <12s iv> <ciphertext> <16s tag>
+	ENVELOPE_VERSION = 1
+
+	class EnvelopeException(ValueError):
+		"""When envelope is malformed or version unsupported raise"""
+
 	def __init__(self, key: Optional[str]=None, associated_data: Optional[str]=None, config_file: str='config.ini', *, hash_func=hashlib.sha256):
-		config = ConfigParser()
+		config = None
 		if not all((key, associated_data)):
 			# Try read data from configure file
-			if len(config.read(config_file)) == 0 or not config.has_section('encrypt'):
+			config = _load_config(config_file)
+			if config is None or not config.has_section('encrypt'):
 				raise IOError(f'`{config_file}\' is not a compliant profile.')
 		#self.key = key if key else config['encrypt']['key']
-		self.key: bytes = hash_func((key if key else config['encrypt']['key']).encode()).digest()
+		self.key: bytes = _derive_key(hash_func, key if key else config['encrypt']['key'])
 		self.associated_data: bytes = (associated_data if associated_data else config['encrypt']['associated_data']).encode()
+		self._aead_cache: Optional[Tuple[bytes, AESGCM]] = None
+
+	def _get_aead(self) -> AESGCM:
+		# One-shot primitive is cached until `self.key' is replaced
+		cached = self._aead_cache
+		if cached is None or cached[0] is not self.key:
+			cached = self._aead_cache = (self.key, AESGCM(self.key))
+		return cached[1]
+
+	@staticmethod
+	def _batches(items: Iterable[_T], batch_size: int) -> Iterator[List[_T]]:
+		iterator = iter(items)
+		while batch := list(islice(iterator, batch_size)):
+			yield batch
+
+	def _map_batches(self, fn: Callable[[List[_T]], List[_R]], items: Iterable[_T],
+					 executor: Optional[Executor], batch_size: int) -> List[_R]:
+		batches = self._batches(items, batch_size)
+		if executor is None:
+			return list(chain.from_iterable(map(fn, batches)))
+		return list(chain.from_iterable(executor.map(fn, batches)))
 
 	@staticmethod
 	def _encrypt(key: bytes, plaintext: bytes, associated_data: bytes) -> Tuple[bytes, bytes, bytes]:
@@ -90,7 +433,88 @@ class AESGCMEncryptClassic:
 		'''
 			return (iv, ciphertext, encryptor.tag)
 		'''
-		return self._encrypt(self.key, binary_str, self.associated_data)
+		iv = os.urandom(12)
+		sealed = self._get_aead().encrypt(iv, binary_str, self.associated_data)
+		return iv, sealed[:-16], sealed[-16:]
+
+	def _encrypt_batch(self, batch: List[bytes]) -> List[Tuple[bytes, bytes, bytes]]:
+		seal = self._get_aead().encrypt
+		associated_data = self.associated_data
+		# One syscall for every iv in the batch
+		ivs = os.urandom(12 * len(batch))
+		result = []
+		for offset, plaintext in zip(range(0, len(ivs), 12), batch):
+			iv = ivs[offset:offset + 12]
+			sealed = seal(iv, plaintext, associated_data)
+			result.append((iv, sealed[:-16], sealed[-16:]))
+		return result
+
+	def _decrypt_batch(self, batch: List[Sequence[bytes]]) -> List[bytes]:
+		open_ = self._get_aead().decrypt
+		associated_data = self.associated_data
+		return [open_(iv, ciphertext + tag, associated_data) for iv, ciphertext, tag in batch]
+
+	def encrypt_many(self, messages: Iterable[bytes], executor: Optional[Executor] = None,
+					 batch_size: int = 1024) -> List[Tuple[bytes, bytes, bytes]]:
+		'''
+			Same output as calling `encrypt' on every message, batches of `batch_size'
+			messages are handed to `executor' when it is given.
+		'''
+		return self._map_batches(self._encrypt_batch, messages, executor, batch_size)
+
+	def decrypt_many(self, messages: Iterable[Sequence[bytes]], executor: Optional[Executor] = None,
+					 batch_size: int = 1024) -> List[bytes]:
+		'''
+			messages: iterable of (iv, ciphertext, tag)
+		'''
+		return self._map_batches(self._decrypt_batch, messages, executor, batch_size)
+
+	def b64encrypt_many(self, messages: Iterable[bytes], executor: Optional[Executor] = None,
+						batch_size: int = 1024) -> List[str]:
+		return ['\\\\n'.join(b64encode(_str).decode() for _str in item)
+				for item in self.encrypt_many(messages, executor, batch_size)]
+
+	def b64decrypt_many(self, base64_encoded_strs: Iterable[bytes], executor: Optional[Executor] = None,
+						batch_size: int = 1024) -> List[bytes]:
+		'''
+			Accept both the legacy and the envelope base64 format
+		'''
+		return self.decrypt_many(map(self._split_b64, base64_encoded_strs), executor, batch_size)
+
+	def _split_b64(self, base64_encoded_str: bytes) -> Sequence[bytes]:
+		if b'\\\\n' in base64_encoded_str:
+			return [b64decode(_str) for _str in base64_encoded_str.split(b'\\\\n')]
+		envelope = b64decode(base64_encoded_str)
+		self._check_envelope(envelope)
+		return envelope[1:13], envelope[13:-16], envelope[-16:]
+
+	def _check_envelope(self, envelope: ByteString) -> None:
+		if len(envelope) < 29:
+			raise self.EnvelopeException(f'Envelope too short ({len(envelope)} bytes)')
+		if envelope[0] != self.ENVELOPE_VERSION:
+			raise self.EnvelopeException(f'Except envelope version {self.ENVELOPE_VERSION} but {envelope[0]} found.')
+
+	def encrypt_envelope(self, binary_str: ByteString) -> bytes:
+		'''
+			return version || iv || ciphertext || tag as a single buffer
+		'''
+		iv = os.urandom(12)
+		return b''.join((
+			self.ENVELOPE_VERSION.to_bytes(1, 'little'),
+			iv,
+			self._get_aead().encrypt(iv, binary_str, self.associated_data)
+		))
+
+	def decrypt_envelope(self, envelope: ByteString) -> bytes:
+		view = memoryview(envelope)
+		self._check_envelope(view)
+		return self._get_aead().decrypt(view[1:13], view[13:], self.associated_data)
+
+	def b64encrypt_envelope(self, binary_str: ByteString) -> bytes:
+		return b64encode(self.encrypt_envelope(binary_str))
+
+	def b64decrypt_envelope(self, base64_encoded_str: ByteString) -> bytes:
+		return self.decrypt_envelope(b64decode(base64_encoded_str))
 
 	def b64encrypt(self, binary_str: bytes) -> str:
 		return '\\\\n'.join((b64encode(_str).decode() for _str in self.encrypt(binary_str)))
@@ -99,27 +523,53 @@ class AESGCMEncryptClassic:
 		return self.b64encrypt(plaintext.encode())
 
 	def decrypt(self, iv: bytes, ciphertext: bytes, tag: bytes) -> bytes:
-		return self._decrypt(self.key, self.associated_data, iv, ciphertext, tag)
+		return self._get_aead().decrypt(iv, ciphertext + tag, self.associated_data)
 
 	def decrypts(self, iv: bytes, ciphertext: bytes, tag: bytes) -> str:
 		return self.decrypt(iv, ciphertext, tag).decode()
 
 	def b64decrypt(self, base64_encoded_str: bytes) -> bytes:
+		# base64 alphabet never contains the legacy separator
+		if b'\\\\n' not in base64_encoded_str:
+			return self.b64decrypt_envelope(base64_encoded_str)
 		return self.decrypt(*(b64decode(_str.encode()) for _str in base64_encoded_str.decode().split('\\\\n')))
 
 	def b64decrypts(self, base64_encoded_str: bytes) -> str:
 		return self.b64decrypt(base64_encoded_str).decode()
 
 
+class TreeSummary(NamedTuple):
+	encrypted: int
+	unchanged: int
+	removed: int
+
+
+class _HashingReader:
+	def __init__(self, fin: BinaryIO, digest: 'hashlib._Hash'):
+		self._fin: BinaryIO = fin
+		self._digest = digest
+
+	def read(self, size: int) -> bytes:
+		data = self._fin.read(size)
+		self._digest.update(data)
+		return data
+
+
 class AESGCMEncrypt(AESGCMEncryptClassic):
 	VERSION = 1
+	SEGMENTED_VERSION = 2
+	KEYED_VERSION = 3
+	SEGMENT_SIZE = 64 * 1024
+	TREE_MANIFEST = 'manifest'
+	TREE_MANIFEST_VERSION = 1
+	TREE_OBJECTS = 'objects'
 
 	class VersionException(Exception):
 		"""When version mismatch raise"""
 
 	@staticmethod
 	def encrypt_file(key: bytes, input_file_name: str, output_file_name: str,
-					 associated_data: bytes, chunk_size: int = 1024) -> None:
+					 associated_data: bytes, chunk_size: Optional[int] = None) -> None:
 		# Generate a random 96-bit IV.
 		iv = os.urandom(12)
 
@@ -135,21 +585,24 @@ class AESGCMEncrypt(AESGCMEncryptClassic):
 		# it must also be passed in on decryption.
 		encryptor.authenticate_additional_data(associated_data)
 
-		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb', buffering=0) as fout:
 			fout.write(struct.pack('<Q12s16s', AESGCMEncrypt.VERSION, iv, b''))
-			while True:
-				chunk = fin.read(chunk_size)
-				if len(chunk) == 0:
-					break
-				fout.write(encryptor.update(chunk))
+			_update_file(encryptor, fin, fout, chunk_size)
 			fout.write(encryptor.finalize())
 			fout.seek(struct.calcsize('Q12s'))
 			fout.write(struct.pack('16s', encryptor.tag))
 			#print(AESGCMEncrypt.VERSION, iv, encryptor.tag)
 
 	@staticmethod
-	def decrypt_file(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes, chunk_size: int = 1024) -> None:
-		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+	def peek_version(input_file_name: str) -> int:
+		with open(input_file_name, 'rb') as fin:
+			return struct.unpack('<Q', fin.read(struct.calcsize('<Q')))[0]
+
+	@staticmethod
+	def decrypt_file(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes, chunk_size: Optional[int] = None) -> None:
+		if AESGCMEncrypt.peek_version(input_file_name) in _SEGMENTED_HEADERS:
+			return AESGCMEncrypt.decrypt_file_segmented(key, input_file_name, output_file_name, associated_data)
+		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb', buffering=0) as fout:
 			#associated_data_size, tag_size = struct.unpack('<QQ', fin.read(struct.calcsize('QQ')))
 			_version, iv, tag = struct.unpack('<Q12s16s', fin.read(struct.calcsize('Q12s16s')))
 			#print(_version, iv, tag)
@@ -163,35 +616,620 @@ class AESGCMEncrypt(AESGCMEncryptClassic):
 			).decryptor()
 			decryptor.authenticate_additional_data(associated_data)
 			#reader = lib_aes_gcm.chunk_reader(fin, file_size)
-			while True:
-				chunk = fin.read(chunk_size)
-				if len(chunk) == 0:
-					break
-				fout.write(decryptor.update(chunk))
+			_update_file(decryptor, fin, fout, chunk_size)
 			fout.write(decryptor.finalize())
 
-	def fencrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = 1024) -> None:
+	@staticmethod
+	def _encrypt_segmented(key: bytes, fin: BinaryIO, fout: BinaryIO, associated_data: bytes,
+						   segment_size: int, executor: Optional[Executor] = None, key_id: Optional[int] = None,
+						   compression: Optional[str] = None) -> None:
+		'''
+			`compression' is the name of a registered codec (zlib, lzma, zstd if installed),
+			it is skipped when the start of the input does not compress well.
+		'''
+		if not 0 < segment_size < 1 << 32:
+			raise ValueError(f'Segment size should between 1 and {(1 << 32) - 1}, but {segment_size} found.')
+		codec_id = 0
+		if compression is not None:
+			codec_id = _codec_id(compression)
+			sample = _read_full(fin, _COMPRESS_SAMPLE_SIZE)
+			fin = _PrefixedReader(sample, fin)
+			if _compressible(sample):
+				fin = _CompressingReader(fin, _CODECS[codec_id].compressobj())
+			else:
+				codec_id = 0
+		nonce_prefix = os.urandom(7)
+		if key_id is None and codec_id == 0:
+			header = _SEGMENTED_HEADER.pack(AESGCMEncrypt.SEGMENTED_VERSION, nonce_prefix, segment_size)
+		else:
+			header = _KEYED_HEADER.pack(AESGCMEncrypt.KEYED_VERSION, nonce_prefix, segment_size,
+										_NO_KEY_ID if key_id is None else key_id, codec_id)
+		segment_associated_data = header + associated_data
+		fout.write(header)
+		jobs = ((key, _segment_nonce(nonce_prefix, index, last), chunk, segment_associated_data)
+				for index, chunk, last in _iter_chunks(fin, segment_size))
+		for segment in _run_segments(_encrypt_segment, jobs, executor):
+			fout.write(segment)
+
+	@staticmethod
+	def _read_segmented_header(fin: BinaryIO) -> _SegmentedHeader:
+		head = _read_full(fin, struct.calcsize('<Q'))
+		_version, = struct.unpack('<Q', head)
+		if _version not in _SEGMENTED_HEADERS:
+			raise AESGCMEncrypt.VersionException(f'Except one of {tuple(_SEGMENTED_HEADERS)} but {_version} found.')
+		return _SegmentedHeader.unpack(head + _read_full(fin, _SEGMENTED_HEADERS[_version].size - len(head)))
+
+	@staticmethod
+	def _decrypt_segmented(key: Union[bytes, Callable[[Optional[int]], bytes]], fin: BinaryIO, fout: BinaryIO,
+						   associated_data: bytes, executor: Optional[Executor] = None) -> None:
+		'''
+			`key' may be a callable which receives the key id stored in the header (None if absent)
+		'''
+		header = AESGCMEncrypt._read_segmented_header(fin)
+		if callable(key):
+			key = key(header.key_id)
+		if header.flags:
+			fout = _DecompressingWriter(fout, AESGCMEncrypt._get_codec(header.flags).decompressobj())
+		segment_associated_data = header.raw + associated_data
+		jobs = ((key, _segment_nonce(header.nonce_prefix, index, last), chunk, segment_associated_data)
+				for index, chunk, last in _iter_chunks(fin, header.segment_size + _TAG_SIZE))
+		for plaintext in _run_segments(_decrypt_segment, jobs, executor):
+			fout.write(plaintext)
+		if header.flags:
+			fout.close()
+
+	@staticmethod
+	def _decrypted_chunks(key: bytes, fin: BinaryIO, associated_data: bytes,
+						  executor: Optional[Executor] = None) -> Iterator[bytes]:
+		'''
+			Yield plaintext of a VERSION 1, 2 or 3 stream in order, VERSION 1 is only authenticated
+			when the last chunk is taken, so discard whatever was made of the earlier ones on InvalidTag
+		'''
+		head = _read_full(fin, struct.calcsize('<Q'))
+		_version, = struct.unpack('<Q', head)
+		if _version == AESGCMEncrypt.VERSION:
+			iv, tag = struct.unpack('<12s16s', _read_full(fin, struct.calcsize('12s16s')))
+			decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag), backend=default_backend()).decryptor()
+			decryptor.authenticate_additional_data(associated_data)
+			while chunk := fin.read(AESGCMEncrypt.SEGMENT_SIZE):
+				yield decryptor.update(chunk)
+			yield decryptor.finalize()
+			return
+		header = AESGCMEncrypt._read_segmented_header(_PrefixedReader(head, fin))
+		decompressor = AESGCMEncrypt._get_codec(header.flags).decompressobj() if header.flags else None
+		segment_associated_data = header.raw + associated_data
+		jobs = ((key, _segment_nonce(header.nonce_prefix, index, last), chunk, segment_associated_data)
+				for index, chunk, last in _iter_chunks(fin, header.segment_size + _TAG_SIZE))
+		for plaintext in _run_segments(_decrypt_segment, jobs, executor):
+			yield plaintext if decompressor is None else decompressor.decompress(plaintext)
+		flush = getattr(decompressor, 'flush', None)
+		if flush is not None:
+			yield flush()
+
+	@staticmethod
+	def _get_codec(codec_id: int) -> _Codec:
+		try:
+			return _CODECS[codec_id]
+		except KeyError:
+			raise AESGCMEncrypt.VersionException(f'Unknown compression codec id {codec_id}') from None
+
+	@staticmethod
+	def encrypt_stream(key: bytes, reader: BinaryIO, writer: BinaryIO, associated_data: bytes,
+					   segment_size: int = SEGMENT_SIZE, executor: Optional[Executor] = None,
+					   compression: Optional[str] = None) -> None:
+		'''
+			Encrypt `reader' into `writer' using the VERSION 2 layout (VERSION 3 if compressed),
+			`writer' is never seeked so pipes, sockets and stdout are accepted.
+		'''
+		AESGCMEncrypt._encrypt_segmented(key, reader, writer, associated_data, segment_size, executor,
+										 compression=compression)
+
+	@staticmethod
+	def decrypt_stream(key: bytes, reader: BinaryIO, writer: BinaryIO, associated_data: bytes,
+					   executor: Optional[Executor] = None) -> None:
+		AESGCMEncrypt._decrypt_segmented(key, reader, writer, associated_data, executor)
+
+	@staticmethod
+	def encrypt_file_segmented(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes,
+							   segment_size: int = SEGMENT_SIZE, executor: Optional[Executor] = None,
+							   compression: Optional[str] = None) -> None:
+		'''
+			Write a VERSION 2 file (VERSION 3 if compressed), segments are sealed in parallel by
+			`executor' (a thread pool sized to the cpu count by default) and written in order.
+		'''
+		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+			AESGCMEncrypt._encrypt_segmented(key, fin, fout, associated_data, segment_size, executor,
+											 compression=compression)
+
+	@staticmethod
+	def decrypt_file_segmented(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes,
+							   executor: Optional[Executor] = None) -> None:
+		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+			AESGCMEncrypt._decrypt_segmented(key, fin, fout, associated_data, executor)
+
+	def fencrypt(self, input_file_name: str, output_file_name: str, chunk_size: Optional[int] = None, *,
+				 segmented: bool = False, executor: Optional[Executor] = None, compression: Optional[str] = None) -> None:
+		'''
+			`compression' implies `segmented'
+		'''
+		if segmented or compression is not None:
+			self.encrypt_file_segmented(self.key, input_file_name, output_file_name, self.associated_data,
+										executor=executor, compression=compression)
+			return
 		self.encrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size)
 
-	def fdecrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = 1024) -> None:
+	def fdecrypt(self, input_file_name: str, output_file_name: str, chunk_size: Optional[int] = None) -> None:
 		self.decrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size)
 
+	def sencrypt(self, reader: BinaryIO, writer: BinaryIO, segment_size: int = SEGMENT_SIZE,
+				 compression: Optional[str] = None) -> None:
+		self.encrypt_stream(self.key, reader, writer, self.associated_data, segment_size, compression=compression)
+
+	def sdecrypt(self, reader: BinaryIO, writer: BinaryIO) -> None:
+		self.decrypt_stream(self.key, reader, writer, self.associated_data)
+
+	def fopen(self, input_file_name: str, cache_size: int = 8) -> io.BufferedReader:
+		return io.BufferedReader(AESGCMFileReader(self.key, input_file_name, self.associated_data, cache_size))
+
+	def _tree_object_name(self, relative_path: str) -> str:
+		# Stable per path without revealing it
+		return hmac.new(self.key, relative_path.encode(), hashlib.sha256).hexdigest()
+
+	def _load_manifest(self, target_dir: str) -> Dict[str, Dict[str, Any]]:
+		try:
+			with open(os.path.join(target_dir, self.TREE_MANIFEST), 'rb') as fin:
+				manifest = json.loads(self.decrypt_envelope(fin.read()))
+		except FileNotFoundError:
+			return {}
+		if manifest.get('version') != self.TREE_MANIFEST_VERSION:
+			raise self.VersionException(f'Except manifest {self.TREE_MANIFEST_VERSION} but {manifest.get("version")} found.')
+		return manifest['files']
+
+	def _save_manifest(self, target_dir: str, files: Dict[str, Dict[str, Any]]) -> None:
+		manifest_file_name = os.path.join(target_dir, self.TREE_MANIFEST)
+		with open(manifest_file_name + '.tmp', 'wb') as fout:
+			fout.write(self.encrypt_envelope(
+				json.dumps({'version': self.TREE_MANIFEST_VERSION, 'files': files}, separators=(',', ':')).encode()
+			))
+		os.replace(manifest_file_name + '.tmp', manifest_file_name)
+
+	@staticmethod
+	def _hash_file(file_name: str) -> str:
+		digest = hashlib.sha256()
+		with open(file_name, 'rb') as fin:
+			while chunk := fin.read(1 << 20):
+				digest.update(chunk)
+		return digest.hexdigest()
+
+	def encrypt_tree(self, source_dir: str, target_dir: str, workers: Optional[int] = None,
+					 compression: Optional[str] = None) -> TreeSummary:
+		'''
+			Incremental backup of `source_dir' into `target_dir'.
+			Files whose size and mtime match the (encrypted) manifest are skipped without being read,
+			files whose content hash is unchanged only get their mtime updated, the rest are
+			encrypted by `workers' threads. Files removed from `source_dir' are removed from the backup.
+		'''
+		objects_dir = os.path.join(target_dir, self.TREE_OBJECTS)
+		os.makedirs(objects_dir, exist_ok=True)
+		target_real_path = os.path.realpath(target_dir)
+		previous = self._load_manifest(target_dir)
+		files: Dict[str, Dict[str, Any]] = {}
+		changed: List[Tuple[str, str, os.stat_result]] = []
+		for root, dirs, names in os.walk(source_dir):
+			dirs[:] = [name for name in dirs if os.path.realpath(os.path.join(root, name)) != target_real_path]
+			for name in names:
+				file_name = os.path.join(root, name)
+				status = os.stat(file_name, follow_symlinks=False)
+				if not stat.S_ISREG(status.st_mode):
+					continue
+				relative_path = os.path.relpath(file_name, source_dir).replace(os.sep, '/')
+				entry = previous.get(relative_path)
+				if entry is not None and entry['size'] == status.st_size and entry['mtime_ns'] == status.st_mtime_ns:
+					files[relative_path] = entry
+				else:
+					changed.append((relative_path, file_name, status))
+		unchanged = len(files)
+
+		def process(job: Tuple[str, str, os.stat_result]) -> Tuple[str, Dict[str, Any], bool]:
+			relative_path, file_name, status = job
+			entry = previous.get(relative_path)
+			if entry is not None and entry['size'] == status.st_size and self._hash_file(file_name) == entry['sha256']:
+				return relative_path, dict(entry, mtime_ns=status.st_mtime_ns), False
+			object_name = self._tree_object_name(relative_path)
+			object_file_name = os.path.join(objects_dir, object_name)
+			digest = hashlib.sha256()
+			with open(file_name, 'rb') as fin, open(object_file_name + '.tmp', 'wb') as fout:
+				self._encrypt_segmented(self.key, _HashingReader(fin, digest), fout, self.associated_data,
+										self.SEGMENT_SIZE, segment_pool, compression=compression)
+			os.replace(object_file_name + '.tmp', object_file_name)
+			return relative_path, {
+				'size': status.st_size,
+				'mtime_ns': status.st_mtime_ns,
+				'sha256': digest.hexdigest(),
+				'object': object_name,
+			}, True
+
+		encrypted = 0
+		with ThreadPoolExecutor(max_workers=workers) as file_pool, \
+				ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as segment_pool:
+			for relative_path, entry, is_encrypted in file_pool.map(process, changed):
+				files[relative_path] = entry
+				encrypted += is_encrypted
+				unchanged += not is_encrypted
+		removed = 0
+		for relative_path in previous.keys() - files.keys():
+			try:
+				os.unlink(os.path.join(objects_dir, previous[relative_path]['object']))
+			except FileNotFoundError:
+				pass
+			removed += 1
+		self._save_manifest(target_dir, files)
+		return TreeSummary(encrypted, unchanged, removed)
+
+	def restore_tree(self, target_dir: str, restore_dir: str, workers: Optional[int] = None) -> int:
+		'''
+			Restore every file of the backup in `target_dir' into `restore_dir', return the number of files
+		'''
+		objects_dir = os.path.join(target_dir, self.TREE_OBJECTS)
+		restore_real_path = os.path.realpath(restore_dir)
+		files = self._load_manifest(target_dir)
+
+		def process(item: Tuple[str, Dict[str, Any]]) -> None:
+			relative_path, entry = item
+			file_name = os.path.realpath(os.path.join(restore_real_path, *relative_path.split('/')))
+			if os.path.commonpath((file_name, restore_real_path)) != restore_real_path:
+				raise ValueError(f'Manifest entry `{relative_path}\' escapes restore directory')
+			os.makedirs(os.path.dirname(file_name), exist_ok=True)
+			with open(os.path.join(objects_dir, entry['object']), 'rb') as fin, open(file_name, 'wb') as fout:
+				self._decrypt_segmented(self.key, fin, fout, self.associated_data, segment_pool)
+			os.utime(file_name, ns=(entry['mtime_ns'], entry['mtime_ns']))
+
+		with ThreadPoolExecutor(max_workers=workers) as file_pool, \
+				ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as segment_pool:
+			for _ in file_pool.map(process, files.items()):
+				pass
+		return len(files)
+
+
+class AESGCMFileReader(io.RawIOBase):
+	'''
+		Seekable read-only view of the plaintext of an uncompressed VERSION 2 or 3 file.
+		Only the segments covering the requested range are read, authenticated and decrypted,
+		the most recently used `cache_size' segments are kept in memory.
+	'''
+
+	def __init__(self, key: Union[bytes, Callable[[Optional[int]], bytes]], input_file_name: str,
+				 associated_data: bytes, cache_size: int = 8):
+		super().__init__()
+		self._file: BinaryIO = open(input_file_name, 'rb')
+		try:
+			try:
+				header = AESGCMEncrypt._read_segmented_header(self._file)
+			except struct.error:
+				raise InvalidTag()
+			if header.flags:
+				raise AESGCMEncrypt.VersionException('Compressed file does not support random access')
+			self._nonce_prefix: bytes = header.nonce_prefix
+			self._segment_size: int = header.segment_size
+			if callable(key):
+				key = key(header.key_id)
+			body_size = os.fstat(self._file.fileno()).st_size - len(header.raw)
+			stored_size = self._segment_size + _TAG_SIZE
+			self._segments: int = max(1, -(-body_size // stored_size))
+			if body_size - (self._segments - 1) * stored_size < _TAG_SIZE:
+				raise InvalidTag()
+			self._length: int = body_size - self._segments * _TAG_SIZE
+		except:
+			self._file.close()
+			raise
+		self._aead = AESGCM(key)
+		self._header_size: int = len(header.raw)
+		self._associated_data: bytes = header.raw + associated_data
+		self._cache: 'OrderedDict[int, bytes]' = OrderedDict()
+		self._cache_size: int = max(1, cache_size)
+		self._position: int = 0
+
+	def __len__(self) -> int:
+		return self._length
+
+	def readable(self) -> bool:
+		return True
+
+	def seekable(self) -> bool:
+		return True
+
+	def tell(self) -> int:
+		return self._position
+
+	def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+		if whence == io.SEEK_SET:
+			position = offset
+		elif whence == io.SEEK_CUR:
+			position = self._position + offset
+		elif whence == io.SEEK_END:
+			position = self._length + offset
+		else:
+			raise ValueError(f'Invalid whence ({whence})')
+		if position < 0:
+			raise ValueError(f'Negative seek position {position}')
+		self._position = position
+		return position
+
+	def _segment(self, index: int) -> bytes:
+		plaintext = self._cache.get(index)
+		if plaintext is not None:
+			self._cache.move_to_end(index)
+			return plaintext
+		stored_size = self._segment_size + _TAG_SIZE
+		self._file.seek(self._header_size + index * stored_size)
+		plaintext = self._aead.decrypt(
+			_segment_nonce(self._nonce_prefix, index, index == self._segments - 1),
+			_read_full(self._file, stored_size),
+			self._associated_data
+		)
+		self._cache[index] = plaintext
+		if len(self._cache) > self._cache_size:
+			self._cache.popitem(last=False)
+		return plaintext
+
+	def readinto(self, buffer) -> int:
+		view = memoryview(buffer).cast('B')
+		written = 0
+		while written < len(view) and self._position < self._length:
+			index, offset = divmod(self._position, self._segment_size)
+			plaintext = self._segment(index)
+			size = min(len(view) - written, len(plaintext) - offset)
+			view[written:written + size] = plaintext[offset:offset + size]
+			written += size
+			self._position += size
+		return written
+
+	def close(self) -> None:
+		if not self.closed:
+			self._file.close()
+			self._cache.clear()
+		super().close()
+
+
+class KeyRing:
+	'''
+		Passphrases indexed by a numeric key id, the highest id is the current key used for new data.
+		Key material and AEAD primitives are derived once, files (VERSION 3) and envelopes
+		(ENVELOPE_VERSION 2) record the id of the key they were sealed with.
+	'''
+	# Envelope layout: <B version> <I key id> <12s iv> <ciphertext> <16s tag>
+	ENVELOPE_VERSION = 2
+	_ENVELOPE_HEADER = struct.Struct('<BI')
+
+	class KeyNotFound(KeyError):
+		"""When key id is not in key ring raise"""
+
+	_rings: Dict[Tuple[str, Callable], Tuple[int, 'KeyRing']] = {}
+
+	def __init__(self, keys: Mapping[int, str], associated_data: str, *, hash_func=hashlib.sha256):
+		if not keys:
+			raise ValueError('Key ring requires at least one key')
+		if not all(0 <= key_id < _NO_KEY_ID for key_id in keys):
+			raise ValueError(f'Key id should between 0 and {_NO_KEY_ID - 1}')
+		self._keys: Dict[int, bytes] = {key_id: _derive_key(hash_func, passphrase) for key_id, passphrase in keys.items()}
+		self._aeads: Dict[int, AESGCM] = {key_id: AESGCM(key) for key_id, key in self._keys.items()}
+		self.associated_data: bytes = associated_data.encode()
+		self.current_id: int = max(self._keys)
+
+	@classmethod
+	def from_config(cls, config_file: str = 'config.ini', *, hash_func=hashlib.sha256) -> 'KeyRing':
+		'''
+			Read `[keyring]' section (`<key id> = <passphrase>' and `associated_data'),
+			`key' of `[encrypt]' section is registered as key id 0.
+			Key ring is cached until configure file is modified.
+		'''
+		config = _load_config(config_file)
+		if config is None or not (config.has_section('keyring') or config.has_section('encrypt')):
+			raise IOError(f'`{config_file}\' is not a compliant profile.')
+		mtime = os.stat(config_file).st_mtime_ns
+		cached = cls._rings.get((config_file, hash_func))
+		if cached is not None and cached[0] == mtime:
+			return cached[1]
+		keys: Dict[int, str] = {}
+		associated_data = None
+		if config.has_section('encrypt'):
+			keys[0] = config['encrypt']['key']
+			associated_data = config['encrypt'].get('associated_data')
+		if config.has_section('keyring'):
+			for option, value in config['keyring'].items():
+				if option.isdigit():
+					keys[int(option)] = value
+			associated_data = config['keyring'].get('associated_data', associated_data)
+		if associated_data is None:
+			raise IOError(f'`{config_file}\' is not a compliant profile.')
+		self = cls(keys, associated_data, hash_func=hash_func)
+		cls._rings[(config_file, hash_func)] = (mtime, self)
+		return self
+
+	def key(self, key_id: Optional[int] = None) -> bytes:
+		'''
+			return key material of `key_id', current key if None
+		'''
+		try:
+			return self._keys[self.current_id if key_id is None else key_id]
+		except KeyError:
+			raise self.KeyNotFound(key_id) from None
+
+	def aead(self, key_id: Optional[int] = None) -> AESGCM:
+		try:
+			return self._aeads[self.current_id if key_id is None else key_id]
+		except KeyError:
+			raise self.KeyNotFound(key_id) from None
+
+	def _candidates(self) -> Iterator[Tuple[int, AESGCM]]:
+		# Data sealed before key ids were recorded, newest key first
+		for key_id in sorted(self._aeads, reverse=True):
+			yield key_id, self._aeads[key_id]
+
+	def encrypt_envelope(self, binary_str: ByteString) -> bytes:
+		iv = os.urandom(12)
+		return b''.join((
+			self._ENVELOPE_HEADER.pack(self.ENVELOPE_VERSION, self.current_id),
+			iv,
+			self.aead().encrypt(iv, binary_str, self.associated_data)
+		))
+
+	def envelope_key_id(self, envelope: ByteString) -> Optional[int]:
+		'''
+			return key id recorded in envelope, None for envelope without key id
+		'''
+		view = memoryview(envelope)
+		if len(view) and view[0] == self.ENVELOPE_VERSION:
+			return self._ENVELOPE_HEADER.unpack_from(view)[1]
+		return None
+
+	def decrypt_envelope(self, envelope: ByteString) -> bytes:
+		'''
+			Accept envelopes of this class and of AESGCMEncryptClassic
+		'''
+		view = memoryview(envelope)
+		if len(view) < 29 or view[0] not in (AESGCMEncryptClassic.ENVELOPE_VERSION, self.ENVELOPE_VERSION):
+			raise AESGCMEncryptClassic.EnvelopeException('Malformed envelope or unsupported version')
+		if view[0] == self.ENVELOPE_VERSION:
+			_version, key_id = self._ENVELOPE_HEADER.unpack_from(view)
+			offset = self._ENVELOPE_HEADER.size
+			return self.aead(key_id).decrypt(view[offset:offset + 12], view[offset + 12:], self.associated_data)
+		for _key_id, aead in self._candidates():
+			try:
+				return aead.decrypt(view[1:13], view[13:], self.associated_data)
+			except InvalidTag:
+				pass
+		raise InvalidTag()
+
+	def b64encrypt_envelope(self, binary_str: ByteString) -> bytes:
+		return b64encode(self.encrypt_envelope(binary_str))
+
+	def b64decrypt_envelope(self, base64_encoded_str: ByteString) -> bytes:
+		return self.decrypt_envelope(b64decode(base64_encoded_str))
+
+	def reencrypt_envelope(self, envelope: ByteString) -> ByteString:
+		'''
+			return envelope sealed by current key, unchanged if it already is
+		'''
+		if self.envelope_key_id(envelope) == self.current_id:
+			return envelope
+		return self.encrypt_envelope(self.decrypt_envelope(envelope))
+
+	def encrypt_stream(self, reader: BinaryIO, writer: BinaryIO, segment_size: int = AESGCMEncrypt.SEGMENT_SIZE,
+					   executor: Optional[Executor] = None, compression: Optional[str] = None) -> None:
+		AESGCMEncrypt._encrypt_segmented(self.key(), reader, writer, self.associated_data, segment_size, executor,
+										 self.current_id, compression)
+
+	def decrypt_stream(self, reader: BinaryIO, writer: BinaryIO, executor: Optional[Executor] = None) -> None:
+		'''
+			Streams without key id (VERSION 2) are decrypted with current key
+		'''
+		AESGCMEncrypt._decrypt_segmented(self.key, reader, writer, self.associated_data, executor)
+
+	def encrypt_file(self, input_file_name: str, output_file_name: str, segment_size: int = AESGCMEncrypt.SEGMENT_SIZE,
+					 executor: Optional[Executor] = None, compression: Optional[str] = None) -> None:
+		with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+			self.encrypt_stream(fin, fout, segment_size, executor, compression)
+
+	@staticmethod
+	def _file_header(input_file_name: str) -> Optional[_SegmentedHeader]:
+		with open(input_file_name, 'rb') as fin:
+			try:
+				return AESGCMEncrypt._read_segmented_header(fin)
+			except AESGCMEncrypt.VersionException:
+				return None
+
+	def file_key_id(self, input_file_name: str) -> Optional[int]:
+		'''
+			return key id recorded in file header, None for files without key id
+		'''
+		header = self._file_header(input_file_name)
+		return None if header is None else header.key_id
+
+	def decrypt_file(self, input_file_name: str, output_file_name: str, executor: Optional[Executor] = None) -> None:
+		'''
+			Files without key id are tried against every key, newest first
+		'''
+		if self.file_key_id(input_file_name) is not None:
+			with open(input_file_name, 'rb') as fin, open(output_file_name, 'wb') as fout:
+				AESGCMEncrypt._decrypt_segmented(self.key, fin, fout, self.associated_data, executor)
+			return
+		for key_id, _aead in self._candidates():
+			try:
+				AESGCMEncrypt.decrypt_file(self._keys[key_id], input_file_name, output_file_name, self.associated_data)
+				return
+			except InvalidTag:
+				pass
+		raise InvalidTag()
+
+	def fopen(self, input_file_name: str, cache_size: int = 8) -> io.BufferedReader:
+		return io.BufferedReader(AESGCMFileReader(self.key, input_file_name, self.associated_data, cache_size))
+
+	def reencrypt_file(self, input_file_name: str, segment_size: int = AESGCMEncrypt.SEGMENT_SIZE) -> bool:
+		'''
+			Migrate `input_file_name' to current key in place, return False if it is already sealed by it.
+			Plaintext is streamed from the old file into the new one and never written to disk,
+			files without key id are tried against every key, newest first.
+		'''
+		header = self._file_header(input_file_name)
+		key_id = None if header is None else header.key_id
+		if key_id == self.current_id:
+			return False
+		# Keep the codec of compressed files
+		compression = AESGCMEncrypt._get_codec(header.flags).name if header is not None and header.flags else None
+		directory = os.path.dirname(os.path.abspath(input_file_name))
+		if key_id is not None:
+			keys = [self.key(key_id)]
+		else:
+			keys = [self._keys[candidate] for candidate, _aead in self._candidates()]
+		fd, output_file_name = tempfile.mkstemp(prefix='.reencrypt', dir=directory)
+		try:
+			with open(fd, 'wb') as fout:
+				for index, key in enumerate(keys):
+					try:
+						with open(input_file_name, 'rb') as fin:
+							reader = _ChunkReader(AESGCMEncrypt._decrypted_chunks(key, fin, self.associated_data))
+							self.encrypt_stream(reader, fout, segment_size, compression=compression)
+						break
+					except InvalidTag:
+						if index == len(keys) - 1:
+							raise
+						fout.seek(0)
+						fout.truncate()
+			os.replace(output_file_name, input_file_name)
+		except:
+			os.unlink(output_file_name)
+			raise
+		return True
+
+	def migrate(self, input_file_names: Iterable[str], executor: Optional[Executor] = None) -> 'Future[int]':
+		'''
+			Re-encrypt files to current key in background (a single worker thread if `executor' is None),
+			the returned future resolves to the number of migrated files.
+		'''
+		def job() -> int:
+			return sum(self.reencrypt_file(input_file_name) for input_file_name in input_file_names)
+		if executor is not None:
+			return executor.submit(job)
+		pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='KeyRingMigration')
+		future = pool.submit(job)
+		pool.shutdown(wait=False)
+		return future
+
 
 def test_random_file(mute: bool = False) -> None:
 	import random
-	interrupted = False
-	with tempfile.TemporaryDirectory(prefix='tmp', dir='.') as tmpd:
+	cwd = os.getcwd()
+	# Outside the working tree, so an interrupted run leaves nothing behind there
+	with tempfile.TemporaryDirectory() as tmpd:
 		os.chdir(tmpd)
 		try:
 			with open('origin.txt', 'wb') as fout:
 				for _ in range(100000):
 					fout.write(chr(ord('A') + random.randint(0, 23)).encode())
 			test_specify_file('origin.txt', mute)
-		except InterruptedError:
-			interrupted = True
-		os.chdir('..')
-	if interrupted:
-		raise InterruptedError
+		finally:
+			os.chdir(cwd)
 
 
 def test_specify_file(file_name: str, mute: bool = False) -> None:
@@ -203,6 +1241,40 @@ def test_specify_file(file_name: str, mute: bool = False) -> None:
 		AESGCMEncrypt.decrypt_file(key_hash, file_name + '.enc', 'decrypted.txt', b'data')
 		if mute is not True and filecmp.cmp(file_name, 'decrypted.txt'):
 			print('File test successfully')
+		AESGCMEncrypt.encrypt_file_segmented(key_hash, file_name, file_name + '.enc2', b'data', segment_size=4096)
+		AESGCMEncrypt.decrypt_file(key_hash, file_name + '.enc2', 'decrypted2.txt', b'data')
+		if mute is not True and filecmp.cmp(file_name, 'decrypted2.txt'):
+			print('Segmented file test successfully')
+		with open(file_name, 'rb') as fin, io.BytesIO() as encrypted, io.BytesIO() as decrypted:
+			AESGCMEncrypt.encrypt_stream(key_hash, fin, encrypted, b'data')
+			encrypted.seek(0)
+			AESGCMEncrypt.decrypt_stream(key_hash, encrypted, decrypted, b'data')
+			fin.seek(0)
+			if mute is not True and decrypted.getvalue() == fin.read():
+				print('Stream test successfully')
+		with AESGCMFileReader(key_hash, file_name + '.enc2', b'data') as reader, open(file_name, 'rb') as fin:
+			fin.seek(5000)
+			reader.seek(5000)
+			if mute is not True and reader.read(10000) == fin.read(10000):
+				print('Random access test successfully')
+		AESGCMEncrypt.encrypt_file_segmented(key_hash, file_name, file_name + '.encz', b'data', compression='zlib')
+		AESGCMEncrypt.decrypt_file(key_hash, file_name + '.encz', 'decryptedz.txt', b'data')
+		if mute is not True and filecmp.cmp(file_name, 'decryptedz.txt'):
+			print('Compressed file test successfully')
+		key_ring = KeyRing({1: 'old', 2: 'test'}, 'data')
+		KeyRing({1: 'old'}, 'data').encrypt_file(file_name, file_name + '.enc3')
+		key_ring.reencrypt_file(file_name + '.enc3')
+		key_ring.decrypt_file(file_name + '.enc3', 'decrypted3.txt')
+		if mute is not True and key_ring.file_key_id(file_name + '.enc3') == 2 and filecmp.cmp(file_name, 'decrypted3.txt'):
+			print('Key ring test successfully')
+		# VERSION 1 under an older key and a compressed file, both re-encrypted without a plaintext file
+		AESGCMEncrypt.encrypt_file(KeyRing({1: 'old'}, 'data').key(), file_name, file_name + '.enc4', b'data')
+		KeyRing({1: 'old'}, 'data').encrypt_file(file_name, file_name + '.enc5', compression='zlib')
+		for suffix in ('.enc4', '.enc5'):
+			key_ring.reencrypt_file(file_name + suffix)
+			key_ring.decrypt_file(file_name + suffix, 'decrypted' + suffix)
+			if mute is not True and key_ring.file_key_id(file_name + suffix) == 2 and filecmp.cmp(file_name, 'decrypted' + suffix):
+				print(f'Key ring re-encrypt {suffix} test successfully')
 	except (TypeError, ValueError):
 		traceback.print_exc()
 
@@ -210,4 +1282,5 @@ def test_specify_file(file_name: str, mute: bool = False) -> None:
 if __name__ == '__main__':
 	s = AESGCMEncryptClassic('1234', 'associated data')
 	print(s.b64decrypts(s.b64encrypts('This is test string').encode()))
+	print(s.b64decrypts(s.b64encrypt_envelope(b'This is test envelope')))
 	test_random_file()
@@ -21,27 +21,182 @@
 # origin from https://goo.gl/8PToR6
 import asyncio
 import hashlib
+import inspect
 import os
 import struct
 import tempfile
+from concurrent.futures import Executor
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional, Sequence, Tuple, TypeVar, Union
 
 import aiofiles
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
-from Encrypt import AESGCMEncryptClassic
+from Encrypt import (AESGCMEncryptClassic, _CODECS, _COMPRESS_CHUNK_SIZE, _COMPRESS_SAMPLE_SIZE, _KEYED_HEADER,
+                     _NO_KEY_ID, _SEGMENTED_HEADER, _SEGMENTED_HEADERS, _SegmentedHeader, _TAG_SIZE, _codec_id,
+                     _compressible, _segment_nonce)
+
+_T = TypeVar('_T')
+
+
+async def _read_full(reader: Any, size: int) -> bytes:
+    # Accept asyncio.StreamReader, aiofiles handles or anything with `async read(n)'
+    parts = []
+    remain = size
+    while remain:
+        chunk = await reader.read(remain)
+        if not chunk:
+            break
+        parts.append(chunk)
+        remain -= len(chunk)
+    return b''.join(parts)
+
+
+async def _write(writer: Any, data: bytes) -> None:
+    # asyncio.StreamWriter.write is sync and should be drained, aiofiles write is a coroutine
+    result = writer.write(data)
+    if inspect.isawaitable(result):
+        await result
+    drain = getattr(writer, 'drain', None)
+    if drain is not None:
+        await drain()
+
+
+async def _iter_chunks(reader: Any, size: int) -> AsyncIterator[Tuple[int, bytes, bool]]:
+    index = 0
+    chunk = await _read_full(reader, size)
+    while True:
+        following = await _read_full(reader, size) if len(chunk) == size else b''
+        yield index, chunk, not following
+        if not following:
+            return
+        chunk = following
+        index += 1
+
+
+class _AsyncPrefixedReader:
+    def __init__(self, prefix: bytes, reader: Any):
+        self._prefix: bytes = prefix
+        self._reader = reader
+
+    async def read(self, size: int) -> bytes:
+        if not self._prefix:
+            return await self._reader.read(size)
+        data, self._prefix = self._prefix[:size], self._prefix[size:]
+        return data
+
+
+class _AsyncCompressingReader:
+    # Compression is CPU bound, run it in `executor' like the cipher
+    def __init__(self, reader: Any, compressor: Any, executor: Optional[Executor] = None):
+        self._reader = reader
+        self._compressor = compressor
+        self._executor: Optional[Executor] = executor
+        self._buffer = bytearray()
+        self._eof: bool = False
+
+    async def read(self, size: int) -> bytes:
+        loop = asyncio.get_running_loop()
+        while len(self._buffer) < size and not self._eof:
+            chunk = await self._reader.read(_COMPRESS_CHUNK_SIZE)
+            if chunk:
+                self._buffer += await loop.run_in_executor(self._executor, self._compressor.compress, chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+class _AsyncDecompressingWriter:
+    def __init__(self, writer: Any, decompressor: Any, executor: Optional[Executor] = None):
+        self._writer = writer
+        self._decompressor = decompressor
+        self._executor: Optional[Executor] = executor
+
+    async def write(self, data: bytes) -> None:
+        loop = asyncio.get_running_loop()
+        await _write(self._writer, await loop.run_in_executor(self._executor, self._decompressor.decompress, data))
+
+    async def close(self) -> None:
+        flush = getattr(self._decompressor, 'flush', None)
+        if flush is not None:
+            await _write(self._writer, flush())
+
+
+async def _iter_reads(reader: Any, size: int) -> AsyncIterator[bytes]:
+    while chunk := await reader.read(size):
+        yield chunk
+
+
+async def _gather_or_cancel(*coroutines: Awaitable[Any]) -> None:
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def _pipeline(source: AsyncIterator[_T], transform: Callable[[_T], bytes], writer: Any,
+                    executor: Optional[Executor] = None, depth: int = 4, parallel: bool = False) -> None:
+    """
+        Read, crypto and write stages connected by queues holding at most `depth' chunks.
+        `transform' runs in `executor' (the loop default executor if None), chunks are
+        transformed one after another unless `parallel' is set, output order is always kept.
+    """
+    loop = asyncio.get_running_loop()
+    plain: 'asyncio.Queue[Optional[_T]]' = asyncio.Queue(depth)
+    crypted: 'asyncio.Queue[Optional[asyncio.Future]]' = asyncio.Queue(depth)
+
+    async def read() -> None:
+        async for item in source:
+            await plain.put(item)
+        await plain.put(None)
+
+    async def crypt() -> None:
+        while (item := await plain.get()) is not None:
+            future = loop.run_in_executor(executor, transform, item)
+            if not parallel:
+                # Stateful contexts (GCM stream) must see chunks in order
+                await future
+            await crypted.put(future)
+        await crypted.put(None)
+
+    async def write() -> None:
+        while (future := await crypted.get()) is not None:
+            await _write(writer, await future)
+
+    await _gather_or_cancel(read(), crypt(), write())
+
+
+async def _run_bounded(job: Callable[..., Awaitable[None]], items: Iterable[Sequence[Any]], concurrency: int) -> None:
+    iterator = iter(items)
+
+    async def worker() -> None:
+        for item in iterator:
+            await job(*item)
+
+    await _gather_or_cancel(*(worker() for _ in range(max(1, concurrency))))
 
 
 class AESGCMEncrypt(AESGCMEncryptClassic):
     VERSION = 1
-    CHUNK_SIZE = 1024 * 8
+    SEGMENTED_VERSION = 2
+    KEYED_VERSION = 3
+    CHUNK_SIZE = 1024 * 1024
+    SEGMENT_SIZE = 64 * 1024
 
     class VersionException(Exception):
         """When version mismatch raise"""
 
     @staticmethod
     async def encrypt_file(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes,
-                           chunk_size: int = CHUNK_SIZE) -> None:
+                           chunk_size: int = CHUNK_SIZE, executor: Optional[Executor] = None) -> None:
         # Generate a random 96-bit IV.
         iv = os.urandom(12)
 
@@ -59,19 +214,23 @@ class AESGCMEncrypt(AESGCMEncryptClassic):
 
         async with aiofiles.open(input_file_name, 'rb') as fin, aiofiles.open(output_file_name, 'wb') as fout:
             await fout.write(struct.pack('<Q12s16s', AESGCMEncrypt.VERSION, iv, b''))
-            while chunk := await fin.read(chunk_size):
-                await fout.write(encryptor.update(chunk))
+            await _pipeline(_iter_reads(fin, chunk_size), encryptor.update, fout, executor)
             await fout.write(encryptor.finalize())
             await fout.seek(struct.calcsize('Q12s'))
             await fout.write(struct.pack('16s', encryptor.tag))  # type: ignore
 
     @staticmethod
     async def decrypt_file(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes,
-                           chunk_size: int = CHUNK_SIZE) -> None:
+                           chunk_size: int = CHUNK_SIZE, executor: Optional[Executor] = None) -> None:
         async with aiofiles.open(input_file_name, 'rb') as fin, aiofiles.open(output_file_name, 'wb') as fout:
-            _version, iv, tag = struct.unpack('<Q12s16s', await fin.read(struct.calcsize('Q12s16s')))
+            _version, = struct.unpack('<Q', await fin.read(struct.calcsize('<Q')))
+            if _version in _SEGMENTED_HEADERS:
+                await fin.seek(0)
+                await AESGCMEncrypt.decrypt_stream(key, fin, fout, associated_data, executor)
+                return
             if _version != AESGCMEncrypt.VERSION:
                 raise AESGCMEncrypt.VersionException(f'Except {AESGCMEncrypt.VERSION} but {_version} found.')
+            iv, tag = struct.unpack('<12s16s', await fin.read(struct.calcsize('12s16s')))
             decryptor = Cipher(
                 algorithms.AES(key),  # type: ignore
                 modes.GCM(iv, tag),  # type: ignore
@@ -79,31 +238,130 @@ class AESGCMEncrypt(AESGCMEncryptClassic):
             ).decryptor()
             decryptor.authenticate_additional_data(associated_data)  # type: ignore
             # reader = lib_aes_gcm.chunk_reader(fin, file_size)
-            while chunk := await fin.read(chunk_size):
-                await fout.write(decryptor.update(chunk))
+            await _pipeline(_iter_reads(fin, chunk_size), decryptor.update, fout, executor)
             await fout.write(decryptor.finalize())
 
-    async def fencrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = CHUNK_SIZE) -> None:
-        await self.encrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size)
+    @staticmethod
+    async def encrypt_files(key: bytes, file_pairs: Iterable[Tuple[str, str]], associated_data: bytes,
+                            concurrency: int = 4, chunk_size: int = CHUNK_SIZE,
+                            executor: Optional[Executor] = None) -> None:
+        """
+            file_pairs: iterable of (input_file_name, output_file_name),
+            at most `concurrency' files are processed at the same time.
+        """
+        await _run_bounded(
+            lambda input_file_name, output_file_name: AESGCMEncrypt.encrypt_file(
+                key, input_file_name, output_file_name, associated_data, chunk_size, executor),
+            file_pairs, concurrency
+        )
+
+    @staticmethod
+    async def decrypt_files(key: bytes, file_pairs: Iterable[Tuple[str, str]], associated_data: bytes,
+                            concurrency: int = 4, chunk_size: int = CHUNK_SIZE,
+                            executor: Optional[Executor] = None) -> None:
+        await _run_bounded(
+            lambda input_file_name, output_file_name: AESGCMEncrypt.decrypt_file(
+                key, input_file_name, output_file_name, associated_data, chunk_size, executor),
+            file_pairs, concurrency
+        )
+
+    @staticmethod
+    async def encrypt_stream(key: bytes, reader: Any, writer: Any, associated_data: bytes,
+                             segment_size: int = SEGMENT_SIZE, executor: Optional[Executor] = None,
+                             compression: Optional[str] = None) -> None:
+        """
+            Encrypt `reader' into `writer' using the VERSION 2 layout of Encrypt.AESGCMEncrypt
+            (VERSION 3 if compressed), `writer' is never seeked so sockets and pipes are accepted.
+        """
+        if not 0 < segment_size < 1 << 32:
+            raise ValueError(f'Segment size should between 1 and {(1 << 32) - 1}, but {segment_size} found.')
+        codec_id = 0
+        if compression is not None:
+            codec_id = _codec_id(compression)
+            sample = await _read_full(reader, _COMPRESS_SAMPLE_SIZE)
+            reader = _AsyncPrefixedReader(sample, reader)
+            if _compressible(sample):
+                reader = _AsyncCompressingReader(reader, _CODECS[codec_id].compressobj(), executor)
+            else:
+                codec_id = 0
+        aead = AESGCM(key)
+        nonce_prefix = os.urandom(7)
+        if codec_id == 0:
+            header = _SEGMENTED_HEADER.pack(AESGCMEncrypt.SEGMENTED_VERSION, nonce_prefix, segment_size)
+        else:
+            header = _KEYED_HEADER.pack(AESGCMEncrypt.KEYED_VERSION, nonce_prefix, segment_size, _NO_KEY_ID, codec_id)
+        segment_associated_data = header + associated_data
+        await _write(writer, header)
+        await _pipeline(
+            _iter_chunks(reader, segment_size),
+            lambda item: aead.encrypt(_segment_nonce(nonce_prefix, item[0], item[2]), item[1],
+                                      segment_associated_data),
+            writer, executor, parallel=True
+        )
+
+    @staticmethod
+    async def decrypt_stream(key: Union[bytes, Callable[[Optional[int]], bytes]], reader: Any, writer: Any,
+                             associated_data: bytes, executor: Optional[Executor] = None) -> None:
+        """
+            Accept VERSION 2 and 3 streams, `key' may be a callable which receives
+            the key id stored in the header (e.g. Encrypt.KeyRing.key)
+        """
+        head = await _read_full(reader, struct.calcsize('<Q'))
+        _version, = struct.unpack('<Q', head)
+        if _version not in _SEGMENTED_HEADERS:
+            raise AESGCMEncrypt.VersionException(f'Except one of {tuple(_SEGMENTED_HEADERS)} but {_version} found.')
+        header = _SegmentedHeader.unpack(head + await _read_full(reader, _SEGMENTED_HEADERS[_version].size - len(head)))
+        aead = AESGCM(key(header.key_id) if callable(key) else key)
+        if header.flags:
+            if header.flags not in _CODECS:
+                raise AESGCMEncrypt.VersionException(f'Unknown compression codec id {header.flags}')
+            writer = _AsyncDecompressingWriter(writer, _CODECS[header.flags].decompressobj(), executor)
+        segment_associated_data = header.raw + associated_data
+        await _pipeline(
+            _iter_chunks(reader, header.segment_size + _TAG_SIZE),
+            lambda item: aead.decrypt(_segment_nonce(header.nonce_prefix, item[0], item[2]), item[1],
+                                      segment_associated_data),
+            writer, executor, parallel=True
+        )
+        if header.flags:
+            await writer.close()
+
+    @staticmethod
+    async def encrypt_file_segmented(key: bytes, input_file_name: str, output_file_name: str, associated_data: bytes,
+                                     segment_size: int = SEGMENT_SIZE, executor: Optional[Executor] = None,
+                                     compression: Optional[str] = None) -> None:
+        async with aiofiles.open(input_file_name, 'rb') as fin, aiofiles.open(output_file_name, 'wb') as fout:
+            await AESGCMEncrypt.encrypt_stream(key, fin, fout, associated_data, segment_size, executor, compression)
+
+    async def sencrypt(self, reader: Any, writer: Any, segment_size: int = SEGMENT_SIZE,
+                       compression: Optional[str] = None) -> None:
+        await self.encrypt_stream(self.key, reader, writer, self.associated_data, segment_size,
+                                  compression=compression)
+
+    async def sdecrypt(self, reader: Any, writer: Any) -> None:
+        await self.decrypt_stream(self.key, reader, writer, self.associated_data)
+
+    async def fencrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = CHUNK_SIZE,
+                       executor: Optional[Executor] = None) -> None:
+        await self.encrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size, executor)
 
-    async def fdecrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = CHUNK_SIZE) -> None:
-        await self.decrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size)
+    async def fdecrypt(self, input_file_name: str, output_file_name: str, chunk_size: int = CHUNK_SIZE,
+                       executor: Optional[Executor] = None) -> None:
+        await self.decrypt_file(self.key, input_file_name, output_file_name, self.associated_data, chunk_size, executor)
 
 
 async def test_random_file(mute: bool = False) -> None:
-    interrupted = False
-    with tempfile.TemporaryDirectory(prefix='tmp', dir='.') as tmpd:
+    cwd = os.getcwd()
+    # Outside the working tree, so an interrupted run leaves nothing behind there
+    with tempfile.TemporaryDirectory() as tmpd:
         os.chdir(tmpd)
         try:
             async with aiofiles.open('origin.txt', 'wb') as fout:
                 for _ in range(10000):
                     await fout.write(''.join(chr(ord('A') + random.randint(0, 23)) for _x in range(100)).encode())
             await test_specify_file('origin.txt', mute)
-        except InterruptedError:
-            interrupted = True
-        os.chdir('..')
-    if interrupted:
-        raise InterruptedError
+        finally:
+            os.chdir(cwd)
 
 
 async def test_specify_file(file_name: str, mute: bool = False) -> None:
@@ -114,6 +372,12 @@ async def test_specify_file(file_name: str, mute: bool = False) -> None:
         await AESGCMEncrypt.decrypt_file(key_hash, file_name + '.enc', 'decrypted.txt', b'data')
         if mute is not True and filecmp.cmp(file_name, 'decrypted.txt'):
             print('File test successfully')
+        async with aiofiles.open(file_name, 'rb') as fin, aiofiles.open(file_name + '.enc2', 'wb') as fout:
+            await AESGCMEncrypt.encrypt_stream(key_hash, fin, fout, b'data')
+        async with aiofiles.open(file_name + '.enc2', 'rb') as fin, aiofiles.open('decrypted2.txt', 'wb') as fout:
+            await AESGCMEncrypt.decrypt_stream(key_hash, fin, fout, b'data')
+        if mute is not True and filecmp.cmp(file_name, 'decrypted2.txt'):
+            print('Stream test successfully')
     except (TypeError, ValueError):
         traceback.print_exc()
 
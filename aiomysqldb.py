@@ -18,15 +18,85 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 import asyncio
+import contextvars
 import logging
+import tempfile
+import time
 from configparser import ConfigParser
-from typing import Dict, Optional, Sequence, TypeVar, Tuple, Union, ByteString
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Sequence, Set, TypeVar, Tuple, Union, ByteString
 
 import aiomysql
 
+from instrumentation import Instrumentation, QueryEvent
+from keepalive import KeepaliveScheduler, ScheduledTask
+from querycache import QueryCache, write_tables
+from mysqldb import (OnDuplicate, _BulkInsert, _finish_fifo_writer, _format_fetched, _load_data_statement,
+					 _start_fifo_writer)
+from retrypolicy import Action, CircuitBreaker, RetryPolicy
+from rowformat import Columnar, check_row_format
+from statements import StatementCache
+from writebehind import Batch, WriteBehindBuffer
+
 _cT = TypeVar('_cT', str, int, None, ByteString)
+_rT = TypeVar('_rT')
+
+@asynccontextmanager
+async def _load_data_fifo(rows: Iterable[Sequence[Any]], columns: int) -> AsyncIterator[str]:
+	"""
+		mysqldb._load_data_fifo which waits for the writer thread in an executor, off the event loop
+	"""
+	loop = asyncio.get_running_loop()
+	with tempfile.TemporaryDirectory(prefix='bulk') as directory:
+		file_name, writer, errors = _start_fifo_writer(directory, rows, columns)
+		try:
+			yield file_name
+		except BaseException:
+			await loop.run_in_executor(None, _finish_fifo_writer, file_name, writer, errors, True)
+			raise
+		await loop.run_in_executor(None, _finish_fifo_writer, file_name, writer, errors, False)
+
+
+class _Session:
+	__slots__ = ('connection', 'transaction', 'written', 'lock', 'holder')
+
+	def __init__(self, connection: aiomysql.Connection):
+		self.connection: aiomysql.Connection = connection
+		self.transaction: bool = False
+		# Tables written by the open transaction, invalidated again on commit
+		self.written: Set[str] = set()
+		# Tasks sharing the session take turns on its connection
+		self.lock: asyncio.Lock = asyncio.Lock()
+		self.holder: Optional['asyncio.Task[Any]'] = None
+
+	@asynccontextmanager
+	async def use(self) -> AsyncIterator[aiomysql.Connection]:
+		task = asyncio.current_task()
+		if self.holder is task:
+			# Waiting for the lock would never return
+			raise RuntimeError('Session connection is busy with an unfinished statement of this task (e.g. query_iter)')
+		async with self.lock:
+			self.holder = task
+			try:
+				yield self.connection
+			except Exception:
+				raise
+			except BaseException:
+				# Cancelled or closed early in the middle of a statement, protocol state is unknown
+				self.connection.close()
+				raise
+			finally:
+				self.holder = None
 
 class MySqlDB:
+	"""
+		Backed by an aiomysql pool of `minsize' to `maxsize' autocommit connections.
+		Calls inside session() / transaction() of a task use the connection pinned by it,
+		other calls take a connection from the pool for each statement.
+	"""
+
+	class PoolTimeout(TimeoutError):
+		"""When no connection become available in `acquire_timeout' seconds raise"""
 
 	_self: Optional['MySqlDB'] = None
 
@@ -38,6 +108,17 @@ class MySqlDB:
 		db: str,
 		charset: str='utf8mb4',
 		cursorclass: aiomysql.Cursor=aiomysql.DictCursor,
+		*,
+		minsize: int=1,
+		maxsize: int=10,
+		acquire_timeout: float=30.0,
+		pool_recycle: float=-1,
+		local_infile: bool=False,
+		cache: Optional[QueryCache]=None,
+		retry_policy: Optional[RetryPolicy]=None,
+		breaker: Optional[CircuitBreaker]=None,
+		instrumentation: Optional[Instrumentation]=None,
+		statement_cache: Optional[StatementCache]=None,
 	):
 		self.logger: logging.Logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.DEBUG)
@@ -47,42 +128,398 @@ class MySqlDB:
 		self.db: str = db
 		self.charset: str = charset
 		self.cursorclass: aiomysql.Cursor = cursorclass
-		#self.execute_lock: asyncio.Lock = asyncio.Lock()
-		#self.last_execute_time: float = 0.0
-		#self.exit_request: bool = False
-		self.mysql_connection: aiomysql.Connection = None
+		self.local_infile: bool = local_infile
+		self.minsize: int = minsize
+		self.maxsize: int = maxsize
+		self.acquire_timeout: float = acquire_timeout
+		self.pool_recycle: float = pool_recycle
+		self._max_allowed_packet: Optional[int] = None
+		self.cache: Optional[QueryCache] = cache
+		self.retry_policy: RetryPolicy = retry_policy or RetryPolicy()
+		# Shared with mysqldb.MySqlDB handles of the same server
+		self.breaker: CircuitBreaker = breaker or CircuitBreaker.shared(('mysql', host))
+		self.instrumentation: Optional[Instrumentation] = instrumentation
+		self.statement_cache: Optional[StatementCache] = statement_cache
+		self.last_execute_time: float = time.monotonic()
+		self.pool: Optional[aiomysql.Pool] = None
+		self._session: contextvars.ContextVar[Optional[_Session]] = contextvars.ContextVar(f'mysql_session_{id(self)}', default=None)
+		self._keepalive: Optional[ScheduledTask] = None
+		self._idle_ping: float = 300.0
+		self._idle_max: float = 1800.0
 
 	async def init_connection(self) -> None:
-		self.mysql_connection = await aiomysql.connect(
+		if self.pool is not None and not self.pool.closed:
+			return
+		self.pool = await aiomysql.create_pool(
+			minsize=self.minsize,
+			maxsize=self.maxsize,
+			pool_recycle=self.pool_recycle,
 			host=self.host,
 			user=self.user,
 			password=self.password,
 			db=self.db,
 			charset=self.charset,
 			cursorclass=self.cursorclass,
+			local_infile=self.local_infile,
+			autocommit=True,
 		)
 
-	async def query(self, sql: str, args: Union[Sequence[_cT], _cT]=()) -> Tuple[Dict[str, _cT]]:
-		async with self.mysql_connection.cursor() as cur:
-			await cur.execute(sql, args)
-			return await cur.fetchall()
+	@asynccontextmanager
+	async def _acquire(self) -> AsyncIterator[aiomysql.Connection]:
+		session = self._session.get()
+		if session is not None:
+			async with session.use() as connection:
+				yield connection
+			return
+		async with self._pool_connection() as connection:
+			yield connection
+
+	@asynccontextmanager
+	async def _pool_connection(self) -> AsyncIterator[aiomysql.Connection]:
+		if self.pool is None:
+			await self.init_connection()
+		try:
+			connection = await asyncio.wait_for(self.pool.acquire(), self.acquire_timeout)
+		except asyncio.TimeoutError:
+			raise self.PoolTimeout(f'No connection available in {self.acquire_timeout:.1f}s') from None
+		try:
+			yield connection
+		except Exception as e:
+			if self.retry_policy.classify(e) is Action.RECONNECT:
+				# Closed connection is dropped by pool on release
+				connection.close()
+			raise
+		except BaseException:
+			# Cancelled or closed early (e.g. query_iter), what is left of the result is never read
+			connection.close()
+			raise
+		finally:
+			self.last_execute_time = time.monotonic()
+			self.pool.release(connection)
+
+	@asynccontextmanager
+	async def _cursor(self, *cursorclass: type) -> AsyncIterator[aiomysql.Cursor]:
+		async with self._acquire() as connection:
+			async with connection.cursor(*cursorclass) as cur:
+				yield cur
+
+	@asynccontextmanager
+	async def session(self) -> AsyncIterator['MySqlDB']:
+		"""
+			Pin a pool connection to current task (and tasks it creates) until exit,
+			nested sessions share the outer one. Statements of tasks sharing it run one at a time.
+		"""
+		if self._session.get() is not None:
+			yield self
+			return
+		async with self._acquire() as connection:
+			session = _Session(connection)
+			token = self._session.set(session)
+			try:
+				yield self
+			finally:
+				self._session.reset(token)
+				async with session.use():
+					if not connection.closed and connection.get_transaction_status():
+						# Left open by caller, never return such connection to pool
+						await connection.rollback()
+
+	@asynccontextmanager
+	async def transaction(self) -> AsyncIterator['MySqlDB']:
+		"""
+			Run statements of the block in one transaction on a pinned connection, commit on
+			success or roll back on exception. A nested transaction joins the outer one.
+		"""
+		async with self.session():
+			session = self._session.get()
+			if session.transaction:
+				yield self
+				return
+			async with session.use() as connection:
+				await connection.begin()
+			session.transaction = True
+			try:
+				yield self
+			except BaseException:
+				session.transaction = False
+				session.written.clear()
+				async with session.use() as connection:
+					if not connection.closed:
+						try:
+							await connection.rollback()
+						except aiomysql.Error:
+							connection.close()
+				raise
+			session.transaction = False
+			async with session.use() as connection:
+				await connection.commit()
+			self._committed(session)
+
+	def _in_transaction(self) -> bool:
+		session = self._session.get()
+		return session is not None and (session.transaction or bool(session.connection.get_transaction_status()))
+
+	def _invalidate(self, tables: Iterable[str]) -> None:
+		if self.cache is None or not tables:
+			return
+		self.cache.invalidate(tables)
+		if self._in_transaction():
+			self._session.get().written.update(tables)
 
-	async def query1(self, sql: str, args: Union[Sequence[_cT], _cT]=()) -> Optional[Dict[str, _cT]]:
-		async with self.mysql_connection.cursor() as cur:
-			await cur.execute(sql, args)
-			return await cur.fetchone()
+	def _committed(self, session: _Session) -> None:
+		written, session.written = session.written, set()
+		if self.cache is not None and written:
+			# Readers may have loaded old rows between the write and the commit
+			self.cache.invalidate(written)
+
+	async def _cached(self, kind: str, sql: str, args: Union[Sequence[_cT], _cT], ttl: Optional[float],
+					  load: Callable[[], Awaitable[_rT]]) -> _rT:
+		# A transaction may see its own uncommitted rows, never share them
+		if self.cache is None or ttl == 0 or self._in_transaction() or (key := self.cache.make_key(kind, sql, args)) is None:
+			return await load()
+		return await self.cache.aget_or_load(key, sql, load, ttl)
+
+	async def _execute(self, cur: aiomysql.Cursor, sql: str, args: Union[Sequence[_cT], _cT]) -> int:
+		if self.statement_cache is not None:
+			rendered = self.statement_cache.render(sql, args, cur.connection)
+			if rendered is not None:
+				return await cur.execute(rendered)
+		return await cur.execute(sql, args)
+
+	async def _run(self, sql: str, args: Union[Sequence[_cT], Sequence[Sequence[_cT]], _cT]=(), many: bool=False,
+				   fetch: Optional[Callable[[aiomysql.Cursor], Awaitable[_rT]]]=None,
+				   cursorclass: Optional[type]=None) -> Optional[_rT]:
+		if self.instrumentation is None:
+			return await self._run_with_retry(sql, args, many, fetch, None, cursorclass)
+		event = self.instrumentation.start(sql, args)
+		try:
+			result = await self._run_with_retry(sql, args, many, fetch, event, cursorclass)
+		except BaseException as e:
+			self.instrumentation.finish(event, e)
+			raise
+		self.instrumentation.finish(event)
+		return result
+
+	async def _run_with_retry(self, sql: str, args: Union[Sequence[_cT], Sequence[Sequence[_cT]], _cT], many: bool,
+							  fetch: Optional[Callable[[aiomysql.Cursor], Awaitable[_rT]]],
+							  event: Optional[QueryEvent], cursorclass: Optional[type]=None) -> Optional[_rT]:
+		'''
+			See mysqldb.MySqlDB._run, statements of a session are never tried again
+		'''
+		pinned = self._session.get() is not None
+		attempt = 0
+		while True:
+			attempt += 1
+			self.breaker.before_call()
+			if event is not None:
+				event.mark()
+			try:
+				async with self._cursor(*((cursorclass,) if cursorclass is not None else ())) as cur:
+					if event is not None:
+						event.acquired()
+					if many:
+						await cur.executemany(sql, args)
+					else:
+						await self._execute(cur, sql, args)
+					if event is not None:
+						event.executed()
+					result = await fetch(cur) if fetch is not None else None
+					if event is not None:
+						event.fetched(cur.rowcount)
+			except Exception as e:
+				action = self.retry_policy.classify(e)
+				if action is Action.RECONNECT:
+					self.breaker.record_failure()
+				else:
+					self.breaker.release()
+				if pinned or self.retry_policy.action(e, attempt) is Action.FAIL:
+					raise
+				delay = self.retry_policy.delay(attempt)
+				self.logger.warning('Got %s, trying again in %.3fs. (Attempt: %d)', type(e).__name__, delay, attempt)
+				await asyncio.sleep(delay)
+			except BaseException:
+				self.breaker.release(healthy=False)
+				raise
+			else:
+				self.breaker.record_success()
+				return result
+
+	async def query(self, sql: str, args: Union[Sequence[_cT], _cT]=(), *, ttl: Optional[float]=None,
+					row_format: Optional[str]=None) -> Union[Tuple[Dict[str, _cT]], Tuple[Any, ...], Columnar]:
+		"""
+			`ttl' overrides the cache default lifetime of this result, 0 bypasses the cache,
+			so does an open transaction, which may see its own uncommitted writes.
+			`row_format' is one of rowformat.ROW_FORMATS instead of rows of the handle cursorclass,
+			all but `dict' are read with a tuple cursor
+		"""
+		if row_format is None:
+			return await self._cached('query', sql, args, ttl, lambda: self._run(sql, args, fetch=lambda cur: cur.fetchall()))
+		check_row_format(row_format)
+
+		async def fetch(cur: aiomysql.Cursor) -> Union[Tuple[Any, ...], Columnar]:
+			return _format_fetched(cur, await cur.fetchall(), row_format)
+		return await self._cached(f'query:{row_format}', sql, args, ttl, lambda: self._run(
+			sql, args, fetch=fetch, cursorclass=aiomysql.DictCursor if row_format == 'dict' else aiomysql.Cursor
+		))
+
+	async def query1(self, sql: str, args: Union[Sequence[_cT], _cT]=(), *, ttl: Optional[float]=None) -> Optional[Dict[str, _cT]]:
+		return await self._cached('query1', sql, args, ttl, lambda: self._run(sql, args, fetch=lambda cur: cur.fetchone()))
+
+	async def query_iter(self, sql: str, args: Union[Sequence[_cT], _cT]=(), batch_size: int=1000) -> AsyncIterator[Dict[str, _cT]]:
+		"""
+			Stream rows through an unbuffered (server side) cursor, `batch_size' rows are read at a time.
+			Close the generator (e.g. contextlib.aclosing) when leaving early, the rest of result is discarded then.
+		"""
+		if issubclass(self.cursorclass, (aiomysql.DictCursor, aiomysql.SSDictCursor)):
+			cursorclass = aiomysql.SSDictCursor
+		else:
+			cursorclass = aiomysql.SSCursor
+		async with self._cursor(cursorclass) as cur:
+			await self._execute(cur, sql, args)
+			while rows := await cur.fetchmany(batch_size):
+				for row in rows:
+					yield row
 
 	async def execute(self, sql: str, args: Union[Sequence[_cT], Sequence[Sequence[_cT]], _cT]=(), many: bool=False) -> None:
-		async with self.mysql_connection.cursor() as cur:
-			await (cur.executemany if many else cur.execute)(sql, args)
-		await self.mysql_connection.commit()
+		try:
+			await self._run(sql, args, many)
+		finally:
+			self._invalidate(write_tables(sql))
+
+	async def max_allowed_packet(self, connection: Optional[aiomysql.Connection]=None) -> int:
+		"""
+			Pass the `connection' already held, taking the session one again would wait for itself
+		"""
+		if self._max_allowed_packet is None:
+			if connection is None:
+				async with self._acquire() as connection:
+					return await self.max_allowed_packet(connection)
+			async with connection.cursor(aiomysql.Cursor) as cur:
+				await cur.execute('SELECT @@max_allowed_packet')
+				self._max_allowed_packet = int((await cur.fetchone())[0])
+		return self._max_allowed_packet
+
+	async def bulk_insert(self, table: str, columns: Sequence[str],
+						  rows: Union[Iterable[Sequence[_cT]], AsyncIterable[Sequence[_cT]]],
+						  on_duplicate: OnDuplicate=None, *, max_rows: int=10000, load_data: bool=False) -> int:
+		"""
+			Insert `rows' with multi-row statements sized to the server max_allowed_packet in one transaction,
+			return the number of affected rows. See mysqldb.MySqlDB.bulk_insert for `on_duplicate'.
+			`load_data' streams (synchronous) rows through LOAD DATA LOCAL INFILE, requires `local_infile'.
+		"""
+		affected = 0
+		try:
+			async with self.transaction(), self._cursor() as cur:
+				if load_data:
+					if isinstance(rows, AsyncIterable):
+						raise TypeError('LOAD DATA requires synchronous iterable rows')
+					async with _load_data_fifo(rows, len(columns)) as file_name:
+						affected = await cur.execute(_load_data_statement(table, columns, on_duplicate), (file_name,))
+				else:
+					builder = _BulkInsert(table, columns, on_duplicate, cur.connection.escape,
+										  await self.max_allowed_packet(cur.connection), max_rows)
+					if isinstance(rows, AsyncIterable):
+						async for row in rows:
+							if (statement := builder.add(row)) is not None:
+								affected += await cur.execute(statement)
+					else:
+						for row in rows:
+							if (statement := builder.add(row)) is not None:
+								affected += await cur.execute(statement)
+					if (statement := builder.flush()) is not None:
+						affected += await cur.execute(statement)
+		finally:
+			self._invalidate((table,))
+		return affected
+
+	async def _write_batch(self, batch: Batch) -> None:
+		# Never a pinned session, the batch commits on its own
+		try:
+			async with self._pool_connection() as connection:
+				await connection.begin()
+				try:
+					async with connection.cursor() as cur:
+						for sql, args in batch:
+							await cur.executemany(sql, args)
+				except BaseException:
+					if not connection.closed:
+						try:
+							await connection.rollback()
+						except aiomysql.Error:
+							connection.close()
+					raise
+				await connection.commit()
+		finally:
+			if self.cache is not None:
+				for sql, _ in batch:
+					self.cache.invalidate_sql(sql)
+
+	def write_behind(self, max_batch: int=1000, max_delay: float=0.01, max_pending: int=10000) -> WriteBehindBuffer:
+		'''
+			Buffer whose execute() coalesces writes into executemany batches committed together,
+			see writebehind.WriteBehindBuffer. Close it before closing this handle.
+		'''
+		return WriteBehindBuffer(self._write_batch, max_batch, max_delay, max_pending)
+
+	def do_keepalive(self, idle_ping: float=300.0, idle_max: float=1800.0, interval: float=30.0) -> None:
+		'''
+			Register with the process wide keepalive scheduler (see mysqldb.MySqlDB.do_keepalive),
+			must be called from the event loop running this pool. Pool keeps at least `minsize' connections.
+		'''
+		if self._keepalive is not None:
+			self._keepalive.cancel()
+		self._idle_ping = idle_ping
+		self._idle_max = idle_max
+		self._keepalive = KeepaliveScheduler.get_instance().schedule(self._maintain, interval, asyncio.get_running_loop())
+
+	async def _maintain(self) -> None:
+		if self.pool is None or self.pool.closed:
+			return
+		loop = asyncio.get_running_loop()
+		# Pool hands out free connections first in first out, so each one is visited once
+		for _ in range(self.pool.freesize):
+			if not self.pool.freesize:
+				break
+			connection = await self.pool.acquire()
+			try:
+				idle = loop.time() - connection.last_usage
+				if idle > self._idle_max and self.pool.size > self.pool.minsize:
+					connection.close()
+				elif idle > self._idle_ping:
+					await connection.ping(reconnect=False)
+			except aiomysql.Error:
+				self.logger.warning('Idle connection failed health check, closing')
+				connection.close()
+			finally:
+				self.pool.release(connection)
+
+	async def ping(self) -> None:
+		async with self._acquire() as connection:
+			await connection.ping(reconnect=False)
 
 	async def close(self) -> None:
-		self.mysql_connection.close()
-		await self.mysql_connection.wait_closed()
+		if self._keepalive is not None:
+			self._keepalive.cancel()
+		if self.pool is not None:
+			self.pool.close()
+			await self.pool.wait_closed()
 
 	async def commit(self) -> None:
-		await self.mysql_connection.commit()
+		'''
+			Commit transaction started (e.g. by `BEGIN') in current session, statements outside a session autocommit
+		'''
+		session = self._session.get()
+		if session is not None:
+			async with session.use() as connection:
+				await connection.commit()
+			self._committed(session)
+
+	async def rollback(self) -> None:
+		session = self._session.get()
+		if session is not None:
+			session.written.clear()
+			async with session.use() as connection:
+				await connection.rollback()
 
 	@classmethod
 	async def create(cls,
@@ -91,9 +528,13 @@ class MySqlDB:
 		password: str,
 		db: str,
 		charset: str='utf8mb4',
-		cursorclass: aiomysql.Cursor=aiomysql.DictCursor
+		cursorclass: aiomysql.Cursor=aiomysql.DictCursor,
+		**options: Any
 	):
-		self = cls(host, user, password, db, charset, cursorclass)
+		'''
+			`options' are the keyword only arguments of MySqlDB
+		'''
+		self = cls(host, user, password, db, charset, cursorclass, **options)
 		if cls._self is None:
 			cls._self = self
 		await self.init_connection()
@@ -105,6 +546,84 @@ class MySqlDB:
 			raise RuntimeError()
 		return MySqlDB._self
 
+async def test_bulk_insert() -> None:
+	# Stand-in pool of one connection, enough to follow the statements of a new handle
+	class FakeCursor:
+		def __init__(self, connection: 'FakeConnection'):
+			self.connection = connection
+
+		async def __aenter__(self) -> 'FakeCursor':
+			return self
+
+		async def __aexit__(self, *exc_info: Any) -> None:
+			pass
+
+		async def execute(self, sql: str, args: Any=None) -> int:
+			self.connection.statements.append(sql)
+			return sql.count('),(') + 1 if sql.startswith('INSERT') else 0
+
+		async def fetchone(self) -> Tuple[int]:
+			return (1 << 20,)
+
+		async def fetchall(self) -> Tuple[Tuple[int], ...]:
+			return ((len(self.connection.statements),),)
+
+	class FakeConnection:
+		closed = False
+
+		def __init__(self):
+			self.statements = []
+			self.in_transaction = False
+
+		def cursor(self, *cursorclass: type) -> FakeCursor:
+			return FakeCursor(self)
+
+		def escape(self, value: Any) -> str:
+			return repr(value)
+
+		def get_transaction_status(self) -> bool:
+			return self.in_transaction
+
+		async def begin(self) -> None:
+			self.in_transaction = True
+			self.statements.append('BEGIN')
+
+		async def commit(self) -> None:
+			self.in_transaction = False
+			self.statements.append('COMMIT')
+
+		async def rollback(self) -> None:
+			self.in_transaction = False
+			self.statements.append('ROLLBACK')
+
+		def close(self) -> None:
+			self.closed = True
+
+	class FakePool:
+		closed = False
+
+		def __init__(self):
+			self.connection = FakeConnection()
+
+		async def acquire(self) -> FakeConnection:
+			return self.connection
+
+		def release(self, connection: FakeConnection) -> None:
+			pass
+
+	conn = MySqlDB('localhost', 'user', 'password', 'db', cache=QueryCache())
+	conn.pool = FakePool()
+	rows = await conn.query('SELECT a FROM t')
+	assert await conn.query('SELECT a FROM t') is rows
+	affected = await conn.bulk_insert('t', ('a', 'b'), [(1, 'x'), (2, 'y')])
+	statements = conn.pool.connection.statements
+	assert affected == 2 and statements[1] == 'BEGIN' and statements[-1] == 'COMMIT', statements
+	assert 'SELECT @@max_allowed_packet' in statements, statements
+	# Cached rows of the written table are gone
+	assert await conn.query('SELECT a FROM t') != rows
+	print('Bulk insert test successfully')
+
+
 async def main() -> None:
 	config = ConfigParser()
 	config.read('config.ini')
@@ -119,6 +638,7 @@ async def main() -> None:
 	await conn.close()
 
 if __name__ == "__main__":
+	asyncio.run(test_bulk_insert())
 	cron = main()
 	asyncio.run(cron)
 	#asyncio.wait(cron)
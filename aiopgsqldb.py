@@ -17,12 +17,177 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextvars
+import inspect
+import os
+import time
+import warnings
+from contextlib import asynccontextmanager
+
 import asyncpg
 
-from typing import Optional, Tuple, Union, Sequence, Any
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple, Union
+
+from instrumentation import Instrumentation
+from keepalive import KeepaliveScheduler, ScheduledTask
+from querycache import QueryCache, write_tables
+from rowformat import Columnar, check_row_format, format_rows
+from writebehind import Batch, WriteBehindBuffer
+
+
+class CopyStats(NamedTuple):
+    rows: int
+    bytes: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+def _copy_count(status: str) -> int:
+    # Command status `COPY 1000'
+    count = status.rsplit(' ', 1)[-1]
+    return int(count) if count.isdigit() else 0
+
+
+class _StatementConnection(asyncpg.Connection):
+    """
+        Connection class of pools made by PgSQLdb.create, keeps statements prepared by name
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.named_statements: Dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+
+class _StatementCounter:
+    __slots__ = ('calls', 'prepares', 'invalidations')
+
+    def __init__(self):
+        self.calls: int = 0
+        self.prepares: int = 0
+        self.invalidations: int = 0
+
+
+class _Session:
+    __slots__ = ('connection', 'transaction', 'written')
+
+    def __init__(self, connection: asyncpg.Connection):
+        self.connection: asyncpg.Connection = connection
+        self.transaction: Optional[asyncpg.transaction.Transaction] = None
+        # Tables written in current transaction, invalidated again on commit
+        self.written: Set[str] = set()
+
+
+class RecordStream:
+    """
+        Rows of `sql' read through a server side cursor, `prefetch' rows per round trip, or lists of up to
+        `batch_size' rows when it is given. A pool connection and a transaction are held from the first
+        row until the result is exhausted, an error, cancellation or aclose(). Use it as
+        `async with db.stream(...) as rows: async for row in rows:' so an early break releases them at once.
+        A stream opened with a pinned `connection' uses a savepoint inside its transaction and never releases it.
+    """
+
+    def __init__(self, pool: asyncpg.pool.Pool, sql: str, args: Sequence[Any], prefetch: int,
+                 batch_size: Optional[int], connection: Optional[asyncpg.Connection] = None):
+        self._pool: asyncpg.pool.Pool = pool
+        self._pinned: Optional[asyncpg.Connection] = connection
+        self.sql: str = sql
+        self.args: Sequence[Any] = args
+        self.prefetch: int = prefetch
+        self.batch_size: Optional[int] = batch_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._conn: Optional[asyncpg.Connection] = None
+        self._transaction: Optional[asyncpg.transaction.Transaction] = None
+        self._cursor: Optional[asyncpg.cursor.Cursor] = None
+        self._iterator: Optional[AsyncIterator[asyncpg.Record]] = None
+        self._closed: bool = False
+        self.rows: int = 0
+
+    async def _open(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._conn = self._pinned if self._pinned is not None else await self._pool.acquire()
+        transaction = self._conn.transaction()
+        await transaction.start()
+        self._transaction = transaction
+        if self.batch_size is None:
+            self._iterator = self._conn.cursor(self.sql, *self.args, prefetch=self.prefetch).__aiter__()
+        else:
+            self._cursor = await self._conn.cursor(self.sql, *self.args)
+
+    def __aiter__(self) -> 'RecordStream':
+        return self
+
+    async def __anext__(self) -> Union[asyncpg.Record, List[asyncpg.Record]]:
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            if self._conn is None:
+                await self._open()
+            if self._iterator is not None:
+                result = await self._iterator.__anext__()
+                self.rows += 1
+            else:
+                result = await self._cursor.fetch(self.batch_size)
+                if not result:
+                    raise StopAsyncIteration
+                self.rows += len(result)
+        except StopAsyncIteration:
+            await self._release(commit=True)
+            raise
+        except asyncio.CancelledError:
+            # Protocol state is unknown after an interrupted fetch
+            await self._release(terminate=True)
+            raise
+        except BaseException:
+            await self._release()
+            raise
+        return result
+
+    async def _release(self, commit: bool = False, terminate: bool = False) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        try:
+            if terminate:
+                conn.terminate()
+            elif self._transaction is not None:
+                await (self._transaction.commit() if commit else self._transaction.rollback())
+        except Exception:
+            conn.terminate()
+        finally:
+            if conn is not self._pinned:
+                await self._pool.release(conn)
+
+    async def aclose(self) -> None:
+        await self._release()
+
+    async def __aenter__(self) -> 'RecordStream':
+        return self
+
+    async def __aexit__(self, *_exc: Any) -> None:
+        await self.aclose()
+
+    def __del__(self) -> None:
+        if self._conn is not None and not self._closed and self._loop is not None and not self._loop.is_closed():
+            warnings.warn(f'Unclosed RecordStream of {self.sql!r}', ResourceWarning)
+            self._loop.call_soon_threadsafe(self._loop.create_task, self._release())
 
 
 class PgSQLdb:
+    """
+        Calls inside session() / transaction() of a task use the connection pinned by it,
+        other calls take a connection from the pool for each statement.
+    """
 
     def __init__(
             self,
@@ -31,7 +196,9 @@ class PgSQLdb:
             user: str,
             password: str,
             db: str,
-            pool: asyncpg.pool.Pool
+            pool: asyncpg.pool.Pool,
+            cache: Optional[QueryCache] = None,
+            instrumentation: Optional[Instrumentation] = None
     ):
         self.host: str = host
         self.port: int = port
@@ -39,6 +206,15 @@ class PgSQLdb:
         self.password: str = password
         self.db: str = db
         self.pgsql_pool: asyncpg.pool.Pool = pool
+        self.cache: Optional[QueryCache] = cache
+        self.instrumentation: Optional[Instrumentation] = instrumentation
+        self.last_execute_time: float = time.monotonic()
+        self._keepalive: Optional[ScheduledTask] = None
+        self._idle_ping: float = 300.0
+        self._session: contextvars.ContextVar[Optional[_Session]] = contextvars.ContextVar(
+            f'pgsql_session_{id(self)}', default=None)
+        self._statements: Dict[str, str] = {}
+        self._statement_counters: Dict[str, _StatementCounter] = {}
 
     @classmethod
     async def create(cls,
@@ -46,33 +222,397 @@ class PgSQLdb:
                      port: int,
                      user: str,
                      password: str,
-                     db: str
+                     db: str,
+                     cache: Optional[QueryCache] = None,
+                     idle_max: float = 300.0,
+                     instrumentation: Optional[Instrumentation] = None,
+                     statement_cache_size: int = 100,
+                     max_cached_statement_lifetime: float = 300.0,
+                     max_cacheable_statement_size: int = 15 * 1024
                      ) -> 'PgSQLdb':
+        """
+            Pooled connections idle for `idle_max' seconds are closed by asyncpg,
+            statement options size the implicit per connection statement cache of asyncpg
+            (0 disables it, e.g. behind pgbouncer in transaction mode)
+        """
         pool = await asyncpg.create_pool(
             host=host,
             port=port,
             user=user,
             password=password,
-            database=db
+            database=db,
+            max_inactive_connection_lifetime=idle_max,
+            statement_cache_size=statement_cache_size,
+            max_cached_statement_lifetime=max_cached_statement_lifetime,
+            max_cacheable_statement_size=max_cacheable_statement_size,
+            connection_class=_StatementConnection
         )
-        self = cls(host, port, user, password, db, pool)
+        self = cls(host, port, user, password, db, pool, cache, instrumentation)
         return self
 
-    async def query(self, sql: str, *args: Optional[Any]) -> Tuple[asyncpg.Record, ...]:
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        session = self._session.get()
+        if session is not None:
+            yield session.connection
+            return
         async with self.pgsql_pool.acquire() as conn:
-            return await conn.fetch(sql, *args)
+            yield conn
 
-    async def query1(self, sql: str, *args: Optional[Any]) -> Optional[asyncpg.Record]:
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator['PgSQLdb']:
+        """
+            Pin a pool connection to current task (and tasks it creates) until exit,
+            nested sessions share the outer one
+        """
+        if self._session.get() is not None:
+            yield self
+            return
+        # Pool resets the connection on release, including a transaction left open
         async with self.pgsql_pool.acquire() as conn:
-            return await conn.fetchrow(sql, *args)
+            token = self._session.set(_Session(conn))
+            try:
+                yield self
+            finally:
+                self._session.reset(token)
+
+    @asynccontextmanager
+    async def transaction(self, isolation: Optional[str] = None, readonly: bool = False,
+                          deferrable: bool = False) -> AsyncIterator['PgSQLdb']:
+        """
+            Run statements of the block in one transaction on a pinned connection, commit on
+            success or roll back on exception. A nested transaction joins the outer one,
+            options are those of asyncpg Connection.transaction and apply to the outermost only.
+        """
+        async with self.session():
+            session = self._session.get()
+            if session.transaction is not None:
+                yield self
+                return
+            transaction = session.connection.transaction(isolation=isolation, readonly=readonly,
+                                                         deferrable=deferrable)
+            await transaction.start()
+            session.transaction = transaction
+            try:
+                yield self
+            except BaseException:
+                session.transaction = None
+                session.written.clear()
+                if not session.connection.is_closed():
+                    try:
+                        await transaction.rollback()
+                    except Exception:
+                        session.connection.terminate()
+                raise
+            session.transaction = None
+            written, session.written = session.written, set()
+            try:
+                await transaction.commit()
+            finally:
+                if self.cache is not None and written:
+                    # Readers may have loaded old rows between the write and the commit
+                    self.cache.invalidate(written)
+
+    def _in_transaction(self) -> bool:
+        session = self._session.get()
+        return session is not None and session.transaction is not None
+
+    def _invalidate(self, tables: Iterable[str]) -> None:
+        if self.cache is None or not tables:
+            return
+        self.cache.invalidate(tables)
+        session = self._session.get()
+        if session is not None and session.transaction is not None:
+            session.written.update(tables)
+
+    @staticmethod
+    def _row_count(result: Any) -> int:
+        if isinstance(result, list):
+            return len(result)
+        if isinstance(result, str):
+            # Command status, e.g. `INSERT 0 5'
+            count = result.rsplit(' ', 1)[-1]
+            return int(count) if count.isdigit() else 0
+        return int(result is not None)
+
+    def prepare(self, name: str, sql: str) -> None:
+        """
+            Register `sql' under `name' for query_prepared / query1_prepared / execute_prepared,
+            it is prepared on a pool connection the first time it runs there and reused afterwards
+        """
+        self._statements[name] = sql
+        self._statement_counters.setdefault(name, _StatementCounter())
+
+    def statement_stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """
+            Per registered statement: calls, prepares (calls on a connection without it),
+            invalidations by schema changes and hit rate
+        """
+        return {
+            name: {
+                'calls': counter.calls,
+                'prepares': counter.prepares,
+                'invalidations': counter.invalidations,
+                'hit_rate': 1 - counter.prepares / counter.calls if counter.calls else 0.0,
+            } for name, counter in self._statement_counters.items()
+        }
+
+    @staticmethod
+    async def _call_statement(statement: asyncpg.prepared_stmt.PreparedStatement, method: str,
+                              args: Sequence[Any]) -> Any:
+        if method == 'executemany':
+            return await statement.executemany(*args)
+        if method == 'execute':
+            await statement.fetch(*args)
+            return statement.get_statusmsg()
+        return await getattr(statement, method)(*args)
+
+    async def _run_prepared(self, conn: asyncpg.Connection, method: str, name: str, sql: str,
+                            args: Sequence[Any]) -> Any:
+        counter = self._statement_counters[name]
+        counter.calls += 1
+        statements = getattr(conn, 'named_statements', None)
+        if statements is None:
+            # Pool not made by create(), left to the implicit statement cache
+            return await getattr(conn, method)(sql, *args)
+        statement = statements.get(name)
+        if statement is None or statement.get_query() != sql:
+            counter.prepares += 1
+            statement = statements[name] = await conn.prepare(sql)
+        try:
+            return await self._call_statement(statement, method, args)
+        except asyncpg.exceptions.InvalidCachedStatementError:
+            # Schema changed since it was prepared
+            counter.invalidations += 1
+            del statements[name]
+            if conn.is_in_transaction():
+                raise
+            counter.prepares += 1
+            statement = statements[name] = await conn.prepare(sql)
+            return await self._call_statement(statement, method, args)
+
+    async def _call(self, method: str, sql: str, *args: Any, name: Optional[str] = None) -> Any:
+        self.last_execute_time = time.monotonic()
+        if self.instrumentation is None:
+            async with self._acquire() as conn:
+                if name is None:
+                    return await getattr(conn, method)(sql, *args)
+                return await self._run_prepared(conn, method, name, sql, args)
+        event = self.instrumentation.start(sql, args)
+        try:
+            async with self._acquire() as conn:
+                event.acquired()
+                if name is None:
+                    result = await getattr(conn, method)(sql, *args)
+                else:
+                    result = await self._run_prepared(conn, method, name, sql, args)
+                # asyncpg executes and fetches in one round trip
+                event.executed()
+                event.fetched(self._row_count(result))
+        except BaseException as e:
+            self.instrumentation.finish(event, e)
+            raise
+        self.instrumentation.finish(event)
+        return result
+
+    async def _fetch_formatted(self, sql: str, args: Sequence[Any], name: Optional[str],
+                               row_format: str) -> Union[Tuple[Any, ...], Columnar]:
+        records = await self._call('fetch', sql, *args, name=name)
+        # Column names are only known from a row, an empty columnar result is an empty dict
+        return format_rows(tuple(records[0].keys()) if records else (), records, row_format)
+
+    async def _cached(self, kind: str, method: str, sql: str, args: Sequence[Any], ttl: Optional[float],
+                      name: Optional[str] = None, row_format: Optional[str] = None) -> Any:
+        if row_format is None:
+            load = lambda: self._call(method, sql, *args, name=name)
+        else:
+            check_row_format(row_format)
+            kind = f'{kind}:{row_format}'
+            load = lambda: self._fetch_formatted(sql, args, name, row_format)
+        if self.cache is None or ttl == 0 or self._in_transaction() or (key := self.cache.make_key(kind, sql, args)) is None:
+            return await load()
+        return await self.cache.aget_or_load(key, sql, load, ttl)
+
+    async def query(self, sql: str, *args: Optional[Any], ttl: Optional[float] = None,
+                    row_format: Optional[str] = None) -> Union[Tuple[asyncpg.Record, ...], Tuple[Any, ...], Columnar]:
+        """
+            `ttl' overrides the cache default lifetime of this result, 0 bypasses the cache,
+            so does a transaction, which may see its own uncommitted writes.
+            `row_format' is one of rowformat.ROW_FORMATS instead of asyncpg Records.
+        """
+        return await self._cached('query', 'fetch', sql, args, ttl, row_format=row_format)
+
+    async def query1(self, sql: str, *args: Optional[Any], ttl: Optional[float] = None) -> Optional[asyncpg.Record]:
+        return await self._cached('query1', 'fetchrow', sql, args, ttl)
+
+    async def query_prepared(self, name: str, *args: Optional[Any], ttl: Optional[float] = None,
+                             row_format: Optional[str] = None) -> Union[Tuple[asyncpg.Record, ...], Tuple[Any, ...], Columnar]:
+        """
+            query() of the statement registered as `name' by prepare()
+        """
+        return await self._cached('query', 'fetch', self._statements[name], args, ttl, name, row_format)
+
+    async def query1_prepared(self, name: str, *args: Optional[Any],
+                              ttl: Optional[float] = None) -> Optional[asyncpg.Record]:
+        return await self._cached('query1', 'fetchrow', self._statements[name], args, ttl, name)
+
+    def stream(self, sql: str, *args: Optional[Any], prefetch: int = 1000,
+               batch_size: Optional[int] = None) -> RecordStream:
+        """
+            Yield rows (or lists of `batch_size' rows) as they arrive, see RecordStream.
+            Opened inside a session, it reads on the pinned connection and must be consumed before the session exits.
+        """
+        self.last_execute_time = time.monotonic()
+        session = self._session.get()
+        return RecordStream(self.pgsql_pool, sql, args, prefetch, batch_size,
+                            session.connection if session is not None else None)
+
+    async def query_iter(self, sql: str, *args: Optional[Any], prefetch: int = 1000) -> AsyncIterator[asyncpg.Record]:
+        """
+            Stream rows through a server side cursor, which requires a transaction,
+            `prefetch' rows are read at a time. The pool connection is held until the generator is closed.
+        """
+        async with self.stream(sql, *args, prefetch=prefetch) as records:
+            async for record in records:
+                yield record
 
     async def execute(self, sql: str, *args: Union[Sequence[Tuple[Any, ...]],
                                                    Optional[Any]], many: bool = False) -> None:
-        async with self.pgsql_pool.acquire() as conn:
-            if many:
-                await conn.executemany(sql, *args)
-            else:
-                await conn.execute(sql, *args)
+        try:
+            await self._call('executemany' if many else 'execute', sql, *args)
+        finally:
+            self._invalidate(write_tables(sql))
+
+    async def execute_prepared(self, name: str, *args: Union[Sequence[Tuple[Any, ...]],
+                                                             Optional[Any]], many: bool = False) -> None:
+        sql = self._statements[name]
+        try:
+            await self._call('executemany' if many else 'execute', sql, *args, name=name)
+        finally:
+            self._invalidate(write_tables(sql))
+
+    async def batch(self, statements: Iterable[Union[str, Sequence[Any]]], *,
+                    transaction: bool = False) -> List[List[asyncpg.Record]]:
+        """
+            Run independent `statements', each a SQL string or a (sql, *args) sequence, back to back
+            on one connection and return rows of each (empty list for commands).
+            With `transaction' they are committed together, otherwise each one commits on its own.
+        """
+        results = []
+        async with (self.transaction() if transaction else self.session()):
+            for statement in statements:
+                sql, *args = (statement,) if isinstance(statement, str) else statement
+                try:
+                    results.append(await self._call('fetch', sql, *args))
+                finally:
+                    self._invalidate(write_tables(sql))
+        return results
+
+    async def copy_in(self, table: str, records: Union[Iterable[Sequence[Any]], AsyncIterable[Sequence[Any]]], *,
+                      columns: Optional[Sequence[str]] = None, schema_name: Optional[str] = None,
+                      timeout: Optional[float] = None) -> CopyStats:
+        """
+            Load `records' (iterable or async iterable, consumed as they are sent) with binary COPY
+        """
+        self.last_execute_time = time.monotonic()
+        start = time.perf_counter()
+        try:
+            async with self._acquire() as conn:
+                status = await conn.copy_records_to_table(table, records=records, columns=columns,
+                                                          schema_name=schema_name, timeout=timeout)
+        finally:
+            self._invalidate((table,))
+        return CopyStats(_copy_count(status), 0, time.perf_counter() - start)
+
+    async def copy_out(self, query: str, *args: Any,
+                       output: Union[str, os.PathLike, Any, Callable[[bytes], Awaitable[Any]]],
+                       format: str = 'csv', header: Optional[bool] = None,
+                       timeout: Optional[float] = None, **options: Any) -> CopyStats:
+        """
+            Stream result of `query' to `output' as it arrives: a path, a file-like object whose write()
+            may return an awaitable (a drain() is awaited too, e.g. asyncio.StreamWriter),
+            or a coroutine function called with each chunk. `options' are passed to copy_from_query.
+        """
+        self.last_execute_time = time.monotonic()
+        loop = asyncio.get_running_loop()
+        written = 0
+        opened = None
+        if isinstance(output, (str, os.PathLike)):
+            opened = output = await loop.run_in_executor(None, open, output, 'wb')
+            write = lambda data: loop.run_in_executor(None, opened.write, data)
+        elif hasattr(output, 'write'):
+            drain = getattr(output, 'drain', None)
+
+            async def write(data: bytes) -> None:
+                result = output.write(data)
+                if inspect.isawaitable(result):
+                    await result
+                if drain is not None:
+                    await drain()
+        elif callable(output):
+            write = output
+        else:
+            raise TypeError(f'Unsupported output {type(output).__name__}')
+
+        async def sink(data: bytes) -> None:
+            nonlocal written
+            written += len(data)
+            await write(data)
+
+        start = time.perf_counter()
+        try:
+            async with self._acquire() as conn:
+                status = await conn.copy_from_query(query, *args, output=sink, format=format, header=header,
+                                                    timeout=timeout, **options)
+        finally:
+            if opened is not None:
+                await loop.run_in_executor(None, opened.close)
+        return CopyStats(_copy_count(status), written, time.perf_counter() - start)
+
+    async def _write_batch(self, batch: Batch) -> None:
+        self.last_execute_time = time.monotonic()
+        try:
+            # Never a pinned session, the batch commits on its own
+            async with self.pgsql_pool.acquire() as conn:
+                async with conn.transaction():
+                    for sql, args in batch:
+                        await conn.executemany(sql, args)
+        finally:
+            if self.cache is not None:
+                for sql, _ in batch:
+                    self.cache.invalidate_sql(sql)
+
+    def write_behind(self, max_batch: int = 1000, max_delay: float = 0.01,
+                     max_pending: int = 10000) -> WriteBehindBuffer:
+        """
+            Buffer whose execute() coalesces writes into executemany batches committed together,
+            see writebehind.WriteBehindBuffer. Close it before closing this handle.
+        """
+        return WriteBehindBuffer(self._write_batch, max_batch, max_delay, max_pending)
+
+    def do_keepalive(self, idle_ping: float = 300.0, interval: float = 30.0) -> None:
+        """
+            Register with the process wide keepalive scheduler, the pool is pinged once idle
+            for `idle_ping' seconds. Must be called from the event loop running the pool.
+        """
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+        self._idle_ping = idle_ping
+        self._keepalive = KeepaliveScheduler.get_instance().schedule(self._maintain, interval,
+                                                                     asyncio.get_running_loop())
+
+    async def _maintain(self) -> None:
+        if self.pgsql_pool.is_closing() or time.monotonic() - self.last_execute_time <= self._idle_ping:
+            return
+        self.last_execute_time = time.monotonic()
+        # Failed connection is dropped by pool on release
+        await self.pgsql_pool.execute('SELECT 1')
+
+    async def ping(self) -> None:
+        async with self._acquire() as conn:
+            await conn.execute('SELECT 1')
 
     async def close(self) -> None:
+        if self._keepalive is not None:
+            self._keepalive.cancel()
         await self.pgsql_pool.close()
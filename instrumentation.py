@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+# instrumentation.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import bisect
+import functools
+import logging
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OTHER_STATEMENT = '<other>'
+
+_LITERALS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b|\$\d+|%s|%\(\w+\)s|\?")
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=4096)
+def statement_key(sql: str) -> str:
+	'''
+		Statement with literals and placeholders replaced by `?', lists of them folded,
+		so `IN (%s, %s)' and `IN (%s, %s, %s)' share one histogram
+	'''
+	sql = _LITERALS.sub('?', _WHITESPACE.sub(' ', sql).strip().rstrip(';'))
+	return _LISTS.sub('(...)', sql)
+
+
+def redact_args(args: Any) -> Any:
+	'''
+		Keep types and sizes of query arguments but not their values
+	'''
+	if isinstance(args, (list, tuple)):
+		return type(args)(redact_args(arg) for arg in args)
+	if isinstance(args, dict):
+		return {key: redact_args(value) for key, value in args.items()}
+	if args is None or isinstance(args, (bool, int, float)):
+		return type(args).__name__ if args is not None else None
+	if isinstance(args, (str, bytes, bytearray, memoryview)):
+		return f'<{type(args).__name__}:{len(args)}>'
+	return f'<{type(args).__name__}>'
+
+
+class QueryEvent:
+	'''
+		Timings of one statement, seconds measured with time.perf_counter
+	'''
+	__slots__ = ('sql', 'args', 'statement', 'started', 'finished', 'pool_wait', 'execute_time',
+				 'fetch_time', 'rows', 'error', '_mark', 'context')
+
+	def __init__(self, sql: str, args: Any):
+		self.sql: str = sql
+		self.args: Any = args
+		self.statement: str = statement_key(sql)
+		self.started: float = time.perf_counter()
+		self.finished: float = 0.0
+		self.pool_wait: float = 0.0
+		self.execute_time: float = 0.0
+		self.fetch_time: float = 0.0
+		self.rows: int = 0
+		self.error: Optional[BaseException] = None
+		self._mark: float = self.started
+		# Free for hooks, e.g. to carry a tracing span from before to after hook
+		self.context: Dict[str, Any] = {}
+
+	@property
+	def duration(self) -> float:
+		return self.finished - self.started
+
+	def mark(self) -> None:
+		self._mark = time.perf_counter()
+
+	def _lap(self) -> float:
+		now = time.perf_counter()
+		elapsed, self._mark = now - self._mark, now
+		return elapsed
+
+	def acquired(self) -> None:
+		self.pool_wait += self._lap()
+
+	def executed(self) -> None:
+		self.execute_time += self._lap()
+
+	def fetched(self, rows: int) -> None:
+		self.fetch_time += self._lap()
+		self.rows += max(rows, 0)
+
+
+class _Histogram:
+	__slots__ = ('counts', 'sum', 'count')
+
+	def __init__(self, size: int):
+		self.counts: List[int] = [0] * (size + 1)
+		self.sum: float = 0.0
+		self.count: int = 0
+
+	def observe(self, buckets: Sequence[float], value: float) -> None:
+		self.counts[bisect.bisect_left(buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self) -> List[int]:
+		result, total = [], 0
+		for count in self.counts:
+			total += count
+			result.append(total)
+		return result
+
+
+class _StatementStats:
+	__slots__ = ('latency', 'pool_wait', 'execute_time', 'fetch_time', 'rows', 'errors', 'slow')
+
+	def __init__(self, size: int):
+		self.latency: _Histogram = _Histogram(size)
+		self.pool_wait: float = 0.0
+		self.execute_time: float = 0.0
+		self.fetch_time: float = 0.0
+		self.rows: int = 0
+		self.errors: int = 0
+		self.slow: int = 0
+
+
+def _escape_label(value: str) -> str:
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Instrumentation:
+	'''
+		Per statement latency histograms, pool wait, slow query log and before/after hooks.
+		Pass an instance as `instrumentation' to a database wrapper, wrappers without one
+		skip every measurement. Hooks receive the QueryEvent, their exceptions are logged and dropped.
+		At most `max_statements' distinct statements are tracked, the rest is counted as `<other>'.
+	'''
+
+	def __init__(
+		self,
+		buckets: Sequence[float] = DEFAULT_BUCKETS,
+		slow_query_threshold: Optional[float] = 1.0,
+		redact: Optional[Callable[[Any], Any]] = redact_args,
+		slow_query_logger: Optional[logging.Logger] = None,
+		max_statements: int = 1000
+	):
+		self.buckets: Sequence[float] = tuple(sorted(buckets))
+		self.slow_query_threshold: Optional[float] = slow_query_threshold
+		self.redact: Optional[Callable[[Any], Any]] = redact
+		self.slow_query_logger: logging.Logger = slow_query_logger or logging.getLogger(f'{__name__}.slow_query')
+		self.max_statements: int = max_statements
+		self.before_hooks: List[Callable[[QueryEvent], None]] = []
+		self.after_hooks: List[Callable[[QueryEvent], None]] = []
+		self._lock: threading.Lock = threading.Lock()
+		self._statements: Dict[str, _StatementStats] = {}
+		self._pool_wait: _Histogram = _Histogram(len(self.buckets))
+		self.logger: logging.Logger = logging.getLogger(__name__)
+
+	def add_before_hook(self, hook: Callable[[QueryEvent], None]) -> None:
+		self.before_hooks.append(hook)
+
+	def add_after_hook(self, hook: Callable[[QueryEvent], None]) -> None:
+		self.after_hooks.append(hook)
+
+	def _call_hooks(self, hooks: List[Callable[[QueryEvent], None]], event: QueryEvent) -> None:
+		for hook in hooks:
+			try:
+				hook(event)
+			except Exception:
+				self.logger.exception('Instrumentation hook %r failed', hook)
+
+	def start(self, sql: str, args: Any = ()) -> QueryEvent:
+		event = QueryEvent(sql, args)
+		if self.before_hooks:
+			self._call_hooks(self.before_hooks, event)
+			event.mark()
+		return event
+
+	def finish(self, event: QueryEvent, error: Optional[BaseException] = None) -> None:
+		event.finished = time.perf_counter()
+		event.error = error
+		duration = event.duration
+		slow = self.slow_query_threshold is not None and duration >= self.slow_query_threshold
+		with self._lock:
+			stats = self._statements.get(event.statement)
+			if stats is None:
+				key = event.statement if len(self._statements) < self.max_statements else OTHER_STATEMENT
+				stats = self._statements.get(key)
+				if stats is None:
+					stats = self._statements[key] = _StatementStats(len(self.buckets))
+			stats.latency.observe(self.buckets, duration)
+			stats.pool_wait += event.pool_wait
+			stats.execute_time += event.execute_time
+			stats.fetch_time += event.fetch_time
+			stats.rows += event.rows
+			stats.errors += error is not None
+			stats.slow += slow
+			self._pool_wait.observe(self.buckets, event.pool_wait)
+		if slow:
+			self.slow_query_logger.warning(
+				'Slow query %.3fs (pool wait %.3fs, execute %.3fs, fetch %.3fs, rows %d): %s args=%r',
+				duration, event.pool_wait, event.execute_time, event.fetch_time, event.rows, event.sql,
+				self.redact(event.args) if self.redact is not None else event.args
+			)
+		if self.after_hooks:
+			self._call_hooks(self.after_hooks, event)
+
+	def reset(self) -> None:
+		with self._lock:
+			self._statements.clear()
+			self._pool_wait = _Histogram(len(self.buckets))
+
+	def snapshot(self) -> Dict[str, Any]:
+		with self._lock:
+			return {
+				'buckets': list(self.buckets),
+				'pool_wait': {
+					'counts': self._pool_wait.cumulative(),
+					'sum': self._pool_wait.sum,
+					'count': self._pool_wait.count,
+				},
+				'statements': {
+					statement: {
+						'counts': stats.latency.cumulative(),
+						'sum': stats.latency.sum,
+						'count': stats.latency.count,
+						'pool_wait': stats.pool_wait,
+						'execute_time': stats.execute_time,
+						'fetch_time': stats.fetch_time,
+						'rows': stats.rows,
+						'errors': stats.errors,
+						'slow': stats.slow,
+					} for statement, stats in self._statements.items()
+				},
+			}
+
+	def prometheus(self, prefix: str = 'libpy3_db') -> str:
+		'''
+			Snapshot in Prometheus text exposition format
+		'''
+		snapshot = self.snapshot()
+		bounds = [repr(float(bound)) for bound in snapshot['buckets']] + ['+Inf']
+		lines = [
+			f'# HELP {prefix}_query_duration_seconds Statement latency including pool wait.',
+			f'# TYPE {prefix}_query_duration_seconds histogram',
+		]
+		counters = {
+			'pool_wait': ('query_pool_wait_seconds_total', 'Time spent waiting for a connection.'),
+			'execute_time': ('query_execute_seconds_total', 'Time spent executing statements.'),
+			'fetch_time': ('query_fetch_seconds_total', 'Time spent fetching rows.'),
+			'rows': ('query_rows_total', 'Rows returned or affected.'),
+			'errors': ('query_errors_total', 'Statements finished with an error.'),
+			'slow': ('query_slow_total', 'Statements slower than the slow query threshold.'),
+		}
+		for statement, stats in snapshot['statements'].items():
+			label = f'statement="{_escape_label(statement)}"'
+			for bound, count in zip(bounds, stats['counts']):
+				lines.append(f'{prefix}_query_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+			lines.append(f'{prefix}_query_duration_seconds_sum{{{label}}} {stats["sum"]}')
+			lines.append(f'{prefix}_query_duration_seconds_count{{{label}}} {stats["count"]}')
+		for key, (name, description) in counters.items():
+			lines.append(f'# HELP {prefix}_{name} {description}')
+			lines.append(f'# TYPE {prefix}_{name} counter')
+			for statement, stats in snapshot['statements'].items():
+				lines.append(f'{prefix}_{name}{{statement="{_escape_label(statement)}"}} {stats[key]}')
+		lines.append(f'# HELP {prefix}_pool_wait_seconds Time spent waiting for a connection per statement.')
+		lines.append(f'# TYPE {prefix}_pool_wait_seconds histogram')
+		for bound, count in zip(bounds, snapshot['pool_wait']['counts']):
+			lines.append(f'{prefix}_pool_wait_seconds_bucket{{le="{bound}"}} {count}')
+		lines.append(f'{prefix}_pool_wait_seconds_sum {snapshot["pool_wait"]["sum"]}')
+		lines.append(f'{prefix}_pool_wait_seconds_count {snapshot["pool_wait"]["count"]}')
+		return '\n'.join(lines) + '\n'
+
+
+def test_instrumentation() -> None:
+	assert statement_key('SELECT * FROM t WHERE id IN (%s, %s) AND name = \'x\';') == 'SELECT * FROM t WHERE id IN (...) AND name = ?'
+	assert redact_args(('secret', 3, None)) == ('<str:6>', 'int', None)
+	instrumentation = Instrumentation(buckets=(0.01, 1.0), slow_query_threshold=0.0, max_statements=1)
+	seen = []
+	instrumentation.add_after_hook(lambda event: seen.append(event.statement))
+	instrumentation.slow_query_logger.disabled = True
+	for sql, error in (('SELECT 1', None), ('SELECT 2', None), ('UPDATE t SET a = 1', ValueError())):
+		event = instrumentation.start(sql)
+		event.acquired()
+		event.executed()
+		event.fetched(1)
+		instrumentation.finish(event, error)
+	instrumentation.slow_query_logger.disabled = False
+	statements = instrumentation.snapshot()['statements']
+	assert seen == ['SELECT ?', 'SELECT ?', 'UPDATE t SET a = ?'], seen
+	assert statements['SELECT ?']['count'] == 2 and statements['SELECT ?']['slow'] == 2, statements
+	# Past `max_statements' everything is counted together
+	assert statements[OTHER_STATEMENT]['errors'] == 1 and statements[OTHER_STATEMENT]['counts'][-1] == 1, statements
+	assert 'libpy3_db_query_duration_seconds_count{statement="SELECT ?"} 2' in instrumentation.prometheus()
+	print('Instrumentation test successfully')
+
+
+if __name__ == '__main__':
+	test_instrumentation()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# keepalive.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Shared by the plain callbacks of every task, threads are only started when needed
+_workers: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='keepalive')
+
+
+class ScheduledTask:
+	'''
+		Handle returned by KeepaliveScheduler.schedule, call cancel() to stop it
+	'''
+	__slots__ = ('_callback', 'interval', 'loop', 'cancelled', '_running', '__weakref__')
+
+	def __init__(self, callback: Callable[[], Any], interval: float, loop: Optional[asyncio.AbstractEventLoop]):
+		# Bound methods are held weakly, a forgotten handle does not keep its owner alive
+		self._callback: Union[weakref.WeakMethod, Callable[[], Any]] = (
+			weakref.WeakMethod(callback) if hasattr(callback, '__self__') else callback
+		)
+		self.interval: float = interval
+		self.loop: Optional[asyncio.AbstractEventLoop] = loop
+		self.cancelled: bool = False
+		self._running: Optional['Future[Any]'] = None
+
+	@property
+	def callback(self) -> Optional[Callable[[], Any]]:
+		if isinstance(self._callback, weakref.WeakMethod):
+			return self._callback()
+		return self._callback
+
+	def cancel(self) -> None:
+		self.cancelled = True
+
+	def run(self) -> bool:
+		'''
+			return False once the task should not be scheduled again
+		'''
+		callback = self.callback
+		if self.cancelled or callback is None:
+			return False
+		if self.loop is not None and self.loop.is_closed():
+			return False
+		if self._running is not None and not self._running.done():
+			# Previous run still in progress (e.g. a ping stuck on a dead socket), skip this round
+			logger.warning('Keepalive task %r still running, skipped', callback)
+			return True
+		if self.loop is None:
+			# Off the scheduler thread, a blocking callback never holds up the timers of other tasks
+			self._running = _workers.submit(callback)
+		else:
+			try:
+				self._running = asyncio.run_coroutine_threadsafe(callback(), self.loop)
+			except RuntimeError:
+				# Event loop is stopping
+				return False
+		self._running.add_done_callback(self._log_failure)
+		return True
+
+	@staticmethod
+	def _log_failure(future: 'Future[Any]') -> None:
+		if not future.cancelled() and future.exception() is not None:
+			logger.error('Keepalive task failed', exc_info=future.exception())
+
+
+class KeepaliveScheduler:
+	'''
+		Timer heap served by one daemon thread, shared by every database handle of the process.
+		Plain callbacks run on a small worker pool shared by all tasks, so one blocked (e.g. pinging
+		a half dead connection) only holds a worker; callbacks registered with `loop' return a coroutine
+		which is run on that loop. A task whose previous run has not finished skips its round.
+	'''
+
+	_instance: Optional['KeepaliveScheduler'] = None
+	_instance_lock: threading.Lock = threading.Lock()
+
+	def __init__(self):
+		self._condition: threading.Condition = threading.Condition()
+		self._heap: List[Tuple[float, int, ScheduledTask]] = []
+		self._counter = itertools.count()
+		self._thread: Optional[threading.Thread] = None
+
+	@classmethod
+	def get_instance(cls) -> 'KeepaliveScheduler':
+		with cls._instance_lock:
+			if cls._instance is None:
+				cls._instance = cls()
+			return cls._instance
+
+	def schedule(self, callback: Callable[[], Any], interval: float,
+				 loop: Optional[asyncio.AbstractEventLoop] = None) -> ScheduledTask:
+		if interval <= 0:
+			raise ValueError('interval should be positive')
+		task = ScheduledTask(callback, interval, loop)
+		with self._condition:
+			self._push(task, time.monotonic() + interval)
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self._run, name='keepalive', daemon=True)
+				self._thread.start()
+			self._condition.notify()
+		return task
+
+	def _push(self, task: ScheduledTask, due: float) -> None:
+		heapq.heappush(self._heap, (due, next(self._counter), task))
+
+	def __len__(self) -> int:
+		return len(self._heap)
+
+	def _run(self) -> None:
+		while True:
+			with self._condition:
+				while True:
+					# Drop cancelled tasks eagerly so an idle process does not wake for them
+					while self._heap and self._heap[0][2].cancelled:
+						heapq.heappop(self._heap)
+					if not self._heap:
+						# Nothing left, thread exits and is restarted by next schedule()
+						self._thread = None
+						return
+					due, _, task = self._heap[0]
+					remain = due - time.monotonic()
+					if remain <= 0:
+						heapq.heappop(self._heap)
+						break
+					self._condition.wait(remain)
+			if task.run():
+				with self._condition:
+					self._push(task, max(due + task.interval, time.monotonic()))
+
+
+def test_keepalive() -> None:
+	scheduler = KeepaliveScheduler()
+	release = threading.Event()
+	calls = {'fast': 0, 'blocked': 0}
+
+	def fast() -> None:
+		calls['fast'] += 1
+
+	def blocked() -> None:
+		calls['blocked'] += 1
+		release.wait()
+
+	tasks = [scheduler.schedule(fast, 0.01), scheduler.schedule(blocked, 0.01)]
+	time.sleep(0.2)
+	# The blocked task skips its rounds without holding up the other one
+	assert calls['blocked'] == 1 and calls['fast'] >= 5, calls
+	for task in tasks:
+		task.cancel()
+	release.set()
+	time.sleep(0.05)
+	ran = calls['fast']
+	time.sleep(0.05)
+	assert calls['fast'] == ran and len(scheduler) == 0, calls
+	print('Keepalive test successfully')
+
+
+if __name__ == '__main__':
+	test_keepalive()
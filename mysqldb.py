@@ -17,15 +17,419 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
+import datetime
+import itertools
 import logging
+import os
+import tempfile
+import threading
 import time
 import traceback
-from threading import Lock, Thread
-from typing import Dict, Optional, Sequence, Tuple, TypeVar, Union
+from collections import deque
+from contextlib import contextmanager, nullcontext as _nullcontext
+from threading import Thread
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, TypeVar, Union
 
 import pymysql
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_IN_TRANS
+
+from instrumentation import Instrumentation, QueryEvent
+from keepalive import KeepaliveScheduler, ScheduledTask
+from querycache import QueryCache
+from retrypolicy import Action, CircuitBreaker, RetryPolicy, rolled_back_transaction
+from rowformat import Columnar, check_row_format, format_rows
+from statements import StatementCache
 
 _cT = TypeVar('_cT')
+_rT = TypeVar('_rT')
+
+
+class _PoolEntry:
+	__slots__ = ('connection', 'created', 'last_used', 'last_checked')
+
+	def __init__(self, connection: pymysql.connections.Connection):
+		self.connection: pymysql.connections.Connection = connection
+		self.created: float = time.monotonic()
+		self.last_used: float = self.created
+		self.last_checked: float = self.created
+
+
+class ConnectionPool:
+	"""
+		Bounded pool of connections created by `connect'.
+		Idle connections are pinged on checkout when unused for `ping_interval' seconds
+		and reopened once older than `max_lifetime' seconds.
+	"""
+
+	class PoolTimeout(TimeoutError):
+		"""When no connection become available before timeout raise"""
+
+	def __init__(
+		self,
+		connect: Callable[[], pymysql.connections.Connection],
+		max_size: int = 8,
+		timeout: float = 30.0,
+		max_lifetime: float = 3600.0,
+		ping_interval: float = 30.0
+	):
+		self.logger: logging.Logger = logging.getLogger(__name__)
+		self._connect: Callable[[], pymysql.connections.Connection] = connect
+		self.max_size: int = max_size
+		self.timeout: float = timeout
+		self.max_lifetime: float = max_lifetime
+		self.ping_interval: float = ping_interval
+		self._condition: threading.Condition = threading.Condition()
+		self._idle: Deque[_PoolEntry] = deque()
+		self._entries: Dict[int, _PoolEntry] = {}
+		self._size: int = 0
+		self._closed: bool = False
+		# metrics
+		self.checkouts: int = 0
+		self.waits: int = 0
+		self.wait_time: float = 0.0
+		self.max_wait_time: float = 0.0
+		self.timeouts: int = 0
+		self.recycled: int = 0
+		self.failed_checks: int = 0
+		self.reaped: int = 0
+
+	def _open(self) -> pymysql.connections.Connection:
+		try:
+			connection = self._connect()
+		except:
+			with self._condition:
+				self._size -= 1
+				self._condition.notify()
+			raise
+		entry = _PoolEntry(connection)
+		with self._condition:
+			self._entries[id(connection)] = entry
+		return connection
+
+	def _drop(self, entry: _PoolEntry) -> None:
+		with self._condition:
+			self._entries.pop(id(entry.connection), None)
+			self._size -= 1
+			self._condition.notify()
+		_call_without_exception(entry.connection.close)
+
+	def checkout(self, timeout: Optional[float] = None) -> pymysql.connections.Connection:
+		start = time.monotonic()
+		deadline = start + (self.timeout if timeout is None else timeout)
+		with self._condition:
+			while True:
+				if self._closed:
+					raise RuntimeError('Connection pool is closed')
+				if self._idle:
+					entry = self._idle.pop()
+					break
+				if self._size < self.max_size:
+					self._size += 1
+					entry = None
+					break
+				remain = deadline - time.monotonic()
+				if remain <= 0:
+					self.timeouts += 1
+					raise self.PoolTimeout(f'No connection available in {deadline - start:.1f}s')
+				self._condition.wait(remain)
+			self.checkouts += 1
+			waited = time.monotonic() - start
+			if waited > 0.001:
+				self.waits += 1
+				self.wait_time += waited
+				self.max_wait_time = max(self.max_wait_time, waited)
+		if entry is None:
+			return self._open()
+		now = time.monotonic()
+		if now - entry.created > self.max_lifetime:
+			self.recycled += 1
+			return self._reopen(entry)
+		if now - max(entry.last_used, entry.last_checked) > self.ping_interval:
+			try:
+				entry.connection.ping(reconnect=False)
+			except pymysql.err.Error:
+				self.failed_checks += 1
+				self.logger.warning('Pooled connection failed health check, reopening')
+				return self._reopen(entry)
+		return entry.connection
+
+	def _reopen(self, entry: _PoolEntry) -> pymysql.connections.Connection:
+		with self._condition:
+			self._entries.pop(id(entry.connection), None)
+		_call_without_exception(entry.connection.close)
+		return self._open()
+
+	def checkin(self, connection: pymysql.connections.Connection, discard: bool = False) -> None:
+		entry = self._entries.get(id(connection))
+		if entry is None:
+			_call_without_exception(connection.close)
+			return
+		if not discard and connection.server_status & SERVER_STATUS_IN_TRANS:
+			# Never hand out a connection inside a transaction (or holding an old snapshot)
+			try:
+				connection.rollback()
+			except pymysql.err.Error:
+				discard = True
+		if discard or self._closed:
+			self._drop(entry)
+			return
+		with self._condition:
+			entry.last_used = time.monotonic()
+			self._idle.append(entry)
+			self._condition.notify()
+
+	def maintain(self, idle_ping: float, idle_max: float) -> None:
+		'''
+			Close connections idle for `idle_max' seconds (or past max_lifetime),
+			ping those idle for `idle_ping' seconds so server does not time them out
+		'''
+		now = time.monotonic()
+		with self._condition:
+			if self._closed:
+				return
+			reap = [entry for entry in self._idle
+					if now - entry.last_used > idle_max or now - entry.created > self.max_lifetime]
+			check = [entry for entry in self._idle
+					 if entry not in reap and now - max(entry.last_used, entry.last_checked) > idle_ping]
+			for entry in itertools.chain(reap, check):
+				self._idle.remove(entry)
+			self.reaped += len(reap)
+		for entry in reap:
+			self._drop(entry)
+		for entry in reversed(check):
+			try:
+				entry.connection.ping(reconnect=False)
+			except pymysql.err.Error:
+				self.failed_checks += 1
+				self._drop(entry)
+				continue
+			entry.last_checked = time.monotonic()
+			with self._condition:
+				if self._closed:
+					closed = True
+				else:
+					closed = False
+					# Least recently used end, so reaping order is kept
+					self._idle.appendleft(entry)
+					self._condition.notify()
+			if closed:
+				self._drop(entry)
+
+	@contextmanager
+	def connection(self, timeout: Optional[float] = None) -> Iterator[pymysql.connections.Connection]:
+		connection = self.checkout(timeout)
+		try:
+			yield connection
+		except (pymysql.err.InterfaceError, pymysql.err.OperationalError):
+			self.checkin(connection, discard=True)
+			raise
+		except:
+			self.checkin(connection)
+			raise
+		self.checkin(connection)
+
+	def stats(self) -> Dict[str, Union[int, float]]:
+		with self._condition:
+			return {
+				'size': self._size,
+				'idle': len(self._idle),
+				'in_use': self._size - len(self._idle),
+				'max_size': self.max_size,
+				'checkouts': self.checkouts,
+				'waits': self.waits,
+				'wait_time': self.wait_time,
+				'max_wait_time': self.max_wait_time,
+				'timeouts': self.timeouts,
+				'recycled': self.recycled,
+				'failed_checks': self.failed_checks,
+				'reaped': self.reaped,
+			}
+
+	def close(self) -> None:
+		"""
+			Close idle connections, connections in use are closed when checked in
+		"""
+		with self._condition:
+			self._closed = True
+			idle = list(self._idle)
+			self._idle.clear()
+			self._condition.notify_all()
+		for entry in idle:
+			self._drop(entry)
+
+
+def _quote_identifier(name: str) -> str:
+	# `db.table' is quoted part by part
+	return '.'.join('`' + part.replace('`', '``') + '`' for part in name.split('.'))
+
+
+OnDuplicate = Optional[Union[str, Sequence[str], Mapping[str, str]]]
+
+
+class _BulkInsert:
+	"""
+		Build multi-row INSERT statements no larger than `max_packet' bytes and `max_rows' rows.
+		on_duplicate:
+			None: plain INSERT
+			'ignore' / 'replace': INSERT IGNORE / REPLACE
+			'update': ON DUPLICATE KEY UPDATE every column to the inserted value
+			sequence of column names: ON DUPLICATE KEY UPDATE those columns to the inserted value
+			mapping of column name to SQL expression: ON DUPLICATE KEY UPDATE column = expression
+	"""
+	# Room for the packet header and server side overhead
+	PACKET_HEADROOM = 1024
+
+	def __init__(self, table: str, columns: Sequence[str], on_duplicate: OnDuplicate,
+				 escape: Callable[[Any], str], max_packet: int, max_rows: int = 10000):
+		if not columns:
+			raise ValueError('Bulk insert requires at least one column')
+		verb = 'INSERT'
+		update: Dict[str, str] = {}
+		if on_duplicate == 'ignore':
+			verb = 'INSERT IGNORE'
+		elif on_duplicate == 'replace':
+			verb = 'REPLACE'
+		elif on_duplicate == 'update':
+			update = {column: f'VALUES({_quote_identifier(column)})' for column in columns}
+		elif isinstance(on_duplicate, Mapping):
+			update = dict(on_duplicate)
+		elif isinstance(on_duplicate, str):
+			raise ValueError(f'Unsupported on_duplicate `{on_duplicate}\'')
+		elif on_duplicate is not None:
+			update = {column: f'VALUES({_quote_identifier(column)})' for column in on_duplicate}
+		self.verb: str = verb
+		self.prefix: str = f'{verb} INTO {_quote_identifier(table)} ({", ".join(map(_quote_identifier, columns))}) VALUES '
+		self.suffix: str = ''
+		if update:
+			self.suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+				f'{_quote_identifier(column)} = {expression}' for column, expression in update.items())
+		self.columns: int = len(columns)
+		self.escape: Callable[[Any], str] = escape
+		self.limit: int = max_packet - self.PACKET_HEADROOM - len(self.prefix.encode()) - len(self.suffix.encode())
+		self.max_rows: int = max_rows
+		self._values: List[str] = []
+		self._size: int = 0
+
+	def add(self, row: Sequence[Any]) -> Optional[str]:
+		"""
+			return a complete statement when `row' does not fit into current one
+		"""
+		if len(row) != self.columns:
+			raise ValueError(f'Except {self.columns} values but {len(row)} found.')
+		value = '(' + ','.join(map(self.escape, row)) + ')'
+		size = len(value.encode()) + 1
+		if size > self.limit:
+			raise ValueError(f'Row of {size} bytes exceeds max_allowed_packet')
+		statement = None
+		if self._values and (self._size + size > self.limit or len(self._values) >= self.max_rows):
+			statement = self.flush()
+		self._values.append(value)
+		self._size += size
+		return statement
+
+	def flush(self) -> Optional[str]:
+		if not self._values:
+			return None
+		statement = self.prefix + ','.join(self._values) + self.suffix
+		self._values = []
+		self._size = 0
+		return statement
+
+
+def _load_data_statement(table: str, columns: Sequence[str], on_duplicate: OnDuplicate) -> str:
+	if on_duplicate not in (None, 'ignore', 'replace'):
+		raise ValueError('LOAD DATA only supports on_duplicate of None, `ignore\' or `replace\'')
+	return (
+		f"LOAD DATA LOCAL INFILE %s {(on_duplicate or '').upper()} INTO TABLE {_quote_identifier(table)} "
+		"CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+		f"({', '.join(map(_quote_identifier, columns))})"
+	)
+
+
+_TSV_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+
+def _tsv_value(value: Any) -> str:
+	if value is None:
+		return '\\N'
+	if isinstance(value, bool):
+		return '1' if value else '0'
+	if isinstance(value, (bytes, bytearray, memoryview)):
+		value = bytes(value).decode('utf8', 'surrogateescape')
+	elif isinstance(value, datetime.datetime):
+		value = value.isoformat(' ')
+	return str(value).translate(_TSV_ESCAPE)
+
+
+def _write_tsv(file_name: str, rows: Iterable[Sequence[Any]], columns: int, errors: List[BaseException]) -> None:
+	try:
+		with open(file_name, 'w', encoding='utf8', errors='surrogateescape', newline='\n') as fout:
+			for row in rows:
+				if len(row) != columns:
+					raise ValueError(f'Except {columns} values but {len(row)} found.')
+				fout.write('\t'.join(map(_tsv_value, row)) + '\n')
+	except BaseException as e:
+		errors.append(e)
+
+
+def _start_fifo_writer(directory: str, rows: Iterable[Sequence[Any]],
+					   columns: int) -> Tuple[str, Thread, List[BaseException]]:
+	file_name = os.path.join(directory, 'rows.tsv')
+	os.mkfifo(file_name, 0o600)
+	errors: List[BaseException] = []
+	writer = Thread(target=_write_tsv, args=(file_name, rows, columns, errors), daemon=True)
+	writer.start()
+	return file_name, writer, errors
+
+
+def _finish_fifo_writer(file_name: str, writer: Thread, errors: List[BaseException], aborted: bool) -> None:
+	"""
+		Wait for the writer, raise its error. Blocking, so aiomysqldb runs it in an executor.
+	"""
+	if not aborted:
+		writer.join()
+		if errors:
+			raise errors[0]
+		return
+	# Server may never have read the file, unblock the writer and drop its errors
+	while writer.is_alive():
+		fd = os.open(file_name, os.O_RDONLY | os.O_NONBLOCK)
+		os.set_blocking(fd, True)
+		with open(fd, 'rb') as drain:
+			while drain.read(1 << 16):
+				pass
+		writer.join(0.05)
+
+
+@contextmanager
+def _load_data_fifo(rows: Iterable[Sequence[Any]], columns: int) -> Iterator[str]:
+	"""
+		Yield the name of a FIFO fed with `rows' as tab separated values by a writer thread,
+		so LOAD DATA LOCAL INFILE streams rows without materializing them.
+	"""
+	with tempfile.TemporaryDirectory(prefix='bulk') as directory:
+		file_name, writer, errors = _start_fifo_writer(directory, rows, columns)
+		try:
+			yield file_name
+		except BaseException:
+			_finish_fifo_writer(file_name, writer, errors, aborted=True)
+			raise
+		_finish_fifo_writer(file_name, writer, errors, aborted=False)
+
+
+def _format_fetched(cursor: Any, rows: Sequence[Sequence[Any]], row_format: str) -> Union[Tuple[Any, ...], Columnar]:
+	# Rows of a tuple cursor, dict rows come from a dict cursor as they are
+	if row_format == 'dict':
+		return rows
+	return format_rows([column[0] for column in cursor.description or ()], rows, row_format)
+
+
+def _call_without_exception(target: 'callable', *args, **kwargs) -> None:
+	try:
+		target(*args, **kwargs)
+	except:
+		pass
+
 
 class _MySqlDB:
 
@@ -37,7 +441,18 @@ class _MySqlDB:
 		db: str,
 		charset: str = 'utf8mb4',
 		cursorclass: pymysql.cursors.Cursor = pymysql.cursors.DictCursor,
-		autocommit: bool = False
+		autocommit: bool = False,
+		*,
+		pool_size: int = 8,
+		pool_timeout: float = 30.0,
+		max_lifetime: float = 3600.0,
+		ping_interval: float = 30.0,
+		local_infile: bool = False,
+		cache: Optional[QueryCache] = None,
+		retry_policy: Optional[RetryPolicy] = None,
+		breaker: Optional[CircuitBreaker] = None,
+		instrumentation: Optional[Instrumentation] = None,
+		statement_cache: Optional[StatementCache] = None
 	):
 		self.logger: logging.Logger = logging.getLogger(__name__)
 		self.logger.setLevel(logging.DEBUG)
@@ -47,108 +462,415 @@ class _MySqlDB:
 		self.db: str = db
 		self.charset: str = charset
 		self.cursorclass: pymysql.cursors.Cursor = cursorclass
-		self.execute_lock: Lock = Lock()
 		self.last_execute_time: float = 0.0
 		self.exit_request: bool = False
 		self.autocommit: bool = autocommit
-		self.cursor: pymysql.cursors.Cursor = None
-		self.retries: int = 3
+		self.retry_policy: RetryPolicy = retry_policy or RetryPolicy()
+		self.breaker: CircuitBreaker = breaker or CircuitBreaker.shared(('mysql', host))
+		self.pool_size: int = pool_size
+		self.pool_timeout: float = pool_timeout
+		self.max_lifetime: float = max_lifetime
+		self.ping_interval: float = ping_interval
+		self.local_infile: bool = local_infile
+		self._max_allowed_packet: Optional[int] = None
+		self.cache: Optional[QueryCache] = cache
+		self.instrumentation: Optional[Instrumentation] = instrumentation
+		self.statement_cache: Optional[StatementCache] = statement_cache
+		# Without autocommit a thread keeps its connection from first execute() until commit()
+		self._local: threading.local = threading.local()
+		self._pinned_connections: Dict[int, pymysql.connections.Connection] = {}
+		self._pinned_lock: threading.Lock = threading.Lock()
+		self.pool: Optional[ConnectionPool] = None
+		self._keepalive: Optional[ScheduledTask] = None
+		self._idle_ping: float = 300.0
+		self._idle_max: float = 1800.0
 		self.init_connection()
 
-	def init_connection(self) -> None:
-		self.mysql_connection = pymysql.connect(
+	def _connect(self) -> pymysql.connections.Connection:
+		return pymysql.connect(
 			host = self.host,
 			user = self.user,
 			password = self.password,
 			db = self.db,
 			charset = self.charset,
 			cursorclass = self.cursorclass,
-			autocommit = self.autocommit
+			# Reads outside a transaction do not leave one open, see _begin()
+			autocommit = True,
+			local_infile = self.local_infile
 		)
-		self.cursor = self.mysql_connection.cursor()
+
+	def init_connection(self) -> None:
+		if self.pool is not None:
+			self.pool.close()
+		self.pool = ConnectionPool(self._connect, self.pool_size, self.pool_timeout, self.max_lifetime, self.ping_interval)
+
+	def _pinned(self) -> Optional[pymysql.connections.Connection]:
+		return getattr(self._local, 'connection', None)
+
+	def _pin(self, connection: pymysql.connections.Connection) -> None:
+		self._local.connection = connection
+		with self._pinned_lock:
+			self._pinned_connections[id(connection)] = connection
+
+	def _unpin(self) -> Optional[pymysql.connections.Connection]:
+		connection = self._pinned()
+		self._local.connection = None
+		if connection is not None:
+			with self._pinned_lock:
+				self._pinned_connections.pop(id(connection), None)
+		return connection
+
+	def _begin(self, connection: pymysql.connections.Connection) -> None:
+		# Pooled connections run in autocommit, so a transaction starts with the first write of a thread
+		if not self.autocommit:
+			connection.begin()
+
+	@contextmanager
+	def _connection(self, write: bool = False) -> Iterator[pymysql.connections.Connection]:
+		"""
+			Yield the connection pinned to current thread or a pooled one,
+			a pooled one is pinned afterwards if `write' and autocommit is off.
+		"""
+		connection = self._pinned()
+		if connection is not None:
+			yield connection
+			return
+		self.breaker.before_call()
+		try:
+			connection = self.pool.checkout()
+		except Exception as e:
+			if self.retry_policy.classify(e) is Action.RECONNECT:
+				self.breaker.record_failure()
+			else:
+				self.breaker.release()
+			raise
+		try:
+			if write:
+				self._begin(connection)
+			yield connection
+		except (pymysql.err.InterfaceError, pymysql.err.OperationalError) as e:
+			self.pool.checkin(connection, discard=True)
+			if self.retry_policy.classify(e) is Action.RECONNECT:
+				self.breaker.record_failure()
+			else:
+				self.breaker.release()
+			raise
+		except:
+			self.pool.checkin(connection)
+			self.breaker.release()
+			raise
+		self.breaker.record_success()
+		if write and not self.autocommit:
+			self._pin(connection)
+		else:
+			self.pool.checkin(connection)
+
+	def _invalidate(self, sql: str) -> None:
+		if self.cache is None:
+			return
+		self.cache.invalidate_sql(sql)
+		if self._pinned() is not None:
+			# Other threads may cache old rows until commit, drop them again then
+			self._written().append(sql)
+
+	def _written(self) -> List[str]:
+		written = getattr(self._local, 'written', None)
+		if written is None:
+			written = self._local.written = []
+		return written
 
 	def commit(self) -> None:
-		with self.execute_lock:
-			self.cursor.close()
-			self.mysql_connection.commit()
-			self.cursor = self.mysql_connection.cursor()
-
-	def query(self, sql: str, args: Union[Sequence[_cT], _cT] = ()) -> Tuple[Dict[str, _cT], ...]:
-		self.execute(sql, args)
-		return self.cursor.fetchall()
-
-	def query1(self, sql: str, args: Union[Sequence[_cT], _cT] = ()) -> Optional[Dict[str, _cT]]:
-		self.execute(sql, args)
-		return self.cursor.fetchone()
-
-	def get_retries(self) -> int:
-		self.retries -= 1
-		return self.retries
-	
-	def reset_retries(self) -> None:
-		self.retries = 3
+		connection = self._unpin()
+		if connection is None:
+			return
+		try:
+			connection.commit()
+		except:
+			self.pool.checkin(connection, discard=True)
+			raise
+		finally:
+			if self.cache is not None:
+				for sql in self._written():
+					self.cache.invalidate_sql(sql)
+				self._local.written = []
+		self.pool.checkin(connection)
 
-	def execute(self, sql: str, args: Union[Sequence[_cT], _cT] = (), many: bool = False) -> None:
-		with self.execute_lock:
-			while self.get_retries():
-				try:
-					(self.cursor.executemany if many else self.cursor.execute)(sql, args)
-					break
-				except pymysql.err.InterfaceError:
-					self.logger.warning('Got interface error, trying restart connection. (Retries: %d)', self.retries)
-					self.logger.debug(traceback.format_exc())
-					self._force_close()
-					self.init_connection()
-					self.logger.info('Restart connection successful')
-				except pymysql.err.ProgrammingError:
-					err = traceback.format_exc().splitlines()[-1]
-					if 'Cursor closed' in err:
-						self.cursor = self.mysql_connection.cursor()
-				except pymysql.err.OperationalError:
-					err = traceback.format_exc().splitlines()[-1]
-					if '1213, \'Deadlock found' in err:
-						self.logger.warning('Got deadlock found error, trying restart connection. (Retries: %d)', self.retries)
-						self.logger.debug(traceback.format_exc())
-						self._force_close()
-						self.init_connection()
-						self.logger.info('Restart connection successful')
-				finally:
-					self.last_execute_time = time.time()
-			self.reset_retries()
+	def rollback(self) -> None:
+		if self.cache is not None:
+			self._local.written = []
+		connection = self._unpin()
+		if connection is None:
+			return
+		try:
+			connection.rollback()
+		except pymysql.err.Error:
+			self.pool.checkin(connection, discard=True)
+			return
+		self.pool.checkin(connection)
 
-	def ping(self) -> None:
-		return self.mysql_connection.ping()
+	def _cached(self, kind: str, sql: str, args: Union[Sequence[_cT], _cT], ttl: Optional[float],
+				loader: Callable[[], _rT]) -> _rT:
+		# A transaction may see its own uncommitted rows, never share them
+		if self.cache is None or ttl == 0 or self._pinned() is not None:
+			return loader()
+		key = self.cache.make_key(kind, sql, args)
+		if key is None:
+			return loader()
+		return self.cache.get_or_load(key, sql, loader, ttl)
+
+	def query(self, sql: str, args: Union[Sequence[_cT], _cT] = (), *, ttl: Optional[float] = None,
+			  row_format: Optional[str] = None) -> Union[Tuple[Dict[str, _cT], ...], Tuple[Any, ...], Columnar]:
+		'''
+			`ttl' overrides the cache default lifetime of this result, 0 bypasses the cache.
+			`row_format' is one of rowformat.ROW_FORMATS instead of rows of the handle cursorclass,
+			all but `dict' are read with a tuple cursor.
+		'''
+		if row_format is None:
+			return self._cached('query', sql, args, ttl, lambda: self._run(sql, args, fetch=lambda cursor: cursor.fetchall()))
+		check_row_format(row_format)
+		cursorclass = pymysql.cursors.DictCursor if row_format == 'dict' else pymysql.cursors.Cursor
+		return self._cached(f'query:{row_format}', sql, args, ttl, lambda: self._run(
+			sql, args, fetch=lambda cursor: _format_fetched(cursor, cursor.fetchall(), row_format), cursorclass=cursorclass
+		))
 
-	def do_keepalive(self) -> None:
-		Thread(target = self._do_keepalive, daemon = True).start()
+	def query1(self, sql: str, args: Union[Sequence[_cT], _cT] = (), *, ttl: Optional[float] = None) -> Optional[Dict[str, _cT]]:
+		return self._cached('query1', sql, args, ttl, lambda: self._run(sql, args, fetch=lambda cursor: cursor.fetchone()))
+
+	def _unbuffered_cursorclass(self) -> type:
+		if issubclass(self.cursorclass, pymysql.cursors.DictCursorMixin):
+			return pymysql.cursors.SSDictCursor
+		return pymysql.cursors.SSCursor
+
+	def query_iter(self, sql: str, args: Union[Sequence[_cT], _cT] = (), batch_size: int = 1000) -> Iterator[Dict[str, _cT]]:
+		"""
+			Stream rows through an unbuffered (server side) cursor, `batch_size' rows are read at a time.
+			The connection is held until the generator is exhausted or closed.
+		"""
+		connection = self._pinned()
+		pinned = connection is not None
+		if not pinned:
+			connection = self.pool.checkout()
+		cursor = connection.cursor(self._unbuffered_cursorclass())
+		finished = False
+		try:
+			self._execute(cursor, sql, args)
+			self.last_execute_time = time.time()
+			while rows := cursor.fetchmany(batch_size):
+				yield from rows
+			finished = True
+		finally:
+			if finished or pinned:
+				# Reads what is left of the unbuffered result so the connection can be reused
+				_call_without_exception(cursor.close)
+				if not pinned:
+					self.pool.checkin(connection)
+			else:
+				# Draining the rest of a large result costs more than a new connection
+				self.pool.checkin(connection, discard=True)
 
-	def _do_keepalive(self) -> None:
-		while self._do_keepalive:
+	def _execute(self, cursor: pymysql.cursors.Cursor, sql: str, args: Union[Sequence[_cT], _cT]) -> int:
+		if self.statement_cache is not None:
+			rendered = self.statement_cache.render(sql, args, cursor.connection)
+			if rendered is not None:
+				return cursor.execute(rendered)
+		return cursor.execute(sql, args)
+
+	def _run(self, sql: str, args: Union[Sequence[_cT], _cT] = (), many: bool = False,
+			 fetch: Optional[Callable[[pymysql.cursors.Cursor], _rT]] = None,
+			 cursorclass: Optional[type] = None) -> Optional[_rT]:
+		if self.instrumentation is None:
+			return self._run_with_retry(sql, args, many, fetch, None, cursorclass)
+		event = self.instrumentation.start(sql, args)
+		try:
+			result = self._run_with_retry(sql, args, many, fetch, event, cursorclass)
+		except BaseException as e:
+			self.instrumentation.finish(event, e)
+			raise
+		self.instrumentation.finish(event)
+		return result
+
+	def _run_with_retry(self, sql: str, args: Union[Sequence[_cT], _cT], many: bool,
+						fetch: Optional[Callable[[pymysql.cursors.Cursor], _rT]],
+						event: Optional[QueryEvent], cursorclass: Optional[type] = None) -> Optional[_rT]:
+		'''
+			Errors are handled by `retry_policy': deadlocks are tried again on the same connection,
+			broken connections are replaced, anything else (or running out of attempts) is raised.
+			Inside a transaction (pinned connection) nothing is tried again, since after a deadlock the server
+			already rolled back the earlier statements, use run_transaction() to try the whole transaction again.
+			The connection stays pinned unless the transaction is gone (deadlock or broken connection),
+			so a caller catching e.g. a lock wait timeout continues the same transaction.
+		'''
+		connection = self._pinned()
+		pinned = connection is not None
+		attempt = 0
+		while True:
+			attempt += 1
 			try:
-				if time.time() - self.last_execute_time > 300 and not self.exit_request:
-					self.ping()
+				self.breaker.before_call()
+			except BaseException:
+				# Breaker opened while a retried statement waited, never keep its connection out of the pool
+				if not pinned and connection is not None:
+					self.pool.checkin(connection)
+				raise
+			if event is not None:
+				event.mark()
+			try:
+				if connection is None:
+					connection = self.pool.checkout()
+				if not pinned and fetch is None:
+					# Again on each attempt, a deadlock rolled back the earlier one
+					self._begin(connection)
+				if event is not None:
+					event.acquired()
+				with connection.cursor(cursorclass) as cursor:
+					if many:
+						cursor.executemany(sql, args)
+					else:
+						self._execute(cursor, sql, args)
+					if event is not None:
+						event.executed()
+					result = fetch(cursor) if fetch is not None else None
+					if event is not None:
+						event.fetched(cursor.rowcount)
+			except Exception as e:
+				action = self.retry_policy.classify(e)
+				if action is Action.RECONNECT:
+					self.breaker.record_failure()
+				else:
+					self.breaker.release()
+				if pinned:
+					if action is Action.RECONNECT or rolled_back_transaction(e):
+						# Transaction is rolled back by server or lost with the connection
+						self._unpin()
+						self.pool.checkin(connection, discard=action is Action.RECONNECT)
+					raise
+				if self.retry_policy.action(e, attempt) is Action.FAIL:
+					if connection is not None:
+						self.pool.checkin(connection, discard=action is Action.RECONNECT)
+					raise
+				if action is Action.RECONNECT and connection is not None:
+					self.pool.checkin(connection, discard=True)
+					connection = None
+				delay = self.retry_policy.delay(attempt)
+				self.logger.warning('Got %s, trying again in %.3fs. (Attempt: %d)', type(e).__name__, delay, attempt)
+				self.logger.debug(traceback.format_exc())
+				time.sleep(delay)
+			except BaseException:
+				self.breaker.release(healthy=False)
+				if not pinned and connection is not None:
+					self.pool.checkin(connection, discard=True)
+				raise
+			else:
+				self.breaker.record_success()
+				break
 			finally:
-				if self.exit_request: return
-				for _ in range(0, 5):
-					time.sleep(1)
-					if self.exit_request: return
+				self.last_execute_time = time.time()
+		if not pinned:
+			if fetch is None and not self.autocommit:
+				self._pin(connection)
+			else:
+				self.pool.checkin(connection)
+		return result
 
-	def close(self) -> None:
-		with self.execute_lock:
-			self.exit_request = True
-			self.cursor.close()
-			self.mysql_connection.commit()
-			self.mysql_connection.close()
-	
-	def _call_without_exception(self, target: 'callable', *args, **kwargs) -> None:
+	def run_transaction(self, target: Callable[['_MySqlDB'], _rT]) -> _rT:
+		'''
+			Call `target(self)' then commit, the whole transaction is tried again
+			when `retry_policy' classifies the error as retryable (e.g. deadlock)
+		'''
+		attempt = 0
+		while True:
+			attempt += 1
+			try:
+				result = target(self)
+				self.commit()
+				return result
+			except Exception as e:
+				self.rollback()
+				if self.retry_policy.action(e, attempt) is Action.FAIL:
+					raise
+				delay = self.retry_policy.delay(attempt)
+				self.logger.warning('Transaction failed with %s, trying again in %.3fs. (Attempt: %d)',
+									type(e).__name__, delay, attempt)
+				time.sleep(delay)
+
+	def execute(self, sql: str, args: Union[Sequence[_cT], _cT] = (), many: bool = False) -> None:
 		try:
-			target(*args, **kwargs)
-		except:
-			pass
+			self._run(sql, args, many)
+		finally:
+			self._invalidate(sql)
+
+	def max_allowed_packet(self, connection: Optional[pymysql.connections.Connection] = None) -> int:
+		if self._max_allowed_packet is None:
+			with (self._connection() if connection is None else _nullcontext(connection)) as connection:
+				with connection.cursor(pymysql.cursors.Cursor) as cursor:
+					cursor.execute('SELECT @@max_allowed_packet')
+					self._max_allowed_packet = int(cursor.fetchone()[0])
+		return self._max_allowed_packet
+
+	def bulk_insert(self, table: str, columns: Sequence[str], rows: Iterable[Sequence[_cT]],
+					on_duplicate: OnDuplicate = None, *, max_rows: int = 10000, load_data: bool = False) -> int:
+		"""
+			Insert `rows' (any iterable, consumed lazily) with multi-row statements sized to the
+			server max_allowed_packet, return the number of affected rows.
+			`load_data' streams rows through LOAD DATA LOCAL INFILE instead, which requires
+			`local_infile' and a platform with named pipes.
+		"""
+		affected = 0
+		try:
+			with self._connection(write=True) as connection:
+				with connection.cursor() as cursor:
+					if load_data:
+						with _load_data_fifo(rows, len(columns)) as file_name:
+							affected = cursor.execute(_load_data_statement(table, columns, on_duplicate), (file_name,))
+					else:
+						builder = _BulkInsert(table, columns, on_duplicate, connection.escape,
+											  self.max_allowed_packet(connection), max_rows)
+						for row in rows:
+							if (statement := builder.add(row)) is not None:
+								affected += cursor.execute(statement)
+						if (statement := builder.flush()) is not None:
+							affected += cursor.execute(statement)
+		finally:
+			self.last_execute_time = time.time()
+			self._invalidate(f'INSERT INTO {_quote_identifier(table)}')
+		return affected
+
+	def ping(self) -> None:
+		with self.pool.connection() as connection:
+			return connection.ping()
 
-	def _force_close(self) -> None:
-		self._call_without_exception(self.cursor.close)
-		self._call_without_exception(self.mysql_connection.close)
+	def do_keepalive(self, idle_ping: float = 300.0, idle_max: float = 1800.0, interval: float = 30.0) -> None:
+		'''
+			Register with the process wide keepalive scheduler, every `interval' seconds pooled
+			connections idle for `idle_ping' seconds are pinged and those idle for `idle_max' are closed
+		'''
+		if self._keepalive is not None:
+			self._keepalive.cancel()
+		self._idle_ping = idle_ping
+		self._idle_max = idle_max
+		self._keepalive = KeepaliveScheduler.get_instance().schedule(self._maintain, interval)
+
+	def _maintain(self) -> None:
+		if not self.exit_request:
+			self.pool.maintain(self._idle_ping, self._idle_max)
+
+	def close(self) -> None:
+		"""
+			Commit the transaction of current thread, transactions other threads left open are rolled back
+		"""
+		self.exit_request = True
+		if self._keepalive is not None:
+			self._keepalive.cancel()
+		self.commit()
+		with self._pinned_lock:
+			pinned = list(self._pinned_connections.values())
+			self._pinned_connections.clear()
+		if pinned:
+			self.logger.warning('Closing %d connection(s) with uncommitted transaction of other threads', len(pinned))
+		for connection in pinned:
+			# Server rolls back the transaction of a closed connection
+			_call_without_exception(connection.close)
+		self.pool.close()
 
 
 class MySqlDB(_MySqlDB):
@@ -161,9 +883,10 @@ class MySqlDB(_MySqlDB):
 		db: str,
 		charset: str = 'utf8mb4',
 		cursorclass = pymysql.cursors.DictCursor,
-		autocommit = False
+		autocommit = False,
+		**pool_options: Any
 	) -> 'MySqlDB':
-		MySqlDB._self = MySqlDB(host, user, password, db, charset, cursorclass, autocommit)
+		MySqlDB._self = MySqlDB(host, user, password, db, charset, cursorclass, autocommit, **pool_options)
 		return MySqlDB._self
 	
 	@staticmethod
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# querycache.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import functools
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar
+
+_rT = TypeVar('_rT')
+
+_WHITESPACE = re.compile(r'\s+')
+_IDENTIFIER = r'((?:[`"]?[\w$]+[`"]?\.)*[`"]?[\w$]+[`"]?)'
+_TABLE = re.compile(r'\s*' + _IDENTIFIER)
+_ALIAS = re.compile(r'\s+(?:AS\s+)?([`"]?[\w$]+[`"]?)', re.IGNORECASE)
+_LIST_SEPARATOR = re.compile(r'\s*,')
+# Words which may follow a table reference, anything else there is its alias
+_CLAUSE_KEYWORDS = frozenset((
+	'where', 'set', 'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'natural', 'straight_join',
+	'on', 'using', 'group', 'order', 'limit', 'having', 'window', 'union', 'except', 'intersect', 'for',
+	'lock', 'into', 'values', 'value', 'select', 'partition', 'use', 'force', 'ignore', 'from', 'returning',
+	'as', 'with', 'default', 'only',
+))
+_READ_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+', re.IGNORECASE)
+_WRITE_TABLES = re.compile(
+	r'^\s*(?:'
+	r'(?:INSERT|REPLACE)(?:\s+(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE))*\s+(?:INTO\s+)?'
+	r'|UPDATE(?:\s+(?:LOW_PRIORITY|IGNORE|ONLY))*\s+'
+	r'|DELETE(?:\s+(?:LOW_PRIORITY|QUICK|IGNORE))*\s+(?:FROM\s+)?(?:ONLY\s+)?'
+	r'|TRUNCATE\s+(?:TABLE\s+)?(?:ONLY\s+)?'
+	r'|(?:ALTER|DROP)\s+TABLE\s+(?:IF\s+EXISTS\s+)?'
+	r'|COPY\s+'
+	r')',
+	re.IGNORECASE
+)
+_LOAD_DATA_TABLE = re.compile(r'^\s*LOAD\s+DATA\b.*?\bINTO\s+TABLE\s+', re.IGNORECASE | re.DOTALL)
+# Statements which never modify a table
+_READ_ONLY = re.compile(r'^[\s(]*(?:SELECT|SHOW|EXPLAIN|DESCRIBE|DESC|SET|BEGIN|START|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|USE)\b',
+						re.IGNORECASE)
+_STATEMENT = re.compile(r'\b(?:SELECT|INSERT|REPLACE|UPDATE|DELETE)\b', re.IGNORECASE)
+# Returned by write_tables for a write whose tables are unknown, QueryCache.invalidate drops everything then
+ALL_TABLES = frozenset(('*',))
+
+
+def _memoize(function: Callable[[str], _rT]) -> Callable[[str], _rT]:
+	'''
+		Remember results of statements up to 4 KiB, a service runs the same few statements over and over
+		while long ones are usually generated with inlined values and would only fill the cache
+	'''
+	cached = functools.lru_cache(maxsize=4096)(function)
+
+	@functools.wraps(function)
+	def wrapper(sql: str) -> _rT:
+		return cached(sql) if len(sql) <= 4096 else function(sql)
+	return wrapper
+
+
+@_memoize
+def normalize_sql(sql: str) -> str:
+	return _WHITESPACE.sub(' ', sql).strip().rstrip(';').rstrip()
+
+
+def _table_name(identifier: str) -> str:
+	# Schema is dropped, so `db.table' and `table' invalidate each other
+	return identifier.rsplit('.', 1)[-1].strip('`"').lower()
+
+
+def _table_list(sql: str, position: int) -> List[str]:
+	# `a [AS] x, b y, ...' starting at `position', stops at the first word which is not an alias
+	tables = []
+	while (match := _TABLE.match(sql, position)) is not None:
+		tables.append(_table_name(match.group(1)))
+		position = match.end()
+		alias = _ALIAS.match(sql, position)
+		if alias is not None and alias.group(1).strip('`"').lower() not in _CLAUSE_KEYWORDS:
+			position = alias.end()
+		separator = _LIST_SEPARATOR.match(sql, position)
+		if separator is None:
+			break
+		position = separator.end()
+	return tables
+
+
+def _main_statement(sql: str) -> str:
+	# Skip the common table expressions of `WITH ... (...) UPDATE ...'
+	if sql.lstrip()[:4].upper() != 'WITH':
+		return sql
+	depth = 0
+	for match in re.finditer(r'[()]|' + _STATEMENT.pattern, sql, re.IGNORECASE):
+		token = match.group(0)
+		if token == '(':
+			depth += 1
+		elif token == ')':
+			depth -= 1
+		elif depth == 0:
+			return sql[match.start():]
+	return sql
+
+
+@_memoize
+def read_tables(sql: str) -> FrozenSet[str]:
+	return frozenset(table for match in _READ_TABLES.finditer(sql) for table in _table_list(sql, match.end()))
+
+
+@_memoize
+def write_tables(sql: str) -> FrozenSet[str]:
+	'''
+		Tables modified by `sql', empty if it is a statement which only reads,
+		ALL_TABLES if it writes to tables which cannot be told
+	'''
+	statement = _main_statement(sql)
+	match = _WRITE_TABLES.match(statement) or _LOAD_DATA_TABLE.match(statement)
+	tables = set(_table_list(statement, match.end())) if match is not None else set()
+	if tables and statement.lstrip()[:6].upper() in ('INSERT', 'UPDATE', 'DELETE', 'REPLAC'):
+		# Multi table UPDATE / DELETE (maybe by alias) and INSERT ... SELECT, over-invalidating is harmless
+		tables.update(read_tables(sql))
+	if tables:
+		return frozenset(tables)
+	return frozenset() if _READ_ONLY.match(statement) else ALL_TABLES
+
+
+class _Entry:
+	__slots__ = ('value', 'expires', 'tables')
+
+	def __init__(self, value: Any, expires: float, tables: FrozenSet[str]):
+		self.value: Any = value
+		self.expires: float = expires
+		self.tables: FrozenSet[str] = tables
+
+
+class _Flight:
+	__slots__ = ('event', 'value', 'error')
+
+	def __init__(self):
+		self.event: threading.Event = threading.Event()
+		self.value: Any = None
+		self.error: Optional[BaseException] = None
+
+
+_RETRY = object()
+
+
+class QueryCache:
+	'''
+		Read-through cache of query results keyed on (normalized SQL, args),
+		bounded to `max_size' entries with LRU eviction and expired after `ttl' seconds.
+		Concurrent misses of the same key are loaded once, entries are dropped by table name
+		when a write statement touches any table read by the query.
+		Cached results are shared between callers and must not be modified.
+	'''
+
+	def __init__(self, max_size: int = 1024, ttl: float = 60.0):
+		if max_size < 1:
+			raise ValueError('max_size should be positive')
+		self.max_size: int = max_size
+		self.ttl: float = ttl
+		self._lock: threading.Lock = threading.Lock()
+		self._entries: 'OrderedDict[Hashable, _Entry]' = OrderedDict()
+		self._by_table: Dict[str, Set[Hashable]] = {}
+		# Bumped on invalidation, so a load racing with a write does not store stale rows
+		self._versions: Dict[str, int] = {}
+		self._epoch: int = 0
+		self._flights: Dict[Hashable, _Flight] = {}
+		self._async_flights: Dict[Hashable, 'asyncio.Future[Any]'] = {}
+		self.hits: int = 0
+		self.misses: int = 0
+		self.evictions: int = 0
+		self.expirations: int = 0
+		self.invalidations: int = 0
+
+	@staticmethod
+	def make_key(kind: str, sql: str, args: Any) -> Optional[Hashable]:
+		'''
+			return None if `args' is not hashable, such query is not cached
+		'''
+		if isinstance(args, list):
+			args = tuple(args)
+		elif isinstance(args, dict):
+			args = tuple(sorted(args.items()))
+		key = (kind, normalize_sql(sql), args)
+		try:
+			hash(key)
+		except TypeError:
+			return None
+		return key
+
+	def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+		entry = self._entries.get(key)
+		if entry is None:
+			return False, None
+		if entry.expires < time.monotonic():
+			self._remove(key)
+			self.expirations += 1
+			return False, None
+		self._entries.move_to_end(key)
+		self.hits += 1
+		return True, entry.value
+
+	def _remove(self, key: Hashable) -> None:
+		entry = self._entries.pop(key)
+		for table in entry.tables:
+			keys = self._by_table.get(table)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self._by_table[table]
+
+	def _snapshot(self, tables: FrozenSet[str]) -> Tuple[int, ...]:
+		return (self._epoch, *(self._versions.get(table, 0) for table in sorted(tables)))
+
+	def _store(self, key: Hashable, value: Any, ttl: Optional[float], tables: FrozenSet[str],
+			   snapshot: Tuple[int, ...]) -> None:
+		if self._snapshot(tables) != snapshot:
+			return
+		if key in self._entries:
+			self._remove(key)
+		self._entries[key] = _Entry(value, time.monotonic() + (self.ttl if ttl is None else ttl), tables)
+		for table in tables:
+			self._by_table.setdefault(table, set()).add(key)
+		while len(self._entries) > self.max_size:
+			self._remove(next(iter(self._entries)))
+			self.evictions += 1
+
+	def get_or_load(self, key: Hashable, sql: str, loader: Callable[[], _rT], ttl: Optional[float] = None) -> _rT:
+		tables = read_tables(sql)
+		while True:
+			with self._lock:
+				found, value = self._lookup(key)
+				if found:
+					return value
+				flight = self._flights.get(key)
+				leader = flight is None
+				if leader:
+					self.misses += 1
+					flight = self._flights[key] = _Flight()
+					snapshot = self._snapshot(tables)
+			if leader:
+				break
+			flight.event.wait()
+			if flight.error is not None:
+				raise flight.error
+			if flight.value is not _RETRY:
+				with self._lock:
+					self.hits += 1
+				return flight.value
+		try:
+			value = loader()
+		except BaseException as e:
+			flight.error = e if isinstance(e, Exception) else None
+			flight.value = _RETRY
+			raise
+		else:
+			flight.value = value
+			with self._lock:
+				self._store(key, value, ttl, tables, snapshot)
+			return value
+		finally:
+			with self._lock:
+				del self._flights[key]
+			flight.event.set()
+
+	async def aget_or_load(self, key: Hashable, sql: str, loader: Callable[[], Awaitable[_rT]],
+						   ttl: Optional[float] = None) -> _rT:
+		tables = read_tables(sql)
+		while True:
+			with self._lock:
+				found, value = self._lookup(key)
+				if found:
+					return value
+				future = self._async_flights.get(key)
+				leader = future is None
+				if leader:
+					self.misses += 1
+					future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+					snapshot = self._snapshot(tables)
+			if leader:
+				break
+			value = await asyncio.shield(future)
+			if value is not _RETRY:
+				with self._lock:
+					self.hits += 1
+				return value
+		try:
+			value = await loader()
+		except Exception as e:
+			future.set_exception(e)
+			# Followers retrieve it, do not warn when there is none
+			future.exception()
+			raise
+		except BaseException:
+			# Leader cancelled, let a follower load instead
+			future.set_result(_RETRY)
+			raise
+		else:
+			future.set_result(value)
+			with self._lock:
+				self._store(key, value, ttl, tables, snapshot)
+			return value
+		finally:
+			with self._lock:
+				del self._async_flights[key]
+
+	def invalidate(self, tables: Iterable[str]) -> int:
+		'''
+			Drop entries reading any of `tables' (every entry if ALL_TABLES), return count of dropped entries
+		'''
+		dropped = 0
+		tables = tuple(tables)
+		with self._lock:
+			if '*' in tables:
+				dropped = len(self._entries)
+				self._clear()
+				tables = ()
+			for table in tables:
+				table = _table_name(table)
+				self._versions[table] = self._versions.get(table, 0) + 1
+				for key in tuple(self._by_table.get(table, ())):
+					self._remove(key)
+					dropped += 1
+			self.invalidations += dropped
+		return dropped
+
+	def invalidate_sql(self, sql: str) -> int:
+		tables = write_tables(sql)
+		return self.invalidate(tables) if tables else 0
+
+	def _clear(self) -> None:
+		self._epoch += 1
+		self._entries.clear()
+		self._by_table.clear()
+
+	def clear(self) -> None:
+		with self._lock:
+			self._clear()
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def stats(self) -> Dict[str, int]:
+		with self._lock:
+			return {
+				'size': len(self._entries),
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions,
+				'expirations': self.expirations,
+				'invalidations': self.invalidations,
+			}
+
+
+def test_query_cache() -> None:
+	shapes = {
+		'SELECT * FROM a, b AS y JOIN c ON 1': ({'a', 'b', 'c'}, set()),
+		'UPDATE a, b SET a.x = b.x': (set(), {'a', 'b'}),
+		'DELETE a FROM a JOIN b ON a.id = b.id': ({'a', 'b'}, {'a', 'b'}),
+		'DELETE FROM t1, t2 USING t1 JOIN t2': ({'t1', 't2'}, {'t1', 't2'}),
+		'WITH c AS (SELECT * FROM s) UPDATE t SET x = 1': ({'s'}, {'s', 't'}),
+		'INSERT INTO `db`.`t` (a) SELECT a FROM u': ({'u'}, {'t', 'u'}),
+		'CALL refresh()': (set(), set(ALL_TABLES)),
+		'SET NAMES utf8mb4': (set(), set()),
+	}
+	for sql, (read, written) in shapes.items():
+		assert read_tables(sql) == read and write_tables(sql) == written, (sql, read_tables(sql), write_tables(sql))
+	cache = QueryCache(max_size=2)
+	loads = []
+
+	def load(sql: str) -> Any:
+		key = cache.make_key('query', sql, ())
+		return cache.get_or_load(key, sql, lambda: loads.append(sql) or len(loads))
+
+	assert load('SELECT * FROM a, b') == load('SELECT  * FROM a, b') == 1
+	load('SELECT * FROM c')
+	assert cache.invalidate_sql('UPDATE b, d SET b.x = d.x') == 1 and len(cache) == 1
+	assert cache.invalidate_sql('CALL refresh()') == 1 and len(cache) == 0
+	load('SELECT * FROM a')
+	load('SELECT * FROM b')
+	load('SELECT * FROM c')
+	assert len(cache) == 2 and cache.stats()['evictions'] == 1
+	print('Query cache test successfully')
+
+
+if __name__ == '__main__':
+	test_query_cache()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# retrypolicy.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import enum
+import random
+import threading
+import time
+from typing import Callable, Dict, Hashable, Optional
+
+import pymysql
+from pymysql.constants import CR, ER
+
+
+class Action(enum.Enum):
+	# Run the statement (transaction) again on the same connection
+	RETRY = 'retry'
+	# Connection is broken, open another one before trying again
+	RECONNECT = 'reconnect'
+	FAIL = 'fail'
+
+
+_RETRY_ERRORS = frozenset((ER.LOCK_DEADLOCK, ER.LOCK_WAIT_TIMEOUT))
+_RECONNECT_ERRORS = frozenset((
+	CR.CR_CONNECTION_ERROR, CR.CR_CONN_HOST_ERROR, CR.CR_SERVER_GONE_ERROR, CR.CR_SERVER_LOST,
+	CR.CR_SERVER_LOST_EXTENDED, ER.SERVER_SHUTDOWN, ER.CON_COUNT_ERROR,
+	# ER_CLIENT_INTERACTION_TIMEOUT, MySQL 8.0.24+
+	4031,
+))
+
+
+def rolled_back_transaction(error: BaseException) -> bool:
+	'''
+		Whether the server rolled back the whole transaction, a lock wait timeout only rolls back
+		the statement (unless innodb_rollback_on_timeout is enabled)
+	'''
+	return (isinstance(error, pymysql.err.MySQLError) and bool(error.args)
+			and error.args[0] == ER.LOCK_DEADLOCK)
+
+
+def classify_mysql_error(error: BaseException) -> Action:
+	if isinstance(error, pymysql.err.InterfaceError):
+		return Action.RECONNECT
+	if isinstance(error, pymysql.err.MySQLError):
+		code = error.args[0] if error.args and isinstance(error.args[0], int) else None
+		if code in _RETRY_ERRORS:
+			return Action.RETRY
+		if code in _RECONNECT_ERRORS:
+			return Action.RECONNECT
+		return Action.FAIL
+	if isinstance(error, ConnectionError):
+		return Action.RECONNECT
+	return Action.FAIL
+
+
+class RetryPolicy:
+	'''
+		Decide whether a failed call is tried again and how long to wait before that.
+		Delays grow exponentially from `base_delay' up to `max_delay' with full jitter,
+		so clients failing together do not come back together.
+	'''
+
+	def __init__(
+		self,
+		max_attempts: int = 3,
+		base_delay: float = 0.05,
+		max_delay: float = 2.0,
+		multiplier: float = 2.0,
+		classify: Callable[[BaseException], Action] = classify_mysql_error
+	):
+		if max_attempts < 1:
+			raise ValueError('max_attempts should be positive')
+		self.max_attempts: int = max_attempts
+		self.base_delay: float = base_delay
+		self.max_delay: float = max_delay
+		self.multiplier: float = multiplier
+		self.classify: Callable[[BaseException], Action] = classify
+
+	def action(self, error: BaseException, attempt: int) -> Action:
+		'''
+			`attempt' counts from 1, FAIL is returned once attempts are exhausted
+		'''
+		if attempt >= self.max_attempts:
+			return Action.FAIL
+		return self.classify(error)
+
+	def delay(self, attempt: int) -> float:
+		return random.uniform(0, min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1)))
+
+
+class CircuitBreaker:
+	'''
+		Stop calling a server after `failure_threshold' consecutive connection failures,
+		calls fail fast with CircuitOpen until `reset_timeout' seconds passed,
+		then a single probe is let through, whose outcome closes or reopens the circuit.
+		Safe to share between threads and event loops.
+	'''
+
+	class CircuitOpen(ConnectionError):
+		pass
+
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	_shared: Dict[Hashable, 'CircuitBreaker'] = {}
+	_shared_lock: threading.Lock = threading.Lock()
+
+	def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+		self.failure_threshold: int = failure_threshold
+		self.reset_timeout: float = reset_timeout
+		self._lock: threading.Lock = threading.Lock()
+		self.state: str = self.CLOSED
+		self.failures: int = 0
+		self.opened_at: float = 0.0
+		self._probing: bool = False
+		self.rejected: int = 0
+		self.trips: int = 0
+
+	@classmethod
+	def shared(cls, endpoint: Hashable, **kwargs) -> 'CircuitBreaker':
+		'''
+			Process wide breaker of `endpoint', so every handle of one server opens together
+		'''
+		with cls._shared_lock:
+			breaker = cls._shared.get(endpoint)
+			if breaker is None:
+				breaker = cls._shared[endpoint] = cls(**kwargs)
+			return breaker
+
+	def before_call(self) -> None:
+		with self._lock:
+			if self.state == self.CLOSED:
+				return
+			if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+				self.state = self.HALF_OPEN
+			if self.state == self.HALF_OPEN and not self._probing:
+				self._probing = True
+				return
+			self.rejected += 1
+		raise self.CircuitOpen('Circuit breaker is open, server is considered unavailable')
+
+	def record_success(self) -> None:
+		if self.state == self.CLOSED and not self.failures:
+			return
+		with self._lock:
+			self.state = self.CLOSED
+			self.failures = 0
+			self._probing = False
+
+	def record_failure(self) -> None:
+		with self._lock:
+			self.failures += 1
+			if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+				if self.state != self.OPEN:
+					self.trips += 1
+				self.state = self.OPEN
+				self.opened_at = time.monotonic()
+				self._probing = False
+
+	def release(self, healthy: bool = True) -> None:
+		'''
+			Call finished without a connection failure, `healthy' is False if it was interrupted
+			before the server answered
+		'''
+		if self._probing:
+			with self._lock:
+				self._probing = False
+				if healthy and self.state == self.HALF_OPEN:
+					self.state = self.CLOSED
+					self.failures = 0
+
+	def stats(self) -> Dict[str, object]:
+		with self._lock:
+			return {
+				'state': self.state,
+				'failures': self.failures,
+				'rejected': self.rejected,
+				'trips': self.trips,
+			}
+
+
+def test_retry_policy() -> None:
+	policy = RetryPolicy(max_attempts=3, base_delay=0.1, max_delay=0.15)
+	deadlock = pymysql.err.OperationalError(ER.LOCK_DEADLOCK, 'Deadlock found')
+	lost = pymysql.err.OperationalError(CR.CR_SERVER_LOST, 'Lost connection')
+	assert classify_mysql_error(deadlock) is Action.RETRY and rolled_back_transaction(deadlock)
+	assert classify_mysql_error(pymysql.err.OperationalError(ER.LOCK_WAIT_TIMEOUT, 'Lock wait timeout')) is Action.RETRY
+	assert classify_mysql_error(lost) is Action.RECONNECT and not rolled_back_transaction(lost)
+	assert classify_mysql_error(pymysql.err.ProgrammingError(1064, 'syntax')) is Action.FAIL
+	assert classify_mysql_error(ConnectionResetError()) is Action.RECONNECT
+	assert policy.action(deadlock, 2) is Action.RETRY and policy.action(deadlock, 3) is Action.FAIL
+	assert all(0 <= policy.delay(attempt) <= 0.15 for attempt in range(1, 10))
+	breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+	for _ in range(2):
+		breaker.before_call()
+		breaker.record_failure()
+	try:
+		breaker.before_call()
+		raise AssertionError('Circuit should be open')
+	except CircuitBreaker.CircuitOpen:
+		pass
+	time.sleep(0.06)
+	# Single probe while half open, its success closes the circuit
+	breaker.before_call()
+	try:
+		breaker.before_call()
+		raise AssertionError('Only one probe should be let through')
+	except CircuitBreaker.CircuitOpen:
+		pass
+	breaker.record_success()
+	breaker.before_call()
+	assert breaker.stats() == {'state': CircuitBreaker.CLOSED, 'failures': 0, 'rejected': 2, 'trips': 1}, breaker.stats()
+	print('Retry policy test successfully')
+
+
+if __name__ == '__main__':
+	test_retry_policy()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+# router.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from keepalive import KeepaliveScheduler, ScheduledTask
+from retrypolicy import Action, classify_mysql_error
+
+try:
+	import asyncpg
+except ImportError:
+	asyncpg = None
+
+LEAST_OUTSTANDING = 'least_outstanding'
+ROUND_ROBIN = 'round_robin'
+
+# Methods of primary reached through the router which write (or open a session doing so)
+WRITE_METHODS = frozenset({'execute_prepared', 'bulk_insert', 'batch', 'copy_in', 'run_transaction',
+						   'session', 'transaction', 'write_behind'})
+
+
+def connection_failure(error: BaseException) -> bool:
+	'''
+		Errors telling the server (or the way to it) is broken rather than the statement
+	'''
+	if isinstance(error, OSError) or classify_mysql_error(error) is Action.RECONNECT:
+		return True
+	return asyncpg is not None and isinstance(error, (asyncpg.PostgresConnectionError,
+													  asyncpg.exceptions.CannotConnectNowError))
+
+
+class Endpoint:
+	'''
+		Replica handle with its routing state
+	'''
+	__slots__ = ('handle', 'name', 'weight', 'current_weight', 'outstanding', 'healthy', 'failures',
+				 'ejected_until', 'probing', 'requests', 'errors', 'ejections')
+
+	def __init__(self, handle: Any, weight: float = 1.0):
+		if weight <= 0:
+			raise ValueError('weight should be positive')
+		self.handle: Any = handle
+		host, port = getattr(handle, 'host', None), getattr(handle, 'port', None)
+		self.name: str = f'{host}:{port}' if port is not None else str(host if host is not None else id(handle))
+		self.weight: float = weight
+		# Smooth weighted round robin state
+		self.current_weight: float = 0.0
+		self.outstanding: int = 0
+		self.healthy: bool = True
+		self.failures: int = 0
+		self.ejected_until: float = 0.0
+		# Ejected replica has its single trial request in flight
+		self.probing: bool = False
+		self.requests: int = 0
+		self.errors: int = 0
+		self.ejections: int = 0
+
+	def stats(self) -> Dict[str, Union[str, int, float, bool]]:
+		return {
+			'name': self.name,
+			'weight': self.weight,
+			'healthy': self.healthy,
+			'outstanding': self.outstanding,
+			'requests': self.requests,
+			'errors': self.errors,
+			'ejections': self.ejections,
+		}
+
+
+class _Balancer:
+	'''
+		Replica selection and ejection, shared by the sync and async router
+	'''
+
+	def __init__(self, replicas: Sequence[Any], weights: Optional[Sequence[float]], strategy: str,
+				 failure_threshold: int, eject_time: float, is_failure: Callable[[BaseException], bool]):
+		if strategy not in (LEAST_OUTSTANDING, ROUND_ROBIN):
+			raise ValueError(f'Unknown strategy `{strategy}\', available: {(LEAST_OUTSTANDING, ROUND_ROBIN)}')
+		if weights is not None and len(weights) != len(replicas):
+			raise ValueError('Require one weight per replica')
+		self.logger: logging.Logger = logging.getLogger(__name__)
+		self.endpoints: List[Endpoint] = [
+			Endpoint(replica, weights[index] if weights is not None else 1.0) for index, replica in enumerate(replicas)
+		]
+		self.strategy: str = strategy
+		self.failure_threshold: int = failure_threshold
+		self.eject_time: float = eject_time
+		self.is_failure: Callable[[BaseException], bool] = is_failure
+		self._lock: threading.Lock = threading.Lock()
+		# Rotating start, so ties of least outstanding do not all go to the first replica
+		self._offset: int = 0
+
+	def pick(self) -> Optional[Endpoint]:
+		now = time.monotonic()
+		with self._lock:
+			# An ejected replica gets a single trial request once `eject_time' passed, even without health checks
+			candidates = [endpoint for endpoint in self.endpoints
+						  if endpoint.healthy or (now >= endpoint.ejected_until and not endpoint.probing)]
+			if not candidates:
+				return None
+			if self.strategy == LEAST_OUTSTANDING:
+				self._offset = (self._offset + 1) % len(candidates)
+				candidates = candidates[self._offset:] + candidates[:self._offset]
+				endpoint = min(candidates, key=lambda item: (item.outstanding + 1) / item.weight)
+			else:
+				total = 0.0
+				for candidate in candidates:
+					candidate.current_weight += candidate.weight
+					total += candidate.weight
+				endpoint = max(candidates, key=lambda item: item.current_weight)
+				endpoint.current_weight -= total
+			if not endpoint.healthy:
+				endpoint.probing = True
+			endpoint.outstanding += 1
+			endpoint.requests += 1
+			return endpoint
+
+	def done(self, endpoint: Endpoint, error: Optional[BaseException] = None) -> None:
+		with self._lock:
+			endpoint.outstanding -= 1
+			probe, endpoint.probing = endpoint.probing, False
+			if error is None:
+				endpoint.failures = 0
+				endpoint.healthy = True
+				return
+			if not isinstance(error, Exception):
+				# Cancelled, no verdict on the replica, next request is the trial again
+				return
+			endpoint.errors += 1
+		if self.is_failure(error):
+			self.mark_down(endpoint, error)
+		elif probe:
+			# Replica answered, only the statement failed
+			self.mark_up(endpoint)
+
+	def mark_down(self, endpoint: Endpoint, error: BaseException, eject: bool = False) -> None:
+		'''
+			Count a connection failure, `eject' at once (e.g. on a failed health check)
+		'''
+		with self._lock:
+			endpoint.failures += 1
+			if not eject and endpoint.failures < self.failure_threshold and endpoint.healthy:
+				return
+			if endpoint.healthy:
+				endpoint.ejections += 1
+				self.logger.warning('Replica %s ejected for %.1fs after %r', endpoint.name, self.eject_time, error)
+			endpoint.healthy = False
+			endpoint.ejected_until = time.monotonic() + self.eject_time
+
+	def mark_up(self, endpoint: Endpoint) -> None:
+		with self._lock:
+			if not endpoint.healthy:
+				self.logger.info('Replica %s is back', endpoint.name)
+			endpoint.healthy = True
+			endpoint.failures = 0
+
+
+class _RouterBase:
+
+	def __init__(self, primary: Any, replicas: Sequence[Any], *, strategy: str = LEAST_OUTSTANDING,
+				 weights: Optional[Sequence[float]] = None, sticky_window: float = 1.0,
+				 failure_threshold: int = 3, eject_time: float = 30.0, health_check_timeout: float = 2.0,
+				 failover: bool = True, is_failure: Callable[[BaseException], bool] = connection_failure):
+		self.primary: Any = primary
+		self._balancer: _Balancer = _Balancer(replicas, weights, strategy, failure_threshold, eject_time, is_failure)
+		self.sticky_window: float = sticky_window
+		self.health_check_timeout: float = health_check_timeout
+		self.failover: bool = failover
+		self._last_write: contextvars.ContextVar[float] = contextvars.ContextVar(f'router_write_{id(self)}', default=-1.0)
+		self._health_check: Optional[ScheduledTask] = None
+		self.primary_reads: int = 0
+		self.failovers: int = 0
+
+	@property
+	def endpoints(self) -> List[Endpoint]:
+		return self._balancer.endpoints
+
+	def mark_written(self) -> None:
+		'''
+			Send reads of current thread / task (and tasks it creates) to primary for `sticky_window' seconds
+		'''
+		self._last_write.set(time.monotonic())
+
+	def _primary_pinned(self) -> bool:
+		# Connection pinned by a session, transaction or uncommitted write of current context
+		session = getattr(self.primary, '_session', None)
+		if session is not None:
+			return session.get() is not None
+		pinned = getattr(self.primary, '_pinned', None)
+		return pinned is not None and pinned() is not None
+
+	def _read_endpoint(self) -> Optional[Endpoint]:
+		if time.monotonic() - self._last_write.get() < self.sticky_window or self._primary_pinned():
+			return None
+		return self._balancer.pick()
+
+	def _delegate(self, name: str) -> Any:
+		if name.startswith('_'):
+			raise AttributeError(name)
+		attribute = getattr(self.primary, name)
+		if name in WRITE_METHODS:
+			self.mark_written()
+		return attribute
+
+	def stats(self) -> Dict[str, Any]:
+		return {
+			'primary_reads': self.primary_reads,
+			'failovers': self.failovers,
+			'replicas': [endpoint.stats() for endpoint in self.endpoints],
+		}
+
+
+class ReadWriteRouter(_RouterBase):
+	'''
+		Front of a mysqldb.MySqlDB primary and its replicas with the same query API.
+		query / query1 go to a healthy replica picked by `strategy' (least outstanding requests
+		relative to weight, or smooth weighted round robin), everything else goes to primary.
+		Reads follow a write (execute or one of WRITE_METHODS) of the same thread for `sticky_window' seconds,
+		and always while the thread holds an uncommitted transaction (primary not in autocommit). A replica is ejected
+		for `eject_time' seconds after `failure_threshold' connection failures or a failed health check, then gets
+		a single trial request until one succeeds. A read failing on a broken replica is run again on primary
+		when `failover' is set.
+	'''
+
+	def _read(self, method: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+		endpoint = self._read_endpoint()
+		if endpoint is None:
+			self.primary_reads += 1
+			return getattr(self.primary, method)(*args, **kwargs)
+		error = None
+		try:
+			return getattr(endpoint.handle, method)(*args, **kwargs)
+		except BaseException as e:
+			error = e
+			if not isinstance(e, Exception) or not self.failover or not self._balancer.is_failure(e):
+				raise
+		finally:
+			self._balancer.done(endpoint, error)
+		self.failovers += 1
+		return getattr(self.primary, method)(*args, **kwargs)
+
+	def query(self, *args: Any, **kwargs: Any) -> Any:
+		return self._read('query', args, kwargs)
+
+	def query1(self, *args: Any, **kwargs: Any) -> Any:
+		return self._read('query1', args, kwargs)
+
+	def execute(self, *args: Any, **kwargs: Any) -> None:
+		try:
+			return self.primary.execute(*args, **kwargs)
+		finally:
+			self.mark_written()
+
+	def __getattr__(self, name: str) -> Any:
+		return self._delegate(name)
+
+	def check_health(self) -> None:
+		'''
+			Ping every replica one after another, ejecting those failing and bringing back those answering.
+			Connect and read timeouts of the replica handles bound how long it takes.
+		'''
+		for endpoint in self.endpoints:
+			try:
+				endpoint.handle.ping()
+			except Exception as e:
+				self._balancer.mark_down(endpoint, e, eject=True)
+			else:
+				self._balancer.mark_up(endpoint)
+
+	def start_health_checks(self, interval: float = 5.0) -> None:
+		'''
+			Run check_health every `interval' seconds on the process wide keepalive scheduler
+		'''
+		if self._health_check is not None:
+			self._health_check.cancel()
+		self._health_check = KeepaliveScheduler.get_instance().schedule(self.check_health, interval)
+
+	def close(self) -> None:
+		if self._health_check is not None:
+			self._health_check.cancel()
+		self.primary.close()
+		for endpoint in self.endpoints:
+			endpoint.handle.close()
+
+
+class AsyncReadWriteRouter(_RouterBase):
+	'''
+		ReadWriteRouter of aiomysqldb.MySqlDB or aiopgsqldb.PgSQLdb handles, reads follow writes
+		of the same task (and tasks it creates) and stay on primary inside its session() / transaction()
+	'''
+
+	async def _read(self, method: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Any:
+		endpoint = self._read_endpoint()
+		if endpoint is None:
+			self.primary_reads += 1
+			return await getattr(self.primary, method)(*args, **kwargs)
+		error = None
+		try:
+			return await getattr(endpoint.handle, method)(*args, **kwargs)
+		except BaseException as e:
+			error = e
+			if not isinstance(e, Exception) or not self.failover or not self._balancer.is_failure(e):
+				raise
+		finally:
+			self._balancer.done(endpoint, error)
+		self.failovers += 1
+		return await getattr(self.primary, method)(*args, **kwargs)
+
+	async def query(self, *args: Any, **kwargs: Any) -> Any:
+		return await self._read('query', args, kwargs)
+
+	async def query1(self, *args: Any, **kwargs: Any) -> Any:
+		return await self._read('query1', args, kwargs)
+
+	async def execute(self, *args: Any, **kwargs: Any) -> None:
+		try:
+			return await self.primary.execute(*args, **kwargs)
+		finally:
+			self.mark_written()
+
+	def __getattr__(self, name: str) -> Any:
+		return self._delegate(name)
+
+	async def _check(self, endpoint: Endpoint) -> None:
+		try:
+			await asyncio.wait_for(endpoint.handle.ping(), self.health_check_timeout)
+		except Exception as e:
+			self._balancer.mark_down(endpoint, e, eject=True)
+		else:
+			self._balancer.mark_up(endpoint)
+
+	async def check_health(self) -> None:
+		await asyncio.gather(*(self._check(endpoint) for endpoint in self.endpoints))
+
+	def start_health_checks(self, interval: float = 5.0) -> None:
+		'''
+			Run check_health every `interval' seconds, must be called from the event loop of the handles
+		'''
+		if self._health_check is not None:
+			self._health_check.cancel()
+		self._health_check = KeepaliveScheduler.get_instance().schedule(self.check_health, interval,
+																		 asyncio.get_running_loop())
+
+	async def close(self) -> None:
+		if self._health_check is not None:
+			self._health_check.cancel()
+		await self.primary.close()
+		for endpoint in self.endpoints:
+			await endpoint.handle.close()
+
+
+def test_router() -> None:
+	class FakeHandle:
+		def __init__(self, host: str):
+			self.host, self.down, self.reads, self.writes = host, False, 0, 0
+
+		def query(self, sql: str, args: Any = ()) -> str:
+			if self.down:
+				raise ConnectionRefusedError(self.host)
+			self.reads += 1
+			return self.host
+
+		def execute(self, sql: str, args: Any = ()) -> None:
+			self.writes += 1
+
+		def ping(self) -> None:
+			if self.down:
+				raise ConnectionRefusedError(self.host)
+
+		def _pinned(self) -> None:
+			return None
+
+		def close(self) -> None:
+			pass
+
+	primary, a, b = FakeHandle('primary'), FakeHandle('a'), FakeHandle('b')
+	router = ReadWriteRouter(primary, [a, b], strategy=ROUND_ROBIN, weights=[1, 3], sticky_window=0.05,
+							 failure_threshold=2, eject_time=0.05)
+	assert [router.query('SELECT') for _ in range(8)].count('b') == 6
+	router.ping()
+	assert router.query('SELECT') != 'primary', 'ping should not stick reads to primary'
+	router.execute('UPDATE')
+	assert router.query('SELECT') == 'primary' and primary.writes == 1
+	time.sleep(0.06)
+	assert router.query('SELECT') != 'primary'
+	b.down = True
+	assert {router.query('SELECT') for _ in range(8)} <= {'a', 'primary'} and router.failovers == 2
+	assert not router.endpoints[1].healthy and router.endpoints[1].ejections == 1
+	time.sleep(0.06)
+	# Only one trial request reaches the ejected replica, failing re-ejects it
+	picked = [router._balancer.pick() for _ in range(4)]
+	assert picked.count(router.endpoints[1]) == 1
+	for endpoint in picked:
+		router._balancer.done(endpoint, ConnectionRefusedError() if endpoint is router.endpoints[1] else None)
+	assert router._balancer.pick() is router.endpoints[0]
+	router._balancer.done(router.endpoints[0])
+	b.down = False
+	router.check_health()
+	assert router.endpoints[1].healthy and 'b' in {router.query('SELECT') for _ in range(4)}
+	router.close()
+	print('Router test successfully')
+
+
+if __name__ == '__main__':
+	test_router()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# rowformat.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import array
+import functools
+import itertools
+import keyword
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# dict: one dict per row, tuple: plain tuples, slots: instances of a __slots__ class made per column set,
+# columns: dict of per column lists, array / numpy: same with numeric columns packed in array.array / numpy arrays
+ROW_FORMATS = ('dict', 'tuple', 'slots', 'columns', 'array', 'numpy')
+# Formats read from a tuple returning cursor
+TUPLE_FORMATS = frozenset(ROW_FORMATS[1:])
+
+Columnar = Dict[str, Union[List[Any], array.array, Any]]
+
+
+def check_row_format(row_format: Optional[str]) -> None:
+	if row_format is not None and row_format not in ROW_FORMATS:
+		raise ValueError(f'Unknown row format `{row_format}\', available: {ROW_FORMATS}')
+	if row_format == 'numpy' and numpy is None:
+		raise ValueError('Row format `numpy\' requires numpy to be installed')
+
+
+def unique_columns(names: Iterable[str]) -> Tuple[str, ...]:
+	'''
+		Repeated names (e.g. `id' of both sides of a join) get a `_2', `_3' ... suffix
+	'''
+	names = list(names)
+	taken = set(names)
+	seen: Set[str] = set()
+	result = []
+	for name in names:
+		if name in seen:
+			count = 2
+			while f'{name}_{count}' in taken:
+				count += 1
+			name = f'{name}_{count}'
+			taken.add(name)
+		seen.add(name)
+		result.append(name)
+	return tuple(result)
+
+
+def _valid_attribute(name: str) -> bool:
+	return name.isidentifier() and not keyword.iskeyword(name) and not name.startswith('_')
+
+
+def _attributes(columns: Tuple[str, ...]) -> Tuple[str, ...]:
+	# Fallback `f<index>' names must not collide with a column of that name (e.g. `f1', `COUNT(*)')
+	taken = {name for name in columns if _valid_attribute(name)}
+	result = []
+	for index, name in enumerate(columns):
+		if not _valid_attribute(name):
+			name = f'f{index}'
+			while name in taken:
+				name += '_'
+			taken.add(name)
+		result.append(name)
+	return tuple(result)
+
+
+class _SlotsRow:
+	__slots__ = ()
+	_fields: Tuple[str, ...] = ()
+
+	def __iter__(self):
+		return (getattr(self, name) for name in self.__slots__)
+
+	def __len__(self) -> int:
+		return len(self.__slots__)
+
+	def __getitem__(self, key: Union[int, str]) -> Any:
+		if isinstance(key, str):
+			return getattr(self, self.__slots__[self._fields.index(key)])
+		return getattr(self, self.__slots__[key])
+
+	def __eq__(self, other: Any) -> bool:
+		if isinstance(other, _SlotsRow):
+			return self._fields == other._fields and tuple(self) == tuple(other)
+		return NotImplemented
+
+	__hash__ = None
+
+	def __repr__(self) -> str:
+		return f'Row({", ".join(f"{name}={value!r}" for name, value in zip(self._fields, self))})'
+
+	def _asdict(self) -> Dict[str, Any]:
+		return dict(zip(self._fields, self))
+
+
+@functools.lru_cache(maxsize=256)
+def row_class(columns: Tuple[str, ...]) -> type:
+	'''
+		__slots__ class of rows with `columns', built once per column set.
+		Columns which are no valid attribute name are reached as `f<index>' (with `_' appended while
+		that is taken by another column) or by row['name'].
+	'''
+	attributes = _attributes(columns)
+	# Positional parameters, so any column name works
+	parameters = ', '.join(f'_{index}' for index in range(len(columns)))
+	body = ''.join(f'\n\tself.{attribute} = _{index}' for index, attribute in enumerate(attributes)) or '\n\tpass'
+	namespace: Dict[str, Any] = {}
+	exec(f'def __init__(self{", " if parameters else ""}{parameters}):{body}', namespace)
+	return type('Row', (_SlotsRow,), {
+		'__slots__': attributes,
+		'_fields': columns,
+		'__init__': namespace['__init__'],
+	})
+
+
+def _packed(values: List[Any], row_format: str) -> Union[List[Any], array.array, Any]:
+	# Typed by the first value, array() rejects anything else (NULL, str, out of range int), which keeps the list
+	first = type(values[0]) if values else None
+	if first is int:
+		typecode, dtype = 'q', 'int64'
+	elif first is float:
+		typecode, dtype = 'd', 'float64'
+	else:
+		return values
+	try:
+		packed = array.array(typecode, values)
+	except (TypeError, OverflowError):
+		return values
+	# numpy array shares the buffer of array, no second copy
+	return numpy.frombuffer(packed, dtype=dtype) if row_format == 'numpy' else packed
+
+
+def format_rows(columns: Sequence[str], rows: Sequence[Sequence[Any]], row_format: str) -> Union[Tuple[Any, ...], Columnar]:
+	'''
+		Convert tuple-like `rows' with `columns' to `row_format', see ROW_FORMATS
+	'''
+	if row_format == 'tuple':
+		return rows if isinstance(rows, tuple) else tuple(tuple(row) for row in rows)
+	if row_format == 'dict':
+		return tuple(dict(zip(columns, row)) for row in rows)
+	columns = unique_columns(columns)
+	if row_format == 'slots':
+		return tuple(itertools.starmap(row_class(columns), rows))
+	if row_format not in ('columns', 'array', 'numpy'):
+		raise ValueError(f'Unknown row format `{row_format}\', available: {ROW_FORMATS}')
+	values = [list(column) for column in zip(*rows)] if rows else [[] for _ in columns]
+	if row_format != 'columns':
+		values = [_packed(column, row_format) for column in values]
+	return dict(zip(columns, values))
+
+
+def test_row_class() -> None:
+	row = row_class(unique_columns(('f1', '1', 'class', 'f2', 'id', 'id', 'id_2')))(1, 2, 3, 4, 5, 6, 7)
+	assert row._fields == ('f1', '1', 'class', 'f2', 'id', 'id_3', 'id_2'), row._fields
+	assert (row.f1, row['1'], row['class'], row.f2, row.id, row.id_3, row.id_2) == (1, 2, 3, 4, 5, 6, 7), row
+	assert list(row) == [1, 2, 3, 4, 5, 6, 7]
+	columnar = format_rows(('a', 'a', 'b'), [(1, 2.5, None), (3, 4.5, 'x')], 'array')
+	assert list(columnar) == ['a', 'a_2', 'b'] and columnar['a'].tolist() == [1, 3] and columnar['b'] == [None, 'x']
+	print('Row format test successfully')
+
+
+if __name__ == '__main__':
+	test_row_class()
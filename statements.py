@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+# statements.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_NO_BACKSLASH_ESCAPES
+from pymysql.converters import escape_string
+
+# `%%', `%s' and `%(name)s' are the only conversions drivers accept after escaping
+_CONVERSION = re.compile(r'%(?:\((\w+)\))?(.)')
+
+
+def _quote(value: str) -> str:
+	return "'" + escape_string(value) + "'"
+
+
+def _quote_no_backslash(value: str) -> str:
+	return "'" + value.replace("'", "''") + "'"
+
+
+class StatementTemplate:
+	'''
+		`sql' checked once for its placeholders, rendered with str, int and None values escaped
+		in line and anything else by the connection, producing the same text as the driver's mogrify
+	'''
+	__slots__ = ('sql', 'names', 'count', 'uses')
+
+	def __init__(self, sql: str):
+		self.sql: str = sql
+		names = []
+		count = 0
+		for name, conversion in _CONVERSION.findall(sql):
+			if conversion == '%':
+				continue
+			if conversion != 's':
+				raise ValueError(f'Unsupported conversion %{conversion} in {sql!r}')
+			if name:
+				names.append(name)
+			else:
+				count += 1
+		if names and count:
+			raise ValueError(f'Mixed positional and named placeholders in {sql!r}')
+		self.names: Tuple[str, ...] = tuple(names)
+		self.count: int = count
+		self.uses: int = 0
+
+	def render(self, args: Any, connection: Any) -> Optional[str]:
+		'''
+			return None when `args' do not fit, so the driver reports the error itself
+		'''
+		if args is None:
+			return self.sql
+		quote = (_quote_no_backslash if connection.server_status & SERVER_STATUS_NO_BACKSLASH_ESCAPES
+				 else _quote)
+		escape = connection.escape
+		if isinstance(args, (tuple, list)):
+			if len(args) != self.count or self.names:
+				return None
+			values: Union[Tuple[str, ...], Dict[str, str]] = tuple([
+				quote(value) if type(value) is str else str(value) if type(value) is int
+				else 'NULL' if value is None else escape(value)
+				for value in args
+			])
+		elif isinstance(args, dict):
+			if self.count:
+				return None
+			values = {
+				key: quote(value) if type(value) is str else str(value) if type(value) is int
+				else 'NULL' if value is None else escape(value)
+				for key, value in args.items()
+			}
+		else:
+			return None
+		try:
+			return self.sql % values
+		except (KeyError, TypeError, ValueError):
+			return None
+
+
+class StatementCache:
+	'''
+		Templates of the last `max_size' distinct statements, shared by every connection of a handle.
+		Statements the template cannot render (e.g. `%d' or a single non-sequence argument)
+		are left to the driver and counted as `bypassed'.
+	'''
+
+	def __init__(self, max_size: int = 256):
+		if max_size < 1:
+			raise ValueError('max_size should be positive')
+		self.max_size: int = max_size
+		self._lock: threading.Lock = threading.Lock()
+		self._templates: 'OrderedDict[str, Optional[StatementTemplate]]' = OrderedDict()
+		self.hits: int = 0
+		self.misses: int = 0
+		self.bypassed: int = 0
+
+	def get(self, sql: str) -> Optional[StatementTemplate]:
+		with self._lock:
+			template = self._templates.get(sql, False)
+			if template is not False:
+				self._templates.move_to_end(sql)
+				self.hits += 1
+				return template
+			self.misses += 1
+		try:
+			template = StatementTemplate(sql)
+		except ValueError:
+			template = None
+		with self._lock:
+			self._templates[sql] = template
+			while len(self._templates) > self.max_size:
+				self._templates.popitem(last=False)
+		return template
+
+	def render(self, sql: str, args: Any, connection: Any) -> Optional[str]:
+		'''
+			Statement text ready to be sent without further escaping, None to leave it to the driver
+		'''
+		template = self.get(sql)
+		rendered = template.render(args, connection) if template is not None else None
+		if rendered is None:
+			self.bypassed += 1
+		else:
+			template.uses += 1
+		return rendered
+
+	def __len__(self) -> int:
+		return len(self._templates)
+
+	def stats(self) -> Dict[str, Union[int, float]]:
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'size': len(self._templates),
+				'hits': self.hits,
+				'misses': self.misses,
+				'bypassed': self.bypassed,
+				'hit_rate': self.hits / lookups if lookups else 0.0,
+			}
+
+
+def test_statement_cache() -> None:
+	import datetime
+
+	class Connection:
+		server_status = 0
+
+		@staticmethod
+		def escape(value: Any) -> str:
+			return f"'{value}'"
+
+	connection = Connection()
+	cache = StatementCache(max_size=2)
+	sql = 'SELECT * FROM t WHERE a = %s AND b = %s AND c = %s AND d LIKE \'x%%\''
+	assert cache.render(sql, ("it's", 3, None), connection) == \
+		'SELECT * FROM t WHERE a = \'it\\\'s\' AND b = 3 AND c = NULL AND d LIKE \'x%\''
+	# Values other than str, int and None go to the connection
+	assert cache.render(sql, ('a', 1, datetime.date(2020, 1, 2)), connection).endswith("c = '2020-01-02' AND d LIKE 'x%'")
+	connection.server_status = SERVER_STATUS_NO_BACKSLASH_ESCAPES
+	assert cache.render('SELECT %(name)s', {'name': "it's"}, connection) == "SELECT 'it''s'"
+	# Wrong argument count, mixed placeholders or other conversions are left to the driver
+	assert cache.render(sql, ('a',), connection) is None
+	assert cache.render('SELECT %s, %(name)s', ('a',), connection) is None
+	assert cache.render('SELECT %d', (1,), connection) is None
+	assert cache.render('SELECT 1', None, connection) == 'SELECT 1'
+	assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 5, 'bypassed': 3, 'hit_rate': 2 / 7}, cache.stats()
+	assert sql not in cache._templates
+	print('Statement cache test successfully')
+
+
+if __name__ == '__main__':
+	test_statement_cache()
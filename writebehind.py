@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# writebehind.py
+# Copyright (C) 2021 KunoiSayami
+#
+# This module is part of libpy3 and is released under
+# the AGPL v3 License: https://www.gnu.org/licenses/agpl-3.0.txt
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+import asyncio
+import contextvars
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+Batch = List[Tuple[str, List[Any]]]
+
+
+def group_statements(writes: Sequence[Tuple[str, Any]]) -> Batch:
+	'''
+		Coalesce runs of the same statement, so each run becomes one executemany
+		while the order of different statements is kept
+	'''
+	groups: Batch = []
+	for sql, args in writes:
+		if groups and groups[-1][0] == sql:
+			groups[-1][1].append(args)
+		else:
+			groups.append((sql, [args]))
+	return groups
+
+
+class WriteBehindBuffer:
+	'''
+		Collect write statements and hand them to `write' in batches of up to `max_batch'
+		statements, once `max_batch' are pending or `max_delay' seconds after the first one.
+		`write' receives (statement, [args, ...]) groups and runs them in one transaction.
+		Every caller gets a future resolved when its batch is committed (or failed with the batch error),
+		callers wait for room once `max_pending' statements are queued or being written.
+	'''
+
+	def __init__(self, write: Callable[[Batch], Awaitable[None]], max_batch: int = 1000,
+				 max_delay: float = 0.01, max_pending: int = 10000):
+		if max_batch < 1 or max_pending < max_batch:
+			raise ValueError('Require 0 < max_batch <= max_pending')
+		self.logger: logging.Logger = logging.getLogger(__name__)
+		self._write: Callable[[Batch], Awaitable[None]] = write
+		self.max_batch: int = max_batch
+		self.max_delay: float = max_delay
+		self.max_pending: int = max_pending
+		self._pending: List[Tuple[str, Any, 'asyncio.Future[None]']] = []
+		# Pending and in flight statements
+		self._size: int = 0
+		self._room: Optional[asyncio.Condition] = None
+		self._nonempty: Optional[asyncio.Event] = None
+		self._ready: Optional[asyncio.Event] = None
+		self._task: Optional['asyncio.Task[None]'] = None
+		self._closing: bool = False
+		self.batches: int = 0
+		self.statements: int = 0
+		self.failed_batches: int = 0
+		self.waits: int = 0
+
+	def _start(self) -> None:
+		if self._task is None:
+			self._room = asyncio.Condition()
+			self._nonempty = asyncio.Event()
+			self._ready = asyncio.Event()
+			# Clean context, so the flusher does not inherit e.g. a session pinned by its first caller
+			self._task = contextvars.Context().run(asyncio.get_running_loop().create_task, self._run())
+
+	async def submit(self, sql: str, args: Any = ()) -> 'asyncio.Future[None]':
+		'''
+			Queue a statement, waiting for room when the buffer is full, return the future of its commit
+		'''
+		if self._closing:
+			raise RuntimeError('Write behind buffer is closed')
+		self._start()
+		if self._size >= self.max_pending:
+			self.waits += 1
+			async with self._room:
+				await self._room.wait_for(lambda: self._size < self.max_pending or self._closing)
+			if self._closing:
+				raise RuntimeError('Write behind buffer is closed')
+		future = asyncio.get_running_loop().create_future()
+		self._pending.append((sql, args, future))
+		self._size += 1
+		self._nonempty.set()
+		if len(self._pending) >= self.max_batch:
+			self._ready.set()
+		return future
+
+	async def execute(self, sql: str, args: Any = ()) -> None:
+		'''
+			Queue a statement and wait until its batch is committed
+		'''
+		await (await self.submit(sql, args))
+
+	async def flush(self) -> None:
+		'''
+			Write everything queued so far without waiting for `max_delay', errors are left to the callers
+		'''
+		if not self._pending:
+			return
+		futures = [future for _, _, future in self._pending]
+		self._ready.set()
+		await asyncio.wait(futures)
+
+	async def close(self) -> None:
+		'''
+			Write remaining statements and stop
+		'''
+		if self._task is None:
+			self._closing = True
+			return
+		self._closing = True
+		self._ready.set()
+		self._nonempty.set()
+		async with self._room:
+			self._room.notify_all()
+		await self._task
+
+	async def _run(self) -> None:
+		while True:
+			await self._nonempty.wait()
+			if not self._pending:
+				self._nonempty.clear()
+				if self._closing:
+					return
+				continue
+			if not self._ready.is_set():
+				try:
+					await asyncio.wait_for(self._ready.wait(), self.max_delay)
+				except asyncio.TimeoutError:
+					pass
+			batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+			if len(self._pending) < self.max_batch and not self._closing:
+				self._ready.clear()
+			try:
+				await self._write(group_statements([(sql, args) for sql, args, _ in batch]))
+			except Exception as e:
+				self.failed_batches += 1
+				self.logger.warning('Write behind batch of %d statements failed: %r', len(batch), e)
+				for _, _, future in batch:
+					if not future.done():
+						future.set_exception(e)
+						# Caller may have stopped waiting, do not warn about unretrieved exception
+						future.exception()
+			except BaseException:
+				# Flusher cancelled, nothing will write what is left
+				for _, _, future in batch + self._pending:
+					if not future.done():
+						future.cancel()
+				self._pending = []
+				raise
+			else:
+				self.batches += 1
+				self.statements += len(batch)
+				for _, _, future in batch:
+					if not future.done():
+						future.set_result(None)
+			self._size -= len(batch)
+			async with self._room:
+				self._room.notify_all()
+
+	def __len__(self) -> int:
+		return self._size
+
+	def stats(self) -> Dict[str, int]:
+		return {
+			'pending': len(self._pending),
+			'in_flight': self._size - len(self._pending),
+			'batches': self.batches,
+			'statements': self.statements,
+			'failed_batches': self.failed_batches,
+			'waits': self.waits,
+		}
+
+
+async def test_write_behind() -> None:
+	assert group_statements([('a', 1), ('a', 2), ('b', 3), ('a', 4)]) == [('a', [1, 2]), ('b', [3]), ('a', [4])]
+	written: Batch = []
+	gate = asyncio.Event()
+
+	async def write(batch: Batch) -> None:
+		await gate.wait()
+		written.extend(batch)
+
+	# Under `max_batch', the batch goes out once `max_delay' passes
+	gate.set()
+	buffer = WriteBehindBuffer(write, max_batch=10, max_delay=0.05, max_pending=10)
+	loop = asyncio.get_running_loop()
+	start = loop.time()
+	await asyncio.gather(buffer.execute('INSERT a', (1,)), buffer.execute('INSERT a', (2,)))
+	assert loop.time() - start >= 0.04, loop.time() - start
+	assert written == [('INSERT a', [(1,), (2,)])], written
+	await buffer.close()
+	# With the writer stuck, callers past `max_pending' wait for room
+	gate.clear()
+	written.clear()
+	buffer = WriteBehindBuffer(write, max_batch=2, max_delay=0.01, max_pending=2)
+	futures = [await buffer.submit('INSERT b', (i,)) for i in range(2)]
+	blocked = asyncio.ensure_future(buffer.submit('INSERT b', (2,)))
+	await asyncio.sleep(0.05)
+	assert not blocked.done() and buffer.waits == 1 and len(buffer) == 2, buffer.stats()
+	gate.set()
+	futures.append(await blocked)
+	await asyncio.wait(futures)
+	await buffer.close()
+	assert written == [('INSERT b', [(0,), (1,)]), ('INSERT b', [(2,)])], written
+	assert buffer.stats() == {'pending': 0, 'in_flight': 0, 'batches': 2, 'statements': 3, 'failed_batches': 0, 'waits': 1}
+	print('Write behind test successfully')
+
+
+if __name__ == '__main__':
+	asyncio.run(test_write_behind())